@@ -4,18 +4,17 @@ import ctk
 import slicer
 import vtk
 import numpy as np
+from collections import OrderedDict
 from datetime import datetime
-from .SurgeryPlannerLogic import SurgeryPlannerLogic
-
-try:
-    import yaml
-except ImportError:
-    yaml = None
+from .SurgeryPlannerLogic import SurgeryPlannerLogic, PlaneContourCache, ResectionVolumeCalculator, \
+    bulkOperation, deferDuringBulkOperation
+from . import surgery_planner_io as sio
 
 class ReferencePlanePlannerWidget(qt.QWidget):
     def __init__(self, parent=None, logic=None, module_dir=None):
         super(ReferencePlanePlannerWidget, self).__init__(parent)
         self.logic = logic if logic else SurgeryPlannerLogic()
+        self.ownsLogic = logic is None  # a logic created here is released by cleanup
         self.module_dir = module_dir
         if not self.module_dir:
             self.module_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
@@ -35,9 +34,31 @@ class ReferencePlanePlannerWidget(qt.QWidget):
             (1, 0.8, 0.8)  # Light Red
         ]
         
+        # Planes modified during a bulk operation, refreshed once when it ends (see refreshModifiedPlanes)
+        self.pendingPlaneRefresh = OrderedDict()
+
+        # Trajectory x plane intersections (see onComputeIntersections)
+        self.intersectionTable = None
+        self.intersectionTableNode = None
+        self.landmarksNode = None
+        self.landmarksObserverTag = None
+
+        # Cross-section contours of segment surfaces (see updatePlaneContour)
+        self.contourCache = PlaneContourCache()
+        self.contourModels = {}  # plane node ID -> vtkMRMLModelNode
+        self.contourPoseKeys = {}  # plane node ID -> pose key of the displayed contour
+
+        # Resection volume between planes (see onComputeResectionVolume)
+        self.resectionCalculator = ResectionVolumeCalculator()
+
         self.setup_ui()
         self.setup_scene()
         
+    def cleanup(self):
+        # Release the logic of a standalone planner (the module's logic is released by SurgeryPlannerWidget)
+        if self.ownsLogic:
+            self.logic.cleanup()
+
     def setup_ui(self):
         self.main_layout = qt.QVBoxLayout(self)
         
@@ -114,11 +135,133 @@ class ReferencePlanePlannerWidget(qt.QWidget):
         self.opacitySlider.connect('valueChanged(double)', self.onOpacityChanged)
         planeActionsFormLayout.addRow("Opacity:", self.opacitySlider)
 
-        # 9. Delete Plane (Selected)
+        # 9. Cross-Section Contours
+        self.showContoursCheckBox = qt.QCheckBox()
+        self.showContoursCheckBox.checked = False
+        self.showContoursCheckBox.setToolTip("Show the outline of the segments where each plane cuts them")
+        self.showContoursCheckBox.connect('toggled(bool)', self.onShowContoursToggled)
+        planeActionsFormLayout.addRow("Cross-Section Contours:", self.showContoursCheckBox)
+
+        # 10. Delete Plane (Selected)
         self.deletePlaneButton = qt.QPushButton("Delete Reference Plane")
         self.deletePlaneButton.connect('clicked(bool)', self.onDeletePlane)
         planeActionsFormLayout.addRow(self.deletePlaneButton)
         
+        # Fit Plane
+        fitCollapsibleButton = ctk.ctkCollapsibleButton()
+        fitCollapsibleButton.text = "Fit Plane"
+        self.main_layout.addWidget(fitCollapsibleButton)
+        fitCollapsibleButton.setChecked(False)
+        fitFormLayout = qt.QFormLayout(fitCollapsibleButton)
+
+        self.fitSourceSelector = slicer.qMRMLNodeComboBox()
+        self.fitSourceSelector.nodeTypes = ["vtkMRMLMarkupsFiducialNode", "vtkMRMLModelNode"]
+        self.fitSourceSelector.addEnabled = False
+        self.fitSourceSelector.removeEnabled = False
+        self.fitSourceSelector.noneEnabled = True
+        self.fitSourceSelector.setMRMLScene(slicer.mrmlScene)
+        self.fitSourceSelector.setToolTip("Markups or model whose points define the plane")
+        fitFormLayout.addRow("Points:", self.fitSourceSelector)
+
+        self.fitRansacCheckBox = qt.QCheckBox()
+        self.fitRansacCheckBox.checked = False
+        self.fitRansacCheckBox.toolTip = "Ignore outlier points (RANSAC) before the least-squares fit"
+        fitFormLayout.addRow("Robust (RANSAC):", self.fitRansacCheckBox)
+
+        self.fitThresholdSpinBox = qt.QDoubleSpinBox()
+        self.fitThresholdSpinBox.setRange(0.01, 100.0)
+        self.fitThresholdSpinBox.setValue(1.0)
+        self.fitThresholdSpinBox.setSuffix(" mm")
+        self.fitThresholdSpinBox.setToolTip("RANSAC inlier distance")
+        fitFormLayout.addRow("Inlier Threshold:", self.fitThresholdSpinBox)
+
+        self.fitUpdateSelectedCheckBox = qt.QCheckBox()
+        self.fitUpdateSelectedCheckBox.checked = False
+        self.fitUpdateSelectedCheckBox.toolTip = "Move the selected plane instead of creating a new one"
+        fitFormLayout.addRow("Update Selected Plane:", self.fitUpdateSelectedCheckBox)
+
+        self.fitPlaneButton = qt.QPushButton("Fit Plane")
+        self.fitPlaneButton.connect('clicked(bool)', self.onFitPlane)
+        fitFormLayout.addRow(self.fitPlaneButton)
+
+        self.fitResultLabel = qt.QLabel("")
+        self.fitResultLabel.setWordWrap(True)
+        fitFormLayout.addRow("Residuals:", self.fitResultLabel)
+
+        # Trajectory Intersections
+        intersectionsCollapsibleButton = ctk.ctkCollapsibleButton()
+        intersectionsCollapsibleButton.text = "Trajectory Intersections"
+        self.main_layout.addWidget(intersectionsCollapsibleButton)
+        intersectionsCollapsibleButton.setChecked(False)
+        intersectionsFormLayout = qt.QFormLayout(intersectionsCollapsibleButton)
+
+        self.computeIntersectionsButton = qt.QPushButton("Compute Intersections")
+        self.computeIntersectionsButton.toolTip = "Compute where every trajectory crosses every reference plane"
+        self.computeIntersectionsButton.connect('clicked(bool)', self.onComputeIntersections)
+        intersectionsFormLayout.addRow(self.computeIntersectionsButton)
+
+        self.liveIntersectionsCheckBox = qt.QCheckBox()
+        self.liveIntersectionsCheckBox.checked = True
+        self.liveIntersectionsCheckBox.toolTip = "Update the row / column of a trajectory / plane when it moves"
+        intersectionsFormLayout.addRow("Live Update:", self.liveIntersectionsCheckBox)
+
+        self.intersectionTableView = slicer.qMRMLTableView()
+        self.intersectionTableView.setMRMLScene(slicer.mrmlScene)
+        self.intersectionTableView.setMinimumHeight(150)
+        intersectionsFormLayout.addRow(self.intersectionTableView)
+
+        self.exportIntersectionsButton = qt.QPushButton("Export Intersections CSV")
+        self.exportIntersectionsButton.toolTip = "Save the intersection table next to the planes output file"
+        self.exportIntersectionsButton.connect('clicked(bool)', self.onExportIntersections)
+        intersectionsFormLayout.addRow(self.exportIntersectionsButton)
+
+        # Resection Volume
+        resectionCollapsibleButton = ctk.ctkCollapsibleButton()
+        resectionCollapsibleButton.text = "Resection Volume"
+        self.main_layout.addWidget(resectionCollapsibleButton)
+        resectionCollapsibleButton.setChecked(False)
+        resectionFormLayout = qt.QFormLayout(resectionCollapsibleButton)
+
+        self.resectionLabelmapSelector = slicer.qMRMLNodeComboBox()
+        self.resectionLabelmapSelector.nodeTypes = ["vtkMRMLLabelMapVolumeNode"]
+        self.resectionLabelmapSelector.addEnabled = False
+        self.resectionLabelmapSelector.removeEnabled = False
+        self.resectionLabelmapSelector.noneEnabled = True
+        self.resectionLabelmapSelector.setMRMLScene(slicer.mrmlScene)
+        self.resectionLabelmapSelector.setToolTip("Labelmap of the bone to measure")
+        resectionFormLayout.addRow("Labelmap:", self.resectionLabelmapSelector)
+
+        self.resectionLabelSpinBox = qt.QSpinBox()
+        self.resectionLabelSpinBox.setRange(0, 65535)
+        self.resectionLabelSpinBox.setSpecialValueText("Any")
+        self.resectionLabelSpinBox.setToolTip("Label value to measure (Any = all non-zero labels)")
+        resectionFormLayout.addRow("Label:", self.resectionLabelSpinBox)
+
+        self.resectionPlanesSelector = slicer.qMRMLCheckableNodeComboBox()
+        self.resectionPlanesSelector.nodeTypes = ["vtkMRMLMarkupsPlaneNode"]
+        self.resectionPlanesSelector.setMRMLScene(slicer.mrmlScene)
+        self.resectionPlanesSelector.setToolTip("Planes bounding the resection")
+        resectionFormLayout.addRow("Planes:", self.resectionPlanesSelector)
+
+        self.resectionModeSelector = qt.QComboBox()
+        self.resectionModeSelector.addItems(["between", "above", "below"])
+        self.resectionModeSelector.setToolTip("between: region enclosed by the planes; "
+                                              "above / below: normal / opposite side of every plane")
+        resectionFormLayout.addRow("Region:", self.resectionModeSelector)
+
+        self.computeResectionButton = qt.QPushButton("Compute Resection Volume")
+        self.computeResectionButton.connect('clicked(bool)', self.onComputeResectionVolume)
+        resectionFormLayout.addRow(self.computeResectionButton)
+
+        self.liveResectionCheckBox = qt.QCheckBox()
+        self.liveResectionCheckBox.checked = False
+        self.liveResectionCheckBox.toolTip = "Recompute while the selected planes are moved"
+        resectionFormLayout.addRow("Live Update:", self.liveResectionCheckBox)
+
+        self.resectionResultLabel = qt.QLabel("")
+        self.resectionResultLabel.setWordWrap(True)
+        resectionFormLayout.addRow("Result:", self.resectionResultLabel)
+
         # Saving Controls
         savingCollapsibleButton = ctk.ctkCollapsibleButton()
         savingCollapsibleButton.text = "Reference Plane Saving"
@@ -147,12 +290,40 @@ class ReferencePlanePlannerWidget(qt.QWidget):
         self.saveAsTxtButton.toolTip = "Save current planes to the specified TXT file"
         self.saveAsTxtButton.connect('clicked(bool)', self.onSaveAsTxtButton)
         self.manualSaveLayout.addWidget(self.saveAsTxtButton)
+
+        self.saveAsBinaryButton = qt.QPushButton("Save as Binary")
+        self.saveAsBinaryButton.toolTip = "Save current planes to the binary (.npz) equivalent of the TXT file"
+        self.saveAsBinaryButton.connect('clicked(bool)', self.onSaveAsBinaryButton)
+        self.manualSaveLayout.addWidget(self.saveAsBinaryButton)
         savingFormLayout.addRow("Manual Save:", self.manualSaveLayout)
 
         """Auto-Save Info"""
         self.autoSaveLabel = qt.QLabel(self.temp_plane_file)
         self.autoSaveLabel.toolTip = "Location of the continuous auto-save file"
         savingFormLayout.addRow("Auto-Save Location:", self.autoSaveLabel)
+
+        # Loading Controls
+        loadingCollapsibleButton = ctk.ctkCollapsibleButton()
+        loadingCollapsibleButton.text = "Reference Plane Loading"
+        self.main_layout.addWidget(loadingCollapsibleButton)
+        loadingCollapsibleButton.setChecked(False)
+        loadingFormLayout = qt.QFormLayout(loadingCollapsibleButton)
+
+        self.loadingDirSelector = ctk.ctkPathLineEdit()
+        self.loadingDirSelector.filters = ctk.ctkPathLineEdit.Dirs
+        self.loadingDirSelector.toolTip = "Select the folder to load planes from"
+        self.loadingDirSelector.currentPath = default_dir
+        loadingFormLayout.addRow("Planes Folder:", self.loadingDirSelector)
+
+        self.loadingFileNameBox = qt.QLineEdit()
+        self.loadingFileNameBox.text = default_filename
+        self.loadingFileNameBox.toolTip = "Enter the planes filename to load (TXT or .npz)"
+        loadingFormLayout.addRow("Planes Filename:", self.loadingFileNameBox)
+
+        self.loadPlanesButton = qt.QPushButton("Load Planes")
+        self.loadPlanesButton.toolTip = "Load planes from the specified file (Replaces current planes)"
+        self.loadPlanesButton.connect('clicked(bool)', self.onLoadPlanesButton)
+        loadingFormLayout.addRow("Manual Load:", self.loadPlanesButton)
         
         self.main_layout.addStretch(1)
 
@@ -176,8 +347,27 @@ class ReferencePlanePlannerWidget(qt.QWidget):
              pass
 
     def onPlaneModified(self, caller, event):
+        # Planes changed in bulk are refreshed and saved once when the bulk operation ends (both are deferred)
+        self.pendingPlaneRefresh[caller.GetID()] = caller
+        self.refreshModifiedPlanes()
         self.writePlanesToFile()
 
+    @deferDuringBulkOperation
+    def refreshModifiedPlanes(self):
+        """Update the intersections, contours and live resection volume of the planes modified since the last call."""
+        planes = [node for node in self.pendingPlaneRefresh.values() if slicer.mrmlScene.IsNodePresent(node)]
+        self.pendingPlaneRefresh.clear()
+        for planeNode in planes:
+            self.updatePlaneIntersections(planeNode)
+            self.updatePlaneContour(planeNode)
+        if self.liveResectionCheckBox.checked and any(node in self.resectionPlanesSelector.checkedNodes()
+                                                      for node in planes):
+            self.onComputeResectionVolume()
+
+    def getPlaneColor(self, idx):
+        # Cycle through the plane colors based on the plane index
+        return self.plane_colors[(idx - 1) % len(self.plane_colors)]
+
     def getNextPlaneIndex(self):
         # Find the next available index X for ReferencePlane_{X}
         nodes = slicer.util.getNodesByClass("vtkMRMLMarkupsPlaneNode")
@@ -214,21 +404,7 @@ class ReferencePlanePlannerWidget(qt.QWidget):
                 print("[ReferencePlanePlanner] Setting display properties")
                 
                 # Pick color based on index
-                color_idx = (idx - 1) % len(self.plane_colors)
-                color = self.plane_colors[color_idx]
-                
-                displayNode.SetGlyphScale(1.0) 
-                displayNode.SetOpacity(0.5)    
-                displayNode.SetSelectedColor(color[0], color[1], color[2]) 
-                displayNode.SetColor(color[0], color[1], color[2])
-                
-                # Enable Interaction Handles
-                displayNode.SetHandlesInteractive(True)
-                displayNode.SetRotationHandleVisibility(True)
-                displayNode.SetTranslationHandleVisibility(True)
-                
-                # Disable Scale Handles to enforce fixed size via UI
-                displayNode.SetScaleHandleVisibility(False)
+                self.logic.setupPlaneDisplayNode(displayNode, self.getPlaneColor(idx))
             
             planeNode.RemoveAllControlPoints()
             print(f"[ReferencePlanePlanner] Adding Center control point: {center_name}")
@@ -349,6 +525,7 @@ class ReferencePlanePlannerWidget(qt.QWidget):
         # Remove the selected plane node
         node_to_remove = self.planeSelector.currentNode()
         if node_to_remove:
+            self.removePlaneContour(node_to_remove)
             slicer.mrmlScene.RemoveNode(node_to_remove)
             print(f"[ReferencePlanePlanner] Removed Reference Plane: {node_to_remove.GetName()}")
             self.writePlanesToFile()
@@ -367,6 +544,12 @@ class ReferencePlanePlannerWidget(qt.QWidget):
         if not os.path.exists(config_path):
             return default_config
             
+        # yaml is optional and only needed here, so it is imported when the config is read
+        try:
+            import yaml
+        except ImportError:
+            yaml = None
+
         try:
             if yaml:
                 with open(config_path, 'r') as f:
@@ -405,19 +588,28 @@ class ReferencePlanePlannerWidget(qt.QWidget):
             print(f"Error loading config: {e}")
             return default_config
 
+    @deferDuringBulkOperation
     def writePlanesToFile(self, output_file=None):
         try:
             if output_file is None:
                 output_file = self.temp_plane_file
             
             coord_sys = self.config.get('coordinate_system', 'RAS')
+
+            if output_file.lower().endswith('.npz'):
+                names, matrices, sizes = self.logic.getReferencePlaneArrays()
+                if coord_sys == 'LPS':
+                    matrices = sio.convert_matrices_lps_ras(matrices)
+                sio.write_planes_npz(output_file, names, matrices, sizes, coord_sys)
+                print(f"[ReferencePlanePlanner] Updated planes in {output_file}")
+                return
             
             with open(output_file, 'w') as f:
                 # Write Header
                 f.write(f"# SurgeryPlanner Reference Planes Output\n")
                 f.write(f"# Timestamp: {datetime.now().isoformat()}\n")
                 f.write(f"# CoordinateSystem: {coord_sys}\n")
-                f.write("PlaneName,Matrix00,Matrix01,Matrix02,Matrix03,Matrix10,Matrix11,Matrix12,Matrix13,Matrix20,Matrix21,Matrix22,Matrix23,Matrix30,Matrix31,Matrix32,Matrix33,Width,Height\n")
+                f.write(sio.PLANE_FILE_HEADER + "\n")
                 
                 # Write Data
                 nodes = slicer.util.getNodesByClass("vtkMRMLMarkupsPlaneNode")
@@ -477,3 +669,236 @@ class ReferencePlanePlannerWidget(qt.QWidget):
         output_file = os.path.join(output_dir, output_filename)
         self.writePlanesToFile(output_file)
         print(f"Manually saved Planes TXT to {output_file}")
+
+    def onSaveAsBinaryButton(self):
+        output_dir = self.outputDirSelector.currentPath
+        output_filename = self.outputFileNameBox.text
+        if not output_dir or not output_filename:
+            print("Please specify a valid destination folder and filename.")
+            return
+
+        # Ensure extension is .npz
+        base, ext = os.path.splitext(output_filename)
+        output_file = os.path.join(output_dir, base + '.npz')
+        self.writePlanesToFile(output_file)
+        print(f"Manually saved Planes binary to {output_file}")
+
+    def onLoadPlanesButton(self):
+        input_dir = self.loadingDirSelector.currentPath
+        input_filename = self.loadingFileNameBox.text
+        if not input_dir or not input_filename:
+            print("Please specify a valid loading folder and filename.")
+            return
+
+        filepath = os.path.join(input_dir, input_filename)
+        if not os.path.exists(filepath):
+            print(f"File not found: {filepath}")
+            return
+
+        ret = qt.QMessageBox.warning(None, "Load Reference Planes",
+                                     "This will remove all current reference planes in the scene. Do you want to proceed?",
+                                     qt.QMessageBox.Yes | qt.QMessageBox.No)
+        if ret == qt.QMessageBox.No:
+            return
+
+        self.loadPlanesFromFile(filepath)
+
+    def loadPlanesFromFile(self, filepath):
+        """Replace the reference planes in the scene with the planes stored in a TXT or .npz planes file."""
+        try:
+            planes = sio.read_planes_file(filepath)
+            matrices = planes['matrices']
+            if planes['coordinate_system'] == 'LPS':
+                matrices = sio.convert_matrices_lps_ras(matrices)
+            colors = [self.getPlaneColor(i + 1) for i in range(len(planes['names']))]
+            nodes = self.restorePlanes(planes['names'], matrices, planes['sizes'], colors)
+            print(f"[ReferencePlanePlanner] Loaded {len(nodes)} planes from {filepath}")
+
+        except Exception as e:
+            print(f"[ReferencePlanePlanner] Failed to load planes: {e}")
+
+    def restorePlanes(self, names, matrices, sizes, colors, opacities=0.5, visibilities=None, selectedName=None):
+        """Replace the reference planes in the scene with the given planes (RAS matrices) in one bulk operation.
+        The selected plane is the one named selectedName, or the last plane."""
+        with bulkOperation():
+            for node in slicer.util.getNodesByClass("vtkMRMLMarkupsPlaneNode"):
+                self.removePlaneContour(node)
+                slicer.mrmlScene.RemoveNode(node)
+            nodes = self.logic.createPlaneNodes(names, matrices, sizes, colors, opacities)
+            for i, node in enumerate(nodes):
+                if visibilities is not None and node.GetDisplayNode():
+                    node.GetDisplayNode().SetVisibility(bool(visibilities[i]))
+                self.addPlaneObservers(node)
+            self.writePlanesToFile()
+        selected = [node for node in nodes if node.GetName() == selectedName] or nodes[-1:]
+        if selected:
+            self.planeSelector.setCurrentNode(selected[0])
+        return nodes
+
+    def onComputeIntersections(self):
+        if self.landmarksNode and self.landmarksObserverTag is not None:
+            self.landmarksNode.RemoveObserver(self.landmarksObserverTag)
+            self.landmarksObserverTag = None
+
+        self.landmarksNode = slicer.mrmlScene.GetFirstNodeByName("SurgeryPlannerLandmarks")
+        self.intersectionTable = self.logic.computeTrajectoryPlaneIntersections(self.landmarksNode)
+        if self.landmarksNode:
+            self.landmarksObserverTag = self.landmarksNode.AddObserver(
+                slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self.onLandmarkPointModified)
+        self.updateIntersectionTableNode()
+        print(f"[ReferencePlanePlanner] Computed intersections for {len(self.intersectionTable.trajectory_names)} "
+              f"trajectories x {len(self.intersectionTable.plane_names)} planes")
+
+    def updatePlaneIntersections(self, planeNode):
+        # Recompute only the column of the plane that moved
+        if not self.intersectionTable or not self.liveIntersectionsCheckBox.checked:
+            return
+        name = planeNode.GetName()
+        if name not in self.intersectionTable.plane_names:
+            return
+        _, matrices, sizes = self.logic.getReferencePlaneArrays([planeNode])
+        self.intersectionTable.update_plane(self.intersectionTable.plane_names.index(name), matrices[0], sizes[0])
+        self.updateIntersectionTableNode()
+
+    @vtk.calldata_type(vtk.VTK_INT)
+    def onLandmarkPointModified(self, caller, event, pointIndex):
+        # Recompute only the row of the trajectory that owns the moved control point
+        if not self.intersectionTable or not self.liveIntersectionsCheckBox.checked:
+            return
+        if pointIndex is None or pointIndex < 0 or pointIndex >= caller.GetNumberOfControlPoints():
+            return
+        num = caller.GetNthControlPointLabel(pointIndex).rpartition('_')[2]
+        trajName = f"traj_{num}"
+        if trajName not in self.intersectionTable.trajectory_names:
+            return
+        entry = [0.0, 0.0, 0.0]
+        target = [0.0, 0.0, 0.0]
+        entryIdx = caller.GetControlPointIndexByLabel(f"Entry_{num}")
+        targetIdx = caller.GetControlPointIndexByLabel(f"Target_{num}")
+        if entryIdx < 0 or targetIdx < 0:
+            return
+        caller.GetNthControlPointPositionWorld(entryIdx, entry)
+        caller.GetNthControlPointPositionWorld(targetIdx, target)
+        self.intersectionTable.update_trajectory(self.intersectionTable.trajectory_names.index(trajName), entry, target)
+        self.updateIntersectionTableNode()
+
+    def updateIntersectionTableNode(self):
+        if not self.intersectionTableNode or not slicer.mrmlScene.IsNodePresent(self.intersectionTableNode):
+            self.intersectionTableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode",
+                                                                            "TrajectoryPlaneIntersections")
+            self.intersectionTableView.setMRMLTableNode(self.intersectionTableNode)
+        self.logic.updateTableNodeFromColumns(self.intersectionTableNode, self.intersectionTable.columns())
+
+    def onExportIntersections(self):
+        if not self.intersectionTable:
+            self.onComputeIntersections()
+        output_dir = self.outputDirSelector.currentPath
+        if not output_dir:
+            print("Please specify a valid destination folder.")
+            return
+        output_file = os.path.join(output_dir, "trajectory_plane_intersections.csv")
+        try:
+            sio.write_table_csv(output_file, self.intersectionTable.columns(),
+                                ["CoordinateSystem: RAS", f"Timestamp: {datetime.now().isoformat()}"])
+            print(f"[ReferencePlanePlanner] Saved intersections to {output_file}")
+        except Exception as e:
+            print(f"[ReferencePlanePlanner] Failed to export intersections: {e}")
+
+    def onShowContoursToggled(self, checked):
+        if checked:
+            self.contourPoseKeys.clear()
+            surfaces = self.logic.getSegmentSurfaces()
+            for node in slicer.util.getNodesByClass("vtkMRMLMarkupsPlaneNode"):
+                self.updatePlaneContour(node, surfaces)
+        else:
+            for node in slicer.util.getNodesByClass("vtkMRMLMarkupsPlaneNode"):
+                self.removePlaneContour(node)
+            self.contourCache.clear()
+
+    def updatePlaneContour(self, planeNode, surfaces=None):
+        if not self.showContoursCheckBox.checked:
+            return
+        # Skip events that do not change the (quantized) pose, e.g. while a drag is in progress
+        _, matrices, sizes = self.logic.getReferencePlaneArrays([planeNode])
+        poseKey = self.contourCache.poseKey(matrices[0], sizes[0])
+        planeID = planeNode.GetID()
+        if self.contourPoseKeys.get(planeID) == poseKey:
+            return
+        self.contourPoseKeys[planeID] = poseKey
+
+        contour = self.logic.computePlaneContour(self.contourCache, planeNode, surfaces)
+        modelNode = self.contourModels.get(planeID)
+        if modelNode is None or not slicer.mrmlScene.IsNodePresent(modelNode):
+            modelNode = slicer.modules.models.logic().AddModel(contour)
+            modelNode.SetName(f"{planeNode.GetName()}_contour")
+            modelNode.SetHideFromEditors(1)
+            modelDisplayNode = modelNode.GetDisplayNode()
+            modelDisplayNode.SetVisibility2D(True)
+            modelDisplayNode.SetLineWidth(3)
+            color = planeNode.GetDisplayNode().GetSelectedColor() if planeNode.GetDisplayNode() else (1, 1, 1)
+            modelDisplayNode.SetColor(color[0], color[1], color[2])
+            self.contourModels[planeID] = modelNode
+        else:
+            modelNode.SetAndObservePolyData(contour)
+
+    def removePlaneContour(self, planeNode):
+        planeID = planeNode.GetID()
+        modelNode = self.contourModels.pop(planeID, None)
+        self.contourPoseKeys.pop(planeID, None)
+        if modelNode and slicer.mrmlScene.IsNodePresent(modelNode):
+            slicer.mrmlScene.RemoveNode(modelNode)
+
+    def onComputeResectionVolume(self):
+        labelmapNode = self.resectionLabelmapSelector.currentNode()
+        planeNodes = self.resectionPlanesSelector.checkedNodes()
+        if not labelmapNode or not planeNodes:
+            self.resectionResultLabel.text = "Select a labelmap and at least one plane"
+            return
+        try:
+            result = self.logic.computeResectionVolume(labelmapNode, planeNodes,
+                                                       self.resectionModeSelector.currentText,
+                                                       self.resectionLabelSpinBox.value or None,
+                                                       self.resectionCalculator)
+        except ValueError as e:
+            self.resectionResultLabel.text = str(e)
+            return
+        centroid = result['centroid_ras']
+        self.resectionResultLabel.text = (f"{result['volume_mm3']:.1f} mm\u00b3 ({result['voxel_count']} voxels)\n"
+                                          f"Centroid: {centroid[0]:.2f}, {centroid[1]:.2f}, {centroid[2]:.2f}")
+
+    def onFitPlane(self):
+        sourceNode = self.fitSourceSelector.currentNode()
+        if not sourceNode:
+            self.fitResultLabel.text = "Select a markups or model node"
+            return
+        try:
+            points = self.logic.getNodePoints(sourceNode)
+            matrix, residuals, inliers = self.logic.fitPlaneToPoints(points, self.fitRansacCheckBox.checked,
+                                                                     self.fitThresholdSpinBox.value)
+        except ValueError as e:
+            self.fitResultLabel.text = str(e)
+            return
+
+        planeNode = self.planeSelector.currentNode() if self.fitUpdateSelectedCheckBox.checked else None
+        if planeNode:
+            # Keep the normal pointing the same way as before so the plane does not flip
+            _, current, _ = self.logic.getReferencePlaneArrays([planeNode])
+            if np.dot(current[0][:3, 2], matrix[:3, 2]) < 0:
+                matrix[:3, 1] *= -1
+                matrix[:3, 2] *= -1
+            self.logic.setPlaneNodePose(planeNode, matrix)
+        else:
+            idx = self.getNextPlaneIndex()
+            size = [self.widthSpinBox.value, self.heightSpinBox.value]
+            planeNode = self.logic.createPlaneNodes([f"ReferencePlane_{idx}"], [matrix], [size],
+                                                    [self.getPlaneColor(idx)])[0]
+            self.addPlaneObservers(planeNode)
+            self.planeSelector.setCurrentNode(planeNode)
+        self.writePlanesToFile()
+
+        inlierResiduals = np.abs(residuals[inliers])
+        self.fitResultLabel.text = (f"RMS {np.sqrt(np.mean(inlierResiduals ** 2)):.3f} mm, "
+                                    f"max {inlierResiduals.max():.3f} mm "
+                                    f"({np.count_nonzero(inliers)}/{len(residuals)} points used)")
+        print(f"[ReferencePlanePlanner] Fitted {planeNode.GetName()} to {len(residuals)} points of "
+              f"{sourceNode.GetName()}")
@@ -1,16 +1,55 @@
+import time
 import qt
 import ctk
+import vtk
 import slicer
-from .SurgeryPlannerLogic import SurgeryPlannerLogic
+import numpy as np
+from .SurgeryPlannerLogic import SurgeryPlannerLogic, SegmentStatistics, SegmentSurfaceCache, bulkOperation
 
 class SegmentationPlannerWidget(qt.QWidget):
     def __init__(self, parent=None, logic=None, module_dir=None):
         super(SegmentationPlannerWidget, self).__init__(parent)
         self.logic = logic if logic else SurgeryPlannerLogic()
+        self.ownsLogic = logic is None  # a logic created here is released by cleanup
         self.module_dir = module_dir
+
+        # Called with a RAS position by "Use Centroid as Target" (set by the module widget)
+        self.targetCallback = None
+
+        # Running statistics of the segments of the tracked segmentation
+        self.statsSegmentationNode = None
+        self.statsObserverTags = []
+        self.segmentStats = {}  # segment ID -> SegmentStatistics
+        self.pendingEdits = {}  # segment ID -> changed IJK extent (None if unknown)
+        self.labelmapMTimes = {}  # segment ID -> internal labelmap MTime at the last update
+        self.unattributedEdit = False  # source representation modified without a segment ID since the last update
+        self.statsUpdateScheduled = False
+
+        # Multi-resolution surfaces: the coarse level is shown while a 3D view is being rotated
+        self.surfaceCache = SegmentSurfaceCache()
+        self.surfaceSegmentationNode = None
+        self.surfaceObserverTags = []
+        self.surfaceModels = {}  # segment ID -> model node
+        self.surfaceLevels = {}  # segment ID -> surfaces (coarse to fine)
+        self.interactorObservers = []  # (interactor, tag)
+        self.viewInteracting = False
+        self.surfaceRefreshTimer = qt.QTimer()
+        self.surfaceRefreshTimer.setSingleShot(True)
+        self.surfaceRefreshTimer.setInterval(500)
+        self.surfaceRefreshTimer.connect('timeout()', self.updateSurfaceModels)
         
         self.setup_ui()
         
+    def cleanup(self):
+        # Remove the cached surface models and their segmentation / 3D view observers (restores the segmentation's
+        # 3D visibility)
+        self.removeSurfaceModels()
+        self.removeStatsObservers()
+        self.statsSegmentationNode = None
+        # Release the logic of a standalone planner (the module's logic is released by SurgeryPlannerWidget)
+        if self.ownsLogic:
+            self.logic.cleanup()
+
     def setup_ui(self):
         self.main_layout = qt.QVBoxLayout(self)
         
@@ -27,6 +66,131 @@ class SegmentationPlannerWidget(qt.QWidget):
         self.removeSegmentationButton = qt.QPushButton("Remove Segmentation")
         self.removeSegmentationButton.connect('clicked(bool)', self.onRemoveSegmentation)
         segActionsFormLayout.addRow(self.removeSegmentationButton)
+
+        # Quick Segment (threshold + connected component)
+        quickSegCollapsibleButton = ctk.ctkCollapsibleButton()
+        quickSegCollapsibleButton.text = "Quick Segment"
+        self.main_layout.addWidget(quickSegCollapsibleButton)
+        quickSegFormLayout = qt.QFormLayout(quickSegCollapsibleButton)
+
+        self.quickVolumeSelector = slicer.qMRMLNodeComboBox()
+        self.quickVolumeSelector.nodeTypes = ["vtkMRMLScalarVolumeNode"]
+        self.quickVolumeSelector.addEnabled = False
+        self.quickVolumeSelector.removeEnabled = False
+        self.quickVolumeSelector.noneEnabled = True
+        self.quickVolumeSelector.setMRMLScene(slicer.mrmlScene)
+        self.quickVolumeSelector.setToolTip("Volume to threshold")
+        self.quickVolumeSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onQuickVolumeChanged)
+        quickSegFormLayout.addRow("Volume:", self.quickVolumeSelector)
+
+        self.quickThresholdRange = ctk.ctkRangeWidget()
+        self.quickThresholdRange.singleStep = 1.0
+        self.quickThresholdRange.minimum = -1024.0
+        self.quickThresholdRange.maximum = 3071.0
+        self.quickThresholdRange.minimumValue = 200.0
+        self.quickThresholdRange.maximumValue = 3071.0
+        self.quickThresholdRange.setToolTip("Voxel values kept by the threshold")
+        quickSegFormLayout.addRow("Threshold:", self.quickThresholdRange)
+
+        self.quickROISelector = slicer.qMRMLNodeComboBox()
+        self.quickROISelector.nodeTypes = ["vtkMRMLMarkupsROINode"]
+        self.quickROISelector.addEnabled = False
+        self.quickROISelector.removeEnabled = False
+        self.quickROISelector.noneEnabled = True
+        self.quickROISelector.setMRMLScene(slicer.mrmlScene)
+        self.quickROISelector.setToolTip("Optional ROI the volume is cropped to")
+        quickSegFormLayout.addRow("ROI:", self.quickROISelector)
+
+        self.quickSeedSelector = slicer.qMRMLNodeComboBox()
+        self.quickSeedSelector.nodeTypes = ["vtkMRMLMarkupsFiducialNode"]
+        self.quickSeedSelector.addEnabled = False
+        self.quickSeedSelector.removeEnabled = False
+        self.quickSeedSelector.noneEnabled = True
+        self.quickSeedSelector.setMRMLScene(slicer.mrmlScene)
+        self.quickSeedSelector.setToolTip("Optional seed (first point) selecting the component; "
+                                          "otherwise the largest component is kept")
+        quickSegFormLayout.addRow("Seed:", self.quickSeedSelector)
+
+        self.quickSegmentationSelector = slicer.qMRMLNodeComboBox()
+        self.quickSegmentationSelector.nodeTypes = ["vtkMRMLSegmentationNode"]
+        self.quickSegmentationSelector.addEnabled = False
+        self.quickSegmentationSelector.removeEnabled = False
+        self.quickSegmentationSelector.noneEnabled = True
+        self.quickSegmentationSelector.noneDisplay = "(Create new)"
+        self.quickSegmentationSelector.setMRMLScene(slicer.mrmlScene)
+        quickSegFormLayout.addRow("Segmentation:", self.quickSegmentationSelector)
+
+        self.quickSegmentNameBox = qt.QLineEdit()
+        self.quickSegmentNameBox.text = "Bone"
+        quickSegFormLayout.addRow("Segment Name:", self.quickSegmentNameBox)
+
+        self.quickSegmentButton = qt.QPushButton("Quick Segment")
+        self.quickSegmentButton.connect('clicked(bool)', self.onQuickSegment)
+        quickSegFormLayout.addRow(self.quickSegmentButton)
+
+        self.quickSegmentResultLabel = qt.QLabel("")
+        self.quickSegmentResultLabel.setWordWrap(True)
+        quickSegFormLayout.addRow(self.quickSegmentResultLabel)
+
+        # Segment Statistics
+        statsCollapsibleButton = ctk.ctkCollapsibleButton()
+        statsCollapsibleButton.text = "Segment Statistics"
+        self.main_layout.addWidget(statsCollapsibleButton)
+        statsFormLayout = qt.QFormLayout(statsCollapsibleButton)
+
+        self.statsSegmentationSelector = slicer.qMRMLNodeComboBox()
+        self.statsSegmentationSelector.nodeTypes = ["vtkMRMLSegmentationNode"]
+        self.statsSegmentationSelector.addEnabled = False
+        self.statsSegmentationSelector.removeEnabled = False
+        self.statsSegmentationSelector.noneEnabled = True
+        self.statsSegmentationSelector.setMRMLScene(slicer.mrmlScene)
+        self.statsSegmentationSelector.setToolTip("Segmentation whose segments are tracked while being edited")
+        self.statsSegmentationSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onStatsSegmentationChanged)
+        statsFormLayout.addRow("Segmentation:", self.statsSegmentationSelector)
+
+        self.statsTable = qt.QTableWidget()
+        self.statsTable.setColumnCount(6)
+        self.statsTable.setHorizontalHeaderLabels(["Segment", "Voxels", "Volume (mm\u00b3)", "Centroid (RAS)",
+                                                   "Bounds (IJK)", ""])
+        self.statsTable.setColumnHidden(5, True)  # segment ID
+        self.statsTable.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+        self.statsTable.setSelectionMode(qt.QAbstractItemView.SingleSelection)
+        self.statsTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+        self.statsTable.setMinimumHeight(150)
+        statsFormLayout.addRow(self.statsTable)
+
+        self.centroidAsTargetButton = qt.QPushButton("Use Centroid as Target")
+        self.centroidAsTargetButton.toolTip = "Move the target of the selected trajectory to the selected segment's centroid"
+        self.centroidAsTargetButton.connect('clicked(bool)', self.onCentroidAsTarget)
+        statsFormLayout.addRow(self.centroidAsTargetButton)
+
+        # Surface Preview
+        surfaceCollapsibleButton = ctk.ctkCollapsibleButton()
+        surfaceCollapsibleButton.text = "Surface Preview"
+        surfaceCollapsibleButton.collapsed = True
+        self.main_layout.addWidget(surfaceCollapsibleButton)
+        surfaceFormLayout = qt.QFormLayout(surfaceCollapsibleButton)
+
+        self.surfaceSegmentationSelector = slicer.qMRMLNodeComboBox()
+        self.surfaceSegmentationSelector.nodeTypes = ["vtkMRMLSegmentationNode"]
+        self.surfaceSegmentationSelector.addEnabled = False
+        self.surfaceSegmentationSelector.removeEnabled = False
+        self.surfaceSegmentationSelector.noneEnabled = True
+        self.surfaceSegmentationSelector.setMRMLScene(slicer.mrmlScene)
+        self.surfaceSegmentationSelector.setToolTip("Segmentation shown with cached multi-resolution surfaces")
+        surfaceFormLayout.addRow("Segmentation:", self.surfaceSegmentationSelector)
+
+        self.showSurfacesCheckBox = qt.QCheckBox()
+        self.showSurfacesCheckBox.checked = False
+        self.showSurfacesCheckBox.setToolTip("Show cached surfaces instead of the segmentation 3D display; "
+                                             "a decimated surface is used while rotating the 3D view")
+        self.showSurfacesCheckBox.connect('toggled(bool)', self.onShowSurfacesToggled)
+        surfaceFormLayout.addRow("Show Cached Surfaces:", self.showSurfacesCheckBox)
+
+        self.clearSurfaceCacheButton = qt.QPushButton("Clear Surface Cache")
+        self.clearSurfaceCacheButton.toolTip = "Forget the surfaces kept in memory (files on disk are kept)"
+        self.clearSurfaceCacheButton.connect('clicked(bool)', self.onClearSurfaceCache)
+        surfaceFormLayout.addRow(self.clearSurfaceCacheButton)
         
         self.main_layout.addStretch(1)
 
@@ -50,3 +214,263 @@ class SegmentationPlannerWidget(qt.QWidget):
             print(f"Removed segmentation node: {node_to_remove.GetName()}")
         else:
             print("No segmentation nodes to remove")
+
+    def onQuickVolumeChanged(self, volumeNode):
+        if volumeNode and volumeNode.GetImageData():
+            low, high = volumeNode.GetImageData().GetScalarRange()
+            self.quickThresholdRange.minimum = low
+            self.quickThresholdRange.maximum = high
+
+    def onQuickSegment(self):
+        volumeNode = self.quickVolumeSelector.currentNode()
+        if not volumeNode:
+            self.quickSegmentResultLabel.text = "Select a volume"
+            return
+        seedRAS = None
+        seedNode = self.quickSeedSelector.currentNode()
+        if seedNode and seedNode.GetNumberOfControlPoints() > 0:
+            seedRAS = [0.0, 0.0, 0.0]
+            seedNode.GetNthControlPointPositionWorld(0, seedRAS)
+
+        start = time.perf_counter()
+        try:
+            segmentationNode, segmentID, component, extent = self.logic.quickSegment(
+                volumeNode, self.quickThresholdRange.minimumValue, self.quickThresholdRange.maximumValue,
+                self.quickROISelector.currentNode(), seedRAS, self.quickSegmentationSelector.currentNode(),
+                self.quickSegmentNameBox.text or "QuickSegment")
+        except ValueError as e:
+            self.quickSegmentResultLabel.text = str(e)
+            return
+        elapsed = time.perf_counter() - start
+        self.quickSegmentationSelector.setCurrentNode(segmentationNode)
+        self.notifySegmentEdited(segmentationNode, segmentID, extent)
+        self.quickSegmentResultLabel.text = f"{np.count_nonzero(component)} voxels in {elapsed:.2f} s"
+        print(f"[SegmentationPlanner] Quick segment {segmentID} created in {elapsed:.2f} s")
+
+    def removeStatsObservers(self):
+        if self.statsSegmentationNode:
+            segmentation = self.statsSegmentationNode.GetSegmentation()
+            for tag in self.statsObserverTags:
+                segmentation.RemoveObserver(tag)
+        self.statsObserverTags = []
+
+    def onStatsSegmentationChanged(self, segmentationNode):
+        self.removeStatsObservers()
+        self.segmentStats = {}
+        self.pendingEdits = {}
+        self.labelmapMTimes = {}
+        self.unattributedEdit = False
+        self.statsSegmentationNode = segmentationNode
+        if segmentationNode:
+            segmentation = segmentationNode.GetSegmentation()
+            modifiedEvent = getattr(slicer.vtkSegmentation, 'SourceRepresentationModified', None)
+            if modifiedEvent is None:  # Slicer < 5.4
+                modifiedEvent = slicer.vtkSegmentation.MasterRepresentationModified
+            self.statsObserverTags.append(segmentation.AddObserver(modifiedEvent, self.onSegmentationEdited))
+            for event in [slicer.vtkSegmentation.SegmentModified, slicer.vtkSegmentation.SegmentAdded,
+                          slicer.vtkSegmentation.SegmentRemoved]:
+                self.statsObserverTags.append(segmentation.AddObserver(event, self.onSegmentEdited))
+            for i in range(segmentation.GetNumberOfSegments()):
+                self.pendingEdits[segmentation.GetNthSegmentID(i)] = None
+        self.scheduleStatsUpdate()
+
+    def notifySegmentEdited(self, segmentationNode, segmentID, extent):
+        """Report an edit whose changed IJK extent (i0, i1, j0, j1, k0, k1) is known, so only it is rescanned."""
+        if segmentationNode is not self.statsSegmentationNode:
+            return
+        self.pendingEdits[segmentID] = extent
+        self.scheduleStatsUpdate()
+
+    @vtk.calldata_type(vtk.VTK_STRING)
+    def onSegmentEdited(self, caller, event, segmentID):
+        # Segment events carry the segment ID: only that segment is updated
+        if segmentID:
+            self.pendingEdits.setdefault(segmentID, None)
+            self.scheduleStatsUpdate()
+
+    def onSegmentationEdited(self, caller, event):
+        # The source representation event does not say which segment changed; it is only used when no segment
+        # event arrives for the same edit (see updateSegmentStatistics)
+        self.unattributedEdit = True
+        self.scheduleStatsUpdate()
+
+    def scheduleStatsUpdate(self):
+        # Coalesce all edit events of one stroke into a single update
+        if not self.statsUpdateScheduled:
+            self.statsUpdateScheduled = True
+            qt.QTimer.singleShot(0, self.updateSegmentStatistics)
+
+    def updateSegmentStatistics(self):
+        self.statsUpdateScheduled = False
+        segmentationNode = self.statsSegmentationNode
+        if not segmentationNode:
+            self.statsTable.setRowCount(0)
+            return
+        segmentation = segmentationNode.GetSegmentation()
+        pending, self.pendingEdits = self.pendingEdits, {}
+        if self.unattributedEdit and not pending:
+            # Edit without a segment ID or extent: check every segment whose labelmap changed. Segments sharing a
+            # labelmap layer all look changed and are rescanned over the labelmap extent; edits made through
+            # notifySegmentEdited (or reported by segment events) avoid this full rescan
+            segmentIDs = [segmentation.GetNthSegmentID(i) for i in range(segmentation.GetNumberOfSegments())]
+            pending = {segmentID: None for segmentID in segmentIDs + list(self.segmentStats)}
+        self.unattributedEdit = False
+        for segmentID, extent in pending.items():
+            if segmentation.GetSegment(segmentID) is None:
+                self.segmentStats.pop(segmentID, None)
+                self.labelmapMTimes.pop(segmentID, None)
+                continue
+            labelmap = segmentationNode.GetBinaryLabelmapInternalRepresentation(segmentID)
+            if labelmap is None:
+                continue
+            stats = self.segmentStats.setdefault(segmentID, SegmentStatistics())
+            if extent is None:
+                if self.labelmapMTimes.get(segmentID) == labelmap.GetMTime():
+                    continue
+                # Unknown edit extent: labelmap extent plus the extent covered by the segment so far
+                extent = np.array(labelmap.GetExtent())
+                if stats.snapshot.size:
+                    snapshotMax = stats.snapshotMin + np.array(stats.snapshot.shape[::-1]) - 1
+                    extent[0::2] = np.minimum(extent[0::2], stats.snapshotMin)
+                    extent[1::2] = np.maximum(extent[1::2], snapshotMax)
+            mask, extent, ijkToRAS = self.logic.getSegmentMask(segmentationNode, segmentID, extent)
+            if mask is not None and mask.size:
+                stats.update(mask, extent[0::2], ijkToRAS)
+            self.labelmapMTimes[segmentID] = labelmap.GetMTime()
+        self.updateStatsTable()
+
+    def updateStatsTable(self):
+        segmentation = self.statsSegmentationNode.GetSegmentation()
+        self.statsTable.setRowCount(len(self.segmentStats))
+        for row, (segmentID, stats) in enumerate(self.segmentStats.items()):
+            segment = segmentation.GetSegment(segmentID)
+            centroid = stats.centroidRAS
+            bounds = stats.boundsIJK
+            values = [segment.GetName() if segment else segmentID,
+                      str(stats.voxelCount),
+                      f"{stats.volumeMM3:.1f}",
+                      f"{centroid[0]:.2f}, {centroid[1]:.2f}, {centroid[2]:.2f}",
+                      ", ".join(str(b) for b in bounds) if bounds else "",
+                      segmentID]
+            for column, value in enumerate(values):
+                self.statsTable.setItem(row, column, qt.QTableWidgetItem(value))
+
+    def onCentroidAsTarget(self):
+        row = self.statsTable.currentRow()
+        if row < 0:
+            print("[SegmentationPlanner] Select a segment in the statistics table")
+            return
+        stats = self.segmentStats.get(self.statsTable.item(row, 5).text())
+        if stats is None or stats.voxelCount == 0:
+            return
+        centroid = stats.centroidRAS
+        if self.targetCallback:
+            self.targetCallback(centroid)
+        else:
+            # Without a trajectory planner, center the views on the centroid instead
+            slicer.modules.markups.logic().JumpSlicesToLocation(centroid[0], centroid[1], centroid[2], True)
+
+    def onShowSurfacesToggled(self, checked):
+        self.removeSurfaceModels()
+        if not checked:
+            return
+        segmentationNode = self.surfaceSegmentationSelector.currentNode()
+        if not segmentationNode:
+            print("[SegmentationPlanner] Select a segmentation to show its surfaces")
+            self.showSurfacesCheckBox.checked = False
+            return
+        self.surfaceSegmentationNode = segmentationNode
+        segmentation = segmentationNode.GetSegmentation()
+        modifiedEvent = getattr(slicer.vtkSegmentation, 'SourceRepresentationModified', None)
+        if modifiedEvent is None:  # Slicer < 5.4
+            modifiedEvent = slicer.vtkSegmentation.MasterRepresentationModified
+        for event in [modifiedEvent, slicer.vtkSegmentation.SegmentAdded, slicer.vtkSegmentation.SegmentRemoved]:
+            self.surfaceObserverTags.append(segmentation.AddObserver(event, self.onSurfaceSegmentationEdited))
+
+        layoutManager = slicer.app.layoutManager()
+        for i in range(layoutManager.threeDViewCount):
+            interactor = layoutManager.threeDWidget(i).threeDView().interactor()
+            for event, callback in [(vtk.vtkCommand.StartInteractionEvent, self.onViewInteractionStarted),
+                                    (vtk.vtkCommand.EndInteractionEvent, self.onViewInteractionEnded)]:
+                self.interactorObservers.append((interactor, interactor.AddObserver(event, callback)))
+
+        if segmentationNode.GetDisplayNode():
+            segmentationNode.GetDisplayNode().SetVisibility3D(False)
+        self.updateSurfaceModels()
+
+    def onSurfaceSegmentationEdited(self, caller, event):
+        # Regenerate once editing pauses rather than on every stroke
+        self.surfaceRefreshTimer.start()
+
+    @bulkOperation()
+    def updateSurfaceModels(self):
+        segmentationNode = self.surfaceSegmentationNode
+        if not segmentationNode:
+            return
+        segmentation = segmentationNode.GetSegmentation()
+        segmentIDs = [segmentation.GetNthSegmentID(i) for i in range(segmentation.GetNumberOfSegments())]
+        for segmentID in list(self.surfaceModels):
+            if segmentID not in segmentIDs:
+                slicer.mrmlScene.RemoveNode(self.surfaceModels.pop(segmentID))
+                self.surfaceLevels.pop(segmentID, None)
+                self.surfaceCache.remove((segmentationNode.GetID(), segmentID))
+
+        start = time.perf_counter()
+        for segmentID in segmentIDs:
+            levels = self.logic.getSegmentSurfaceLevels(self.surfaceCache, segmentationNode, segmentID)
+            if not levels:
+                continue
+            segment = segmentation.GetSegment(segmentID)
+            modelNode = self.surfaceModels.get(segmentID)
+            if modelNode is None:
+                modelNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", f"{segment.GetName()}_surface")
+                modelNode.SetHideFromEditors(True)
+                modelNode.CreateDefaultDisplayNodes()
+                modelNode.GetDisplayNode().SetVisibility2D(False)
+                self.surfaceModels[segmentID] = modelNode
+            modelNode.GetDisplayNode().SetColor(segment.GetColor())
+            self.surfaceLevels[segmentID] = levels
+            self.setSurfaceLevel(segmentID)
+        print(f"[SegmentationPlanner] Surfaces updated in {time.perf_counter() - start:.2f} s")
+
+    def setSurfaceLevel(self, segmentID):
+        levels = self.surfaceLevels[segmentID]
+        surface = levels[0] if self.viewInteracting else levels[-1]
+        modelNode = self.surfaceModels[segmentID]
+        if modelNode.GetPolyData() is not surface:
+            modelNode.SetAndObservePolyData(surface)
+
+    def onViewInteractionStarted(self, caller, event):
+        self.viewInteracting = True
+        for segmentID in self.surfaceModels:
+            self.setSurfaceLevel(segmentID)
+
+    def onViewInteractionEnded(self, caller, event):
+        self.viewInteracting = False
+        for segmentID in self.surfaceModels:
+            self.setSurfaceLevel(segmentID)
+
+    @bulkOperation()
+    def removeSurfaceModels(self):
+        self.surfaceRefreshTimer.stop()
+        if self.surfaceSegmentationNode:
+            segmentation = self.surfaceSegmentationNode.GetSegmentation()
+            for tag in self.surfaceObserverTags:
+                segmentation.RemoveObserver(tag)
+            if self.surfaceSegmentationNode.GetDisplayNode():
+                self.surfaceSegmentationNode.GetDisplayNode().SetVisibility3D(True)
+        for interactor, tag in self.interactorObservers:
+            interactor.RemoveObserver(tag)
+        for modelNode in self.surfaceModels.values():
+            slicer.mrmlScene.RemoveNode(modelNode)
+        self.surfaceObserverTags = []
+        self.interactorObservers = []
+        self.surfaceModels = {}
+        self.surfaceLevels = {}
+        self.surfaceSegmentationNode = None
+        self.viewInteracting = False
+
+    def onClearSurfaceCache(self):
+        self.surfaceCache.clear()
+        if self.surfaceSegmentationNode:
+            self.updateSurfaceModels()
@@ -1,7 +1,93 @@
+import os
+import sys
+import time
+import hashlib
+import functools
 import slicer
 import vtk
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import numpy as np
+from vtk.util import numpy_support
 from slicer.ScriptedLoadableModule import ScriptedLoadableModuleLogic
+from . import surgery_planner_geometry as sg
+from . import surgery_planner_io as sio
+from . import surgery_planner_store as sps
+
+# scipy is optional and slow to import: it is loaded on first use (see getNdimage)
+_ndimage = None
+
+
+def getNdimage():
+    """Return scipy.ndimage, or None when scipy is not installed."""
+    global _ndimage
+    if _ndimage is None:
+        try:
+            from scipy import ndimage
+        except ImportError:
+            ndimage = False
+        _ndimage = ndimage
+    return _ndimage or None
+
+# Local caches (surfaces, volumes, ...) are kept under this folder
+CACHE_DIR = os.path.expanduser('~/.slicer_surgery_planner')
+
+# Nesting depth of bulkOperation blocks and the autosave writes / refreshes deferred until the outermost block exits
+_bulkOperationDepth = 0
+_deferredWrites = OrderedDict()
+
+
+def isBulkOperationActive():
+    return _bulkOperationDepth > 0
+
+
+@contextmanager
+def bulkOperation():
+    """Context manager (or decorator, as @bulkOperation()) for operations that change many nodes at once.
+    Rendering is paused in all views and the scene is in batch-processing state for the duration of the block;
+    planner autosaves (methods decorated with deferDuringBulkOperation) are held back. When the outermost block
+    exits, each deferred write runs once and the views render once."""
+    global _bulkOperationDepth
+    _bulkOperationDepth += 1
+    slicer.app.pauseRender()
+    slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+    try:
+        yield
+    finally:
+        slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+        _bulkOperationDepth -= 1
+        try:
+            if _bulkOperationDepth == 0:
+                while _deferredWrites:
+                    _, write = _deferredWrites.popitem(last=False)
+                    try:
+                        write()
+                    except Exception as e:
+                        print(f"[SurgeryPlannerLogic] Deferred write failed: {e}")
+        finally:
+            slicer.app.resumeRender()
+
+
+def deferDuringBulkOperation(method):
+    """Decorator for autosave (or view refresh) methods: argument-less calls made inside a bulkOperation block are
+    merged into a single call when the block exits. Calls with arguments (e.g. an explicit output file) run
+    immediately."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if _bulkOperationDepth > 0 and not args and not kwargs:
+            _deferredWrites[(id(self), method.__name__)] = functools.partial(method, self)
+            return None
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+def getWorkerExecutable():
+    """Python interpreter for process pool workers (they must not start a new Slicer application): the PythonSlicer
+    executable bundled with Slicer, or None if it is not found (the default interpreter is then used)."""
+    executable = os.path.join(os.path.dirname(sys.executable), 'PythonSlicer' + ('.exe' if os.name == 'nt' else ''))
+    return executable if os.path.exists(executable) else None
+
 
 def setSlicePoseFromSliceNormalAndPosition(sliceNode, sliceNormal, slicePosition, defaultViewUpDirection=None,
                                            backupViewRightDirection=None):
@@ -43,7 +129,439 @@ def setSlicePoseFromSliceNormalAndPosition(sliceNode, sliceNormal, slicePosition
                                  slicePosition[0], slicePosition[1], slicePosition[2], 0)
 
 
+class PlaneContourCache:
+    """Cut contours of segment surfaces by reference planes.
+    A cell locator is built once per surface (rebuilt only when the surface changes) and only the cells inside
+    the plane's width x height bounds are cut. Contours are cached by a quantized plane pose so that repeated
+    events for the same pose (e.g. during a drag) do not recompute anything."""
+
+    def __init__(self, positionResolution=0.25, directionResolution=1e-3, maxEntries=256):
+        self.positionResolution = positionResolution  # mm
+        self.directionResolution = directionResolution  # unit vector components
+        self.maxEntries = maxEntries
+        self.locators = {}  # surfaceKey -> (polyData, mtime, locator)
+        self.contours = OrderedDict()  # (surfaceKey, poseKey) -> vtkPolyData
+
+    def poseKey(self, matrix, size):
+        """Quantized plane pose; planes that differ by less than the resolutions share a key."""
+        matrix = np.asarray(matrix, dtype=float)
+        quantized = np.concatenate([
+            np.round(matrix[:3, :3].ravel() / self.directionResolution),
+            np.round(matrix[:3, 3] / self.positionResolution),
+            np.round(np.asarray(size[:2], dtype=float) / self.positionResolution)])
+        return quantized.astype(np.int64).tobytes()
+
+    def getLocator(self, surfaceKey, polyData):
+        entry = self.locators.get(surfaceKey)
+        if entry and entry[0] is polyData and entry[1] == polyData.GetMTime():
+            return entry[2]
+        locator = vtk.vtkStaticCellLocator()
+        locator.SetDataSet(polyData)
+        locator.BuildLocator()
+        self.locators[surfaceKey] = (polyData, polyData.GetMTime(), locator)
+        # Contours cut from the previous surface are stale
+        for key in [k for k in self.contours if k[0] == surfaceKey]:
+            del self.contours[key]
+        return locator
+
+    def getContour(self, surfaceKey, polyData, matrix, size):
+        """Return the contour (vtkPolyData lines) of polyData cut by the plane rectangle."""
+        locator = self.getLocator(surfaceKey, polyData)
+        cacheKey = (surfaceKey, self.poseKey(matrix, size))
+        contour = self.contours.get(cacheKey)
+        if contour is not None:
+            self.contours.move_to_end(cacheKey)
+            return contour
+
+        matrix = np.asarray(matrix, dtype=float)
+        center, axes = sg.plane_frames(matrix)
+        center, axes = center[0], axes[0]
+        halfSize = np.asarray(size[:2], dtype=float) / 2.0
+
+        # Only cells overlapping the bounding box of the plane rectangle are cut
+        corners = center + np.array([[sx * halfSize[0], sy * halfSize[1]] for sx in (-1, 1) for sy in (-1, 1)]) \
+            @ axes[:, :2].T
+        pad = self.positionResolution
+        bounds = np.column_stack([corners.min(axis=0) - pad, corners.max(axis=0) + pad]).ravel()
+        cellIds = vtk.vtkIdList()
+        locator.FindCellsWithinBounds(bounds, cellIds)
+
+        contour = vtk.vtkPolyData()
+        if cellIds.GetNumberOfIds() > 0:
+            extract = vtk.vtkExtractCells()
+            extract.SetInputData(polyData)
+            extract.SetCellList(cellIds)
+
+            cutPlane = vtk.vtkPlane()
+            cutPlane.SetOrigin(center)
+            cutPlane.SetNormal(axes[:, 2])
+            cutter = vtk.vtkCutter()
+            cutter.SetInputConnection(extract.GetOutputPort())
+            cutter.SetCutFunction(cutPlane)
+
+            # Trim the contour to the width x height rectangle (outward side planes, keep the inside)
+            sideNormals = np.array([axes[:, 0], -axes[:, 0], axes[:, 1], -axes[:, 1]])
+            sideOffsets = np.array([halfSize[0], halfSize[0], halfSize[1], halfSize[1]])
+            sidePoints = vtk.vtkPoints()
+            sideNormalArray = vtk.vtkDoubleArray()
+            sideNormalArray.SetNumberOfComponents(3)
+            for normal, offset in zip(sideNormals, sideOffsets):
+                sidePoints.InsertNextPoint(center + normal * offset)
+                sideNormalArray.InsertNextTuple3(*normal)
+            rectangle = vtk.vtkPlanes()
+            rectangle.SetPoints(sidePoints)
+            rectangle.SetNormals(sideNormalArray)
+            clipper = vtk.vtkClipPolyData()
+            clipper.SetInputConnection(cutter.GetOutputPort())
+            clipper.SetClipFunction(rectangle)
+            clipper.InsideOutOn()
+            clipper.Update()
+            contour.DeepCopy(clipper.GetOutput())
+
+        self.contours[cacheKey] = contour
+        while len(self.contours) > self.maxEntries:
+            self.contours.popitem(last=False)
+        return contour
+
+    def clear(self):
+        self.locators.clear()
+        self.contours.clear()
+
+
+class ResectionVolumeCalculator:
+    """Volume / centroid of labelmap voxels between reference planes.
+    The binary mask of the labelmap is cached until the labelmap changes, so interactive updates while a plane is
+    dragged only evaluate the half-space tests on the crop bounded by the planes."""
+
+    def __init__(self):
+        self.labelmapNode = None
+        self.labelValue = None
+        self.mtime = None
+        self.mask = None
+        self.ijkToRAS = None
+
+    def getMask(self, labelmapNode, labelValue=None):
+        imageData = labelmapNode.GetImageData()
+        if (labelmapNode is not self.labelmapNode or labelValue != self.labelValue
+                or imageData.GetMTime() != self.mtime):
+            voxels = slicer.util.arrayFromVolume(labelmapNode)
+            self.mask = (voxels != 0) if not labelValue else (voxels == labelValue)
+            ijkToRAS = vtk.vtkMatrix4x4()
+            labelmapNode.GetIJKToRASMatrix(ijkToRAS)
+            self.ijkToRAS = slicer.util.arrayFromVTKMatrix(ijkToRAS)
+            self.labelmapNode = labelmapNode
+            self.labelValue = labelValue
+            self.mtime = imageData.GetMTime()
+        return self.mask, self.ijkToRAS
+
+    def compute(self, labelmapNode, planeMatrices, planeSizes, mode='between', labelValue=None):
+        mask, ijkToRAS = self.getMask(labelmapNode, labelValue)
+        return sg.halfspace_region_stats(mask, ijkToRAS, planeMatrices, planeSizes, mode)
+
+
+class SegmentStatistics:
+    """Running voxel count, centroid and bounds of one segment.
+    Per-axis voxel histograms are kept instead of the full mask statistics, so an edit only needs the old and new
+    mask of the changed sub-extent: counts, coordinate sums and exact bounds (also after erasing) all follow from
+    the histograms. A snapshot of the mask over the extent seen so far provides the old values."""
+
+    def __init__(self):
+        self.histograms = [np.zeros(0, dtype=np.int64) for _ in range(3)]  # i, j, k
+        self.histogramOffsets = [0, 0, 0]
+        self.snapshot = np.zeros((0, 0, 0), dtype=bool)  # (K,J,I)
+        self.snapshotMin = np.zeros(3, dtype=int)  # (i, j, k) of snapshot[0, 0, 0]
+        self.ijkToRAS = np.eye(4)
+
+    def _addToHistogram(self, axis, start, values):
+        histogram, offset = self.histograms[axis], self.histogramOffsets[axis]
+        if histogram.size == 0:
+            histogram, offset = np.zeros(len(values), dtype=np.int64), start
+        low = min(offset, start)
+        high = max(offset + len(histogram), start + len(values))
+        if low != offset or high != offset + len(histogram):
+            grown = np.zeros(high - low, dtype=np.int64)
+            grown[offset - low:offset - low + len(histogram)] = histogram
+            histogram, offset = grown, low
+        histogram[start - offset:start - offset + len(values)] += values
+        self.histograms[axis], self.histogramOffsets[axis] = histogram, offset
+
+    def _growSnapshot(self, extentMin, shapeKJI):
+        extentMax = extentMin + np.array(shapeKJI[::-1])
+        if self.snapshot.size == 0:
+            self.snapshot = np.zeros(shapeKJI, dtype=bool)
+            self.snapshotMin = extentMin.copy()
+            return
+        snapshotMax = self.snapshotMin + np.array(self.snapshot.shape[::-1])
+        low = np.minimum(self.snapshotMin, extentMin)
+        high = np.maximum(snapshotMax, extentMax)
+        if np.any(low != self.snapshotMin) or np.any(high != snapshotMax):
+            grown = np.zeros(tuple((high - low)[::-1]), dtype=bool)
+            o = self.snapshotMin - low
+            grown[o[2]:o[2] + self.snapshot.shape[0], o[1]:o[1] + self.snapshot.shape[1],
+                  o[0]:o[0] + self.snapshot.shape[2]] = self.snapshot
+            self.snapshot, self.snapshotMin = grown, low
+
+    def update(self, mask, extentMin, ijkToRAS=None):
+        """Apply an edit: mask is the current (K,J,I) bool mask of the segment over the changed sub-extent whose
+        first voxel is extentMin (i, j, k)."""
+        extentMin = np.asarray(extentMin, dtype=int)
+        if ijkToRAS is not None:
+            self.ijkToRAS = np.asarray(ijkToRAS, dtype=float)
+        self._growSnapshot(extentMin, mask.shape)
+        o = extentMin - self.snapshotMin
+        region = self.snapshot[o[2]:o[2] + mask.shape[0], o[1]:o[1] + mask.shape[1], o[0]:o[0] + mask.shape[2]]
+        delta = mask.astype(np.int8) - region.astype(np.int8)
+        if np.any(delta):
+            self._addToHistogram(0, extentMin[0], delta.sum(axis=(0, 1), dtype=np.int64))
+            self._addToHistogram(1, extentMin[1], delta.sum(axis=(0, 2), dtype=np.int64))
+            self._addToHistogram(2, extentMin[2], delta.sum(axis=(1, 2), dtype=np.int64))
+        region[...] = mask
+
+    @property
+    def voxelCount(self):
+        return int(self.histograms[0].sum())
+
+    @property
+    def volumeMM3(self):
+        return self.voxelCount * abs(np.linalg.det(self.ijkToRAS[:3, :3]))
+
+    @property
+    def centroidIJK(self):
+        count = self.voxelCount
+        if count == 0:
+            return np.full(3, np.nan)
+        return np.array([np.dot(h, np.arange(offset, offset + len(h))) for h, offset
+                         in zip(self.histograms, self.histogramOffsets)]) / count
+
+    @property
+    def centroidRAS(self):
+        return sg.transform_points(self.ijkToRAS, self.centroidIJK)[0]
+
+    @property
+    def boundsIJK(self):
+        """Inclusive (i0, i1, j0, j1, k0, k1), or None if the segment is empty."""
+        if self.voxelCount == 0:
+            return None
+        bounds = []
+        for h, offset in zip(self.histograms, self.histogramOffsets):
+            nonzero = np.flatnonzero(h)
+            bounds += [offset + int(nonzero[0]), offset + int(nonzero[-1])]
+        return tuple(bounds)
+
+
+class SegmentSurfaceCache:
+    """Closed surfaces of segments at several decimation levels.
+    Surfaces are cached in memory per segment (keyed by the labelmap modification time) and on disk as binary VTP
+    files (keyed by a digest of the labelmap content, so they survive restarts). Levels are ordered from coarse
+    to fine; the last level is not decimated. The files of a segment's previous content are dropped when it is
+    edited, and the least recently used files are pruned beyond maxCacheMB."""
+
+    def __init__(self, cacheDir=None, reductions=(0.9, 0.6, 0.0), smoothingIterations=15, maxCacheMB=500):
+        self.cacheDir = cacheDir or os.path.join(CACHE_DIR, 'surface_cache')
+        self.reductions = reductions
+        self.smoothingIterations = smoothingIterations
+        self.maxCacheBytes = maxCacheMB * 1024 * 1024
+        self.surfaces = {}  # surfaceKey -> (mtime, [vtkPolyData per level], digest)
+
+    def get(self, surfaceKey, mtime):
+        """Return the surfaces cached in memory for the labelmap modification time, or None."""
+        cached = self.surfaces.get(surfaceKey)
+        return cached[1] if cached and cached[0] == mtime else None
+
+    def getSurfaces(self, surfaceKey, mtime, mask, extent, ijkToRAS):
+        """Return the list of surfaces (coarse to fine) of a (K,J,I) bool mask covering the IJK extent."""
+        surfaces = self.get(surfaceKey, mtime)
+        if surfaces is not None:
+            return surfaces
+        cached = self.surfaces.get(surfaceKey)
+
+        digest = hashlib.sha1()
+        digest.update(np.packbits(mask).tobytes())
+        digest.update(np.asarray(extent, dtype=np.int64).tobytes())
+        digest.update(np.asarray(ijkToRAS, dtype=float).tobytes())
+        digest.update(repr((self.reductions, self.smoothingIterations)).encode())
+        digest = digest.hexdigest()
+        paths = self.getCachePaths(digest)
+
+        if all(os.path.exists(path) for path in paths):
+            surfaces = []
+            for path in paths:
+                reader = vtk.vtkXMLPolyDataReader()
+                reader.SetFileName(path)
+                reader.Update()
+                surfaces.append(reader.GetOutput())
+                os.utime(path)  # mark as recently used for prune
+        else:
+            surfaces = self.generateSurfaces(mask, extent, ijkToRAS)
+            os.makedirs(self.cacheDir, exist_ok=True)
+            for surface, path in zip(surfaces, paths):
+                writer = vtk.vtkXMLPolyDataWriter()
+                writer.SetFileName(path)
+                writer.SetInputData(surface)
+                writer.SetDataModeToBinary()
+                writer.Write()
+
+        self.surfaces[surfaceKey] = (mtime, surfaces, digest)
+        if cached and cached[2] != digest:
+            self.removeCacheFiles(cached[2])
+        self.prune()
+        return surfaces
+
+    def getCachePaths(self, digest):
+        return [os.path.join(self.cacheDir, f"{digest}_{level}.vtp") for level in range(len(self.reductions))]
+
+    def removeCacheFiles(self, digest):
+        # Keep the files while another segment (e.g. a copy) still shows the same content
+        if any(entry[2] == digest for entry in self.surfaces.values()):
+            return
+        for path in self.getCachePaths(digest):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def prune(self):
+        """Remove the least recently used surface files beyond maxCacheBytes (keeping the ones in use)."""
+        try:
+            entries = [entry for entry in os.scandir(self.cacheDir) if entry.name.endswith('.vtp')]
+        except OSError:
+            return
+        inUse = {entry[2] for entry in self.surfaces.values()}
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        total = 0
+        for entry in entries:
+            total += entry.stat().st_size
+            if total > self.maxCacheBytes and entry.name.rsplit('_', 1)[0] not in inUse:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def generateSurfaces(self, mask, extent, ijkToRAS):
+        # Pad by one voxel so that segments touching the extent border still give closed surfaces
+        mask = np.pad(mask, 1)
+        image = vtk.vtkImageData()
+        image.SetExtent(extent[0] - 1, extent[1] + 1, extent[2] - 1, extent[3] + 1, extent[4] - 1, extent[5] + 1)
+        image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(mask.ravel().astype(np.uint8), deep=1))
+
+        contour = vtk.vtkDiscreteFlyingEdges3D() if hasattr(vtk, 'vtkDiscreteFlyingEdges3D') \
+            else vtk.vtkDiscreteMarchingCubes()
+        contour.SetInputData(image)
+        contour.SetValue(0, 1)
+
+        smoother = vtk.vtkWindowedSincPolyDataFilter()
+        smoother.SetInputConnection(contour.GetOutputPort())
+        smoother.SetNumberOfIterations(self.smoothingIterations)
+        smoother.SetPassBand(0.1)
+        smoother.NormalizeCoordinatesOn()
+
+        toRAS = vtk.vtkTransform()
+        toRAS.SetMatrix(slicer.util.vtkMatrixFromArray(np.asarray(ijkToRAS, dtype=float)))
+        transformer = vtk.vtkTransformPolyDataFilter()
+        transformer.SetInputConnection(smoother.GetOutputPort())
+        transformer.SetTransform(toRAS)
+        transformer.Update()
+        full = transformer.GetOutput()
+
+        surfaces = []
+        for reduction in self.reductions:
+            source = full
+            if reduction > 0:
+                decimator = vtk.vtkQuadricDecimation()
+                decimator.SetInputData(full)
+                decimator.SetTargetReduction(reduction)
+                decimator.Update()
+                source = decimator.GetOutput()
+            normals = vtk.vtkPolyDataNormals()
+            normals.SetInputData(source)
+            normals.ConsistencyOn()
+            normals.AutoOrientNormalsOn()
+            normals.SplittingOff()
+            normals.Update()
+            surface = vtk.vtkPolyData()
+            surface.DeepCopy(normals.GetOutput())
+            surfaces.append(surface)
+        return surfaces
+
+    def remove(self, surfaceKey):
+        self.surfaces.pop(surfaceKey, None)
+
+    def clear(self):
+        """Drop the surfaces cached in memory (they are reloaded from the disk cache or regenerated)."""
+        self.surfaces.clear()
+
+
 # noinspection PyMethodMayBeStatic
+class SessionSnapshots:
+    """Crash-recovery snapshots of a planning session.
+    Each session writes <sessionDir>/session_<timestamp>.snap (see surgery_planner_io.pack_snapshot) atomically on
+    a background thread, skipping writes when the plan did not change. The snapshot written on a clean exit is
+    flagged, so the snapshots left by a crash are the ones offered for restore.
+    """
+
+    def __init__(self, sessionTimestamp, sessionDir=None, keep=5):
+        self.sessionTimestamp = sessionTimestamp
+        self.sessionDir = sessionDir or os.path.join(CACHE_DIR, 'sessions')
+        self.filename = os.path.join(self.sessionDir, f"session_{sessionTimestamp}.snap")
+        self.keep = keep
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.lastDigest = None
+
+    def save(self, metadata, arrays, cleanExit=False, wait=False):
+        """Pack the session state and write it in the background. Returns False if nothing changed."""
+        metadata = dict(metadata, session_timestamp=self.sessionTimestamp, clean_exit=cleanExit)
+        blob = sio.pack_snapshot(metadata, arrays)
+        digest = hashlib.sha1(blob).digest()
+        if digest == self.lastDigest:
+            return False
+        self.lastDigest = digest
+        os.makedirs(self.sessionDir, exist_ok=True)
+        future = self.writer.submit(self._write, blob)
+        if wait:
+            future.result()
+        return True
+
+    def _write(self, blob):
+        try:
+            sio.write_file_atomic(self.filename, blob)
+            self.prune()
+        except Exception as e:
+            print(f"[SurgeryPlanner] Failed to write session snapshot: {e}")
+
+    def listSnapshots(self):
+        """Snapshot files of all sessions, newest first."""
+        if not os.path.isdir(self.sessionDir):
+            return []
+        names = [n for n in os.listdir(self.sessionDir) if n.startswith('session_') and n.endswith('.snap')]
+        return sorted((os.path.join(self.sessionDir, n) for n in names), key=os.path.getmtime, reverse=True)
+
+    def findRecoverable(self):
+        """Return (filename, metadata) of the previous session's snapshot if it did not exit cleanly, or None."""
+        for filename in self.listSnapshots():
+            if filename == self.filename:
+                continue
+            try:
+                metadata = sio.read_snapshot(filename, metadata_only=True)
+            except Exception as e:
+                print(f"[SurgeryPlanner] Skipping unreadable session snapshot {filename}: {e}")
+                continue
+            return None if metadata.get('clean_exit') else (filename, metadata)
+        return None
+
+    def load(self, filename):
+        return sio.read_snapshot(filename)
+
+    def close(self):
+        """Wait for pending writes and stop the writer thread."""
+        self.writer.shutdown(wait=True)
+
+    def prune(self):
+        """Keep only the newest snapshots (always keeping this session's)."""
+        for filename in self.listSnapshots()[self.keep:]:
+            if filename != self.filename:
+                os.remove(filename)
+
+
 class SurgeryPlannerLogic(ScriptedLoadableModuleLogic):
     """This class should implement all the actual
   computation done by your module.  The interface
@@ -54,6 +572,55 @@ class SurgeryPlannerLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+    SLICE_VIEW_NAMES = ('Red', 'Yellow', 'Green')
+
+    def __init__(self):
+        ScriptedLoadableModuleLogic.__init__(self)
+        # Handles of the standard slice nodes and the crosshair, looked up once and dropped when the scene is closed
+        self.sliceNodes = None
+        self.crosshairNode = None
+        self.planStore = None
+        self.sceneCloseObserver = slicer.mrmlScene.AddObserver(slicer.mrmlScene.EndCloseEvent, self.onSceneEndClose)
+
+    def cleanup(self):
+        """Remove the scene observer (so that the logic can be released) and close the plan repository."""
+        if self.sceneCloseObserver is not None:
+            slicer.mrmlScene.RemoveObserver(self.sceneCloseObserver)
+            self.sceneCloseObserver = None
+        if self.planStore is not None:
+            self.planStore.close()
+            self.planStore = None
+
+    def onSceneEndClose(self, caller, event):
+        self.sliceNodes = None
+        self.crosshairNode = None
+
+    def getSliceNodes(self):
+        """Return the Red, Yellow and Green slice nodes as a dict keyed by view name (cached)."""
+        if self.sliceNodes is None or not all(slicer.mrmlScene.IsNodePresent(n) for n in self.sliceNodes.values()):
+            self.sliceNodes = {name: slicer.mrmlScene.GetNodeByID('vtkMRMLSliceNode' + name)
+                               for name in self.SLICE_VIEW_NAMES}
+        return self.sliceNodes
+
+    def getCrosshairNode(self):
+        if self.crosshairNode is None or not slicer.mrmlScene.IsNodePresent(self.crosshairNode):
+            self.crosshairNode = slicer.mrmlScene.GetFirstNodeByClass('vtkMRMLCrosshairNode')
+        return self.crosshairNode
+
+    @contextmanager
+    def sliceUpdateBatch(self):
+        """Group changes of the slice nodes: their Modified events are sent once at the end of the block and
+        rendering is paused meanwhile, so several views change in a single render. Blocks can be nested."""
+        sliceNodes = [n for n in self.getSliceNodes().values() if n is not None]
+        wasModifying = [n.StartModify() for n in sliceNodes]
+        slicer.app.pauseRender()
+        try:
+            yield
+        finally:
+            for sliceNode, wasModified in zip(sliceNodes, wasModifying):
+                sliceNode.EndModify(wasModified)
+            slicer.app.resumeRender()
+
     def addTestData(self, test_volume_data_filename, test_ct_directory):
         """ Load volume data  """
 
@@ -71,12 +638,7 @@ class SurgeryPlannerLogic(ScriptedLoadableModuleLogic):
         label_volumeNode.AddAndObserveDisplayNodeID(displayNode.GetID())
 
         """ Load image data  """
-        # noinspection PyUnresolvedReferences
-        from DICOMLib import DICOMUtils
-        with DICOMUtils.TemporaryDICOMDatabase() as db:
-            DICOMUtils.importDicom(test_ct_directory, db)
-            patientUID = db.patients()[0]
-            DICOMUtils.loadPatientByUID(patientUID)
+        self.loadDicomDirectory(test_ct_directory)
 
         # Resets focal point (pink wireframe bounding box) to center of scene
         layoutManager = slicer.app.layoutManager()
@@ -84,6 +646,96 @@ class SurgeryPlannerLogic(ScriptedLoadableModuleLogic):
         threeDView = threeDWidget.threeDView()
         threeDView.resetFocalPoint()
 
+    def loadDicomDirectory(self, dicomDirectory, volumeCache=None):
+        """Load the DICOM series of a directory. The first load imports them through a temporary DICOM database
+        and stores the voxels in the local volume cache; later loads of the unchanged directory read the cache."""
+        if volumeCache is None:
+            volumeCache = sio.VolumeCache(os.path.join(CACHE_DIR, 'dicom_cache'))
+        cachedSeries = volumeCache.lookup(dicomDirectory)
+        if cachedSeries is not None:
+            volumeNodes = []
+            for series in cachedSeries:
+                volumeNode = slicer.util.addVolumeFromArray(volumeCache.load_array(series),
+                                                            ijkToRAS=np.array(series['ijk_to_ras']),
+                                                            name=series['name'])
+                volumeNode.SetAttribute('DICOM.SeriesInstanceUID', series['series_uid'])
+                volumeNode.CreateDefaultDisplayNodes()
+                if series['window'] is not None:
+                    volumeNode.GetDisplayNode().SetAutoWindowLevel(False)
+                    volumeNode.GetDisplayNode().SetWindowLevel(series['window'], series['level'])
+                volumeNodes.append(volumeNode)
+            slicer.util.setSliceViewerLayers(background=volumeNodes[0] if volumeNodes else None, fit=True)
+            print(f"[SurgeryPlannerLogic] Loaded {len(volumeNodes)} series of {dicomDirectory} from the volume cache")
+            return volumeNodes
+
+        volumeNodes = self.loadDicomSeriesParallel(dicomDirectory) if sio.pydicom_available() else []
+        if not volumeNodes:
+            # noinspection PyUnresolvedReferences
+            from DICOMLib import DICOMUtils
+            with DICOMUtils.TemporaryDICOMDatabase() as db:
+                DICOMUtils.importDicom(dicomDirectory, db)
+                patientUID = db.patients()[0]
+                loadedNodeIDs = DICOMUtils.loadPatientByUID(patientUID) or []
+            volumeNodes = [slicer.mrmlScene.GetNodeByID(nodeID) for nodeID in loadedNodeIDs]
+            volumeNodes = [node for node in volumeNodes if node and node.IsA('vtkMRMLScalarVolumeNode')]
+
+        shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+        seriesList = []
+        for volumeNode in volumeNodes:
+            seriesUID = volumeNode.GetAttribute('DICOM.SeriesInstanceUID') or \
+                shNode.GetItemUID(shNode.GetItemByDataNode(volumeNode), 'DICOM') or volumeNode.GetID()
+            ijkToRAS, _ = self.getVolumeMatrices(volumeNode)
+            displayNode = volumeNode.GetDisplayNode()
+            seriesList.append({'series_uid': seriesUID, 'name': volumeNode.GetName(),
+                               'array': slicer.util.arrayFromVolume(volumeNode), 'ijk_to_ras': ijkToRAS,
+                               'window': displayNode.GetWindow() if displayNode else None,
+                               'level': displayNode.GetLevel() if displayNode else None})
+        try:
+            volumeCache.store(dicomDirectory, seriesList)
+        except OSError as e:
+            print(f"[SurgeryPlannerLogic] Could not cache {dicomDirectory}: {e}")
+        return volumeNodes
+
+    def loadDicomSeriesParallel(self, dicomDirectory, useProcesses=False, workers=None):
+        """Load the DICOM series of a directory with pydicom: headers are read and slices decoded in parallel,
+        each slice being written straight into the voxel buffer of the new scalar volume node."""
+        start = time.perf_counter()
+        try:
+            seriesList = sio.read_dicom_series(dicomDirectory, workers)
+        except Exception as e:
+            print(f"[SurgeryPlannerLogic] Could not read DICOM headers of {dicomDirectory}: {e}")
+            return []
+        executable = getWorkerExecutable()
+        volumeNodes = []
+        for series in seriesList:
+            # Allocate the image of the node and decode into its voxel array (no per-slice copies)
+            imageData = vtk.vtkImageData()
+            imageData.SetDimensions(series['shape'][::-1])
+            imageData.AllocateScalars(numpy_support.get_vtk_array_type(series['dtype']), 1)
+            volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', series['name'])
+            volumeNode.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(series['ijk_to_ras']))
+            volumeNode.SetAndObserveImageData(imageData)
+            try:
+                sio.decode_dicom_series(series, out=slicer.util.arrayFromVolume(volumeNode), workers=workers,
+                                        use_processes=useProcesses,
+                                        executable=executable)
+            except Exception as e:
+                print(f"[SurgeryPlannerLogic] Could not decode series {series['series_uid']}: {e}")
+                slicer.mrmlScene.RemoveNode(volumeNode)
+                continue
+            slicer.util.arrayFromVolumeModified(volumeNode)
+            volumeNode.SetAttribute('DICOM.SeriesInstanceUID', series['series_uid'])
+            volumeNode.CreateDefaultDisplayNodes()
+            if series['window'] is not None:
+                volumeNode.GetDisplayNode().SetAutoWindowLevel(False)
+                volumeNode.GetDisplayNode().SetWindowLevel(series['window'], series['level'])
+            volumeNodes.append(volumeNode)
+        if volumeNodes:
+            slicer.util.setSliceViewerLayers(background=volumeNodes[0], fit=True)
+        print(f"[SurgeryPlannerLogic] Decoded {len(volumeNodes)} series of {dicomDirectory} "
+              f"in {time.perf_counter() - start:.2f} s")
+        return volumeNodes
+
     def toggleSliceIntersection(self):
         sliceDisplayNodes = slicer.util.getNodesByClass('vtkMRMLSliceDisplayNode')
         for sliceDisplayNode in sliceDisplayNodes:
@@ -97,30 +749,29 @@ class SurgeryPlannerLogic(ScriptedLoadableModuleLogic):
                 controller.setSliceVisible(int(not controller.sliceLogic().GetSliceNode().GetSliceVisible()))
 
     def moveTargetToIntersectionButton(self, targetMarkupNode, targetIndex):
-        crosshairNode = slicer.util.getNode('Crosshair')
         crosshairPos = [0.0, 0.0, 0.0]
-        crosshairNode.GetCursorPositionRAS(crosshairPos)
+        self.getCrosshairNode().GetCursorPositionRAS(crosshairPos)
         targetMarkupNode.SetNthControlPointPosition(targetIndex, crosshairPos[0], crosshairPos[1], crosshairPos[2])
 
     def moveEntryToIntersectionButton(self, EntryMarkupNode, entryIndex):
-        crosshairNode = slicer.util.getNode('Crosshair')
         crosshairPos = [0.0, 0.0, 0.0]
-        crosshairNode.GetCursorPositionRAS(crosshairPos)
+        self.getCrosshairNode().GetCursorPositionRAS(crosshairPos)
         EntryMarkupNode.SetNthControlPointPosition(entryIndex, crosshairPos[0], crosshairPos[1], crosshairPos[2])
         
     def jumpToMarkup(self, MarkupNode, pointIndex=0):
         pos = [0.0, 0.0, 0.0]
         MarkupNode.GetNthControlPointPosition(pointIndex, pos)
 
-        for name in ['Red', 'Yellow', 'Green']:
-            sliceNode = slicer.app.layoutManager().sliceWidget(name).mrmlSliceNode()
-            sliceNode.JumpSlice(pos[0], pos[1], pos[2])
+        with self.sliceUpdateBatch():
+            for sliceNode in self.getSliceNodes().values():
+                sliceNode.JumpSlice(pos[0], pos[1], pos[2])
 
     def alignAxesWithTrajectory(self, targetMarkupNode, targetIndex, EntryMarkupNode, entryIndex):
 
-        redSliceNode = slicer.util.getNode('vtkMRMLSliceNodeRed')
-        yellowSliceNode = slicer.util.getNode('vtkMRMLSliceNodeYellow')
-        greenSliceNode = slicer.util.getNode('vtkMRMLSliceNodeGreen')
+        sliceNodes = self.getSliceNodes()
+        redSliceNode = sliceNodes['Red']
+        yellowSliceNode = sliceNodes['Yellow']
+        greenSliceNode = sliceNodes['Green']
 
         redSliceToRAS = redSliceNode.GetSliceToRAS()
         yellowSliceToRAS = yellowSliceNode.GetSliceToRAS()
@@ -133,32 +784,569 @@ class SurgeryPlannerLogic(ScriptedLoadableModuleLogic):
         EntryMarkupNode.GetNthControlPointPosition(entryIndex, p_Entry)
         sliceNormal = p_target - p_Entry
         slicePosition = p_target
-        setSlicePoseFromSliceNormalAndPosition(redSliceNode, sliceNormal, slicePosition)
-
-        swap_yellow = vtk.vtkMatrix4x4()
-        swap_yellow.SetElement(1, 1, 0)
-        swap_yellow.SetElement(2, 1, 1)
-        swap_yellow.SetElement(1, 2, 1)
-        swap_yellow.SetElement(2, 2, 0)
-        vtk.vtkMatrix4x4().Multiply4x4(redSliceToRAS, swap_yellow, yellowSliceToRAS)
-        yellowSliceNode.UpdateMatrices()
-
-        swap_green = vtk.vtkMatrix4x4()
-        swap_green.SetElement(0, 0, 0)
-        swap_green.SetElement(1, 0, -1)
-        swap_green.SetElement(1, 1, 0)
-        swap_green.SetElement(2, 1, 1)
-        swap_green.SetElement(0, 2, -1)
-        swap_green.SetElement(2, 2, 0)
-        vtk.vtkMatrix4x4().Multiply4x4(redSliceToRAS, swap_green, greenSliceToRAS)
-        greenSliceNode.UpdateMatrices()
+
+        with self.sliceUpdateBatch():
+            setSlicePoseFromSliceNormalAndPosition(redSliceNode, sliceNormal, slicePosition)
+
+            swap_yellow = vtk.vtkMatrix4x4()
+            swap_yellow.SetElement(1, 1, 0)
+            swap_yellow.SetElement(2, 1, 1)
+            swap_yellow.SetElement(1, 2, 1)
+            swap_yellow.SetElement(2, 2, 0)
+            vtk.vtkMatrix4x4().Multiply4x4(redSliceToRAS, swap_yellow, yellowSliceToRAS)
+            yellowSliceNode.UpdateMatrices()
+
+            swap_green = vtk.vtkMatrix4x4()
+            swap_green.SetElement(0, 0, 0)
+            swap_green.SetElement(1, 0, -1)
+            swap_green.SetElement(1, 1, 0)
+            swap_green.SetElement(2, 1, 1)
+            swap_green.SetElement(0, 2, -1)
+            swap_green.SetElement(2, 2, 0)
+            vtk.vtkMatrix4x4().Multiply4x4(redSliceToRAS, swap_green, greenSliceToRAS)
+            greenSliceNode.UpdateMatrices()
 
     def resetAxesToASC(self, targetMarkupNode, pointIndex=0):
-        redSliceNode = slicer.util.getNode('vtkMRMLSliceNodeRed')
-        yellowSliceNode = slicer.util.getNode('vtkMRMLSliceNodeYellow')
-        greenSliceNode = slicer.util.getNode('vtkMRMLSliceNodeGreen')
-        redSliceNode.SetOrientationToAxial()
-        yellowSliceNode.SetOrientationToSagittal()
-        greenSliceNode.SetOrientationToCoronal()
+        sliceNodes = self.getSliceNodes()
+        with self.sliceUpdateBatch():
+            sliceNodes['Red'].SetOrientationToAxial()
+            sliceNodes['Yellow'].SetOrientationToSagittal()
+            sliceNodes['Green'].SetOrientationToCoronal()
         p_target = np.array([0.0, 0.0, 0.0])
         targetMarkupNode.GetNthControlPointPosition(pointIndex, p_target)
+
+    def getReferencePlaneArrays(self, planeNodes=None):
+        """Return names, (M,4,4) Object-to-World matrices and (M,2) sizes of the reference planes in the scene."""
+        if planeNodes is None:
+            planeNodes = slicer.util.getNodesByClass("vtkMRMLMarkupsPlaneNode")
+        names = []
+        matrices = np.zeros((len(planeNodes), 4, 4))
+        sizes = np.zeros((len(planeNodes), 2))
+        mat = vtk.vtkMatrix4x4()
+        for i, node in enumerate(planeNodes):
+            names.append(node.GetName())
+            node.GetObjectToWorldMatrix(mat)
+            mat.DeepCopy(matrices[i].ravel(), mat)
+            sizes[i] = node.GetSize()[:2]
+        return names, matrices, sizes
+
+    def setupPlaneDisplayNode(self, displayNode, color, opacity=0.5):
+        """Apply the planner's standard display properties to a reference plane display node."""
+        displayNode.SetGlyphScale(1.0)
+        displayNode.SetOpacity(opacity)
+        displayNode.SetSelectedColor(color[0], color[1], color[2])
+        displayNode.SetColor(color[0], color[1], color[2])
+
+        # Enable Interaction Handles
+        displayNode.SetHandlesInteractive(True)
+        displayNode.SetRotationHandleVisibility(True)
+        displayNode.SetTranslationHandleVisibility(True)
+
+        # Disable Scale Handles to enforce fixed size via UI
+        displayNode.SetScaleHandleVisibility(False)
+
+    def setPlaneNodePose(self, planeNode, matrix):
+        """Set the center and axes of a plane node from a 4x4 Object-to-World matrix."""
+        matrix = np.asarray(matrix, dtype=float)
+        axes = matrix[:3, :3] / np.maximum(np.linalg.norm(matrix[:3, :3], axis=0), 1e-8)
+        center = matrix[:3, 3]
+        if planeNode.GetNumberOfControlPoints() == 0:
+            planeNode.AddControlPoint(center[0], center[1], center[2])
+        else:
+            planeNode.SetNthControlPointPositionWorld(0, center[0], center[1], center[2])
+        planeNode.SetAxesWorld(axes[:, 0], axes[:, 1], axes[:, 2])
+
+    def createPlaneNodes(self, names, matrices, sizes, colors, opacity=0.5):
+        """Create reference plane nodes from stacked poses inside a single bulk operation.
+        INPUT: names    [list of str]   - plane names
+               matrices [(N,4,4) array] - Object-to-World matrices (RAS)
+               sizes    [(N,2) array]   - width, height in mm
+               colors   [list of RGB]   - per-plane color
+               opacity  [float or list] - opacity of all planes or per-plane opacities
+        OUTPUT: list of vtkMRMLMarkupsPlaneNode
+        """
+        nodes = []
+        opacities = np.broadcast_to(np.asarray(opacity, dtype=float), (len(names),))
+        with bulkOperation():
+            for name, matrix, size, color, opacity in zip(names, matrices, sizes, colors, opacities):
+                planeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsPlaneNode")
+                wasModified = planeNode.StartModify()
+                planeNode.SetName(name)
+                planeNode.CreateDefaultDisplayNodes()
+                displayNode = planeNode.GetDisplayNode()
+                if displayNode:
+                    self.setupPlaneDisplayNode(displayNode, color, float(opacity))
+                self.setPlaneNodePose(planeNode, matrix)
+                planeNode.SetNthControlPointLabel(0, f"{name}_center")
+                planeNode.SetSize(size[0], size[1])
+                planeNode.EndModify(wasModified)
+                nodes.append(planeNode)
+        return nodes
+
+    def getTrajectoryArrays(self, markupNode):
+        """Return trajectory numbers and (N,3) entry / target positions from the shared landmarks node.
+        Control points are matched through their "Entry_<n>" / "Target_<n>" labels."""
+        if markupNode is None or markupNode.GetNumberOfControlPoints() == 0:
+            return [], np.zeros((0, 3)), np.zeros((0, 3))
+        positions = slicer.util.arrayFromMarkupsControlPoints(markupNode, world=True)
+        entryIndex = {}
+        targetIndex = {}
+        for i in range(markupNode.GetNumberOfControlPoints()):
+            label = markupNode.GetNthControlPointLabel(i)
+            kind, _, num = label.rpartition('_')
+            if not num.isdigit():
+                continue
+            if kind == 'Entry':
+                entryIndex[int(num)] = i
+            elif kind == 'Target':
+                targetIndex[int(num)] = i
+        trajNums = sorted(set(entryIndex) & set(targetIndex))
+        entries = positions[[entryIndex[n] for n in trajNums]].reshape(-1, 3)
+        targets = positions[[targetIndex[n] for n in trajNums]].reshape(-1, 3)
+        return trajNums, entries, targets
+
+    def collectSessionState(self, landmarksNode, selectedTrajectory=None, selectedPlane=None):
+        """Gather the plan (trajectories, reference planes, their display properties and the selection) for a
+        session snapshot.
+        OUTPUT: metadata [dict] - plane names, landmark display, selection and counts
+                arrays   [dict] - trajectory_numbers (N,), entries / targets (N,3), plane_matrices (M,4,4),
+                                  plane_sizes (M,2), plane_display (M,5) as r, g, b, opacity, visibility
+        """
+        trajNums, entries, targets = self.getTrajectoryArrays(landmarksNode)
+        planeNodes = slicer.util.getNodesByClass("vtkMRMLMarkupsPlaneNode")
+        planeNames, planeMatrices, planeSizes = self.getReferencePlaneArrays(planeNodes)
+        planeDisplay = np.zeros((len(planeNodes), 5), dtype=np.float32)
+        for i, node in enumerate(planeNodes):
+            displayNode = node.GetDisplayNode()
+            if displayNode:
+                planeDisplay[i, :3] = displayNode.GetSelectedColor()
+                planeDisplay[i, 3] = displayNode.GetOpacity()
+                planeDisplay[i, 4] = displayNode.GetVisibility()
+        landmarkDisplay = None
+        if landmarksNode and landmarksNode.GetDisplayNode():
+            displayNode = landmarksNode.GetDisplayNode()
+            landmarkDisplay = {'color': list(displayNode.GetColor()),
+                               'selected_color': list(displayNode.GetSelectedColor()),
+                               'glyph_scale': displayNode.GetGlyphScale(),
+                               'visibility': displayNode.GetVisibility()}
+        metadata = {'plane_names': planeNames, 'landmark_display': landmarkDisplay,
+                    'selected_trajectory': selectedTrajectory, 'selected_plane': selectedPlane,
+                    'trajectory_count': len(trajNums), 'plane_count': len(planeNames)}
+        arrays = {'trajectory_numbers': np.asarray(trajNums, dtype=np.int32), 'entries': entries,
+                  'targets': targets, 'plane_matrices': planeMatrices, 'plane_sizes': planeSizes,
+                  'plane_display': planeDisplay}
+        return metadata, arrays
+
+    def applyLandmarkDisplay(self, landmarksNode, landmarkDisplay):
+        """Restore the landmark display properties stored by collectSessionState."""
+        if not landmarkDisplay or not landmarksNode:
+            return
+        landmarksNode.CreateDefaultDisplayNodes()
+        displayNode = landmarksNode.GetDisplayNode()
+        displayNode.SetColor(landmarkDisplay['color'])
+        displayNode.SetSelectedColor(landmarkDisplay['selected_color'])
+        displayNode.SetGlyphScale(landmarkDisplay['glyph_scale'])
+        displayNode.SetVisibility(landmarkDisplay['visibility'])
+
+    def getPlanStore(self):
+        """The local plan repository (opened on first use)."""
+        if self.planStore is None:
+            self.planStore = sps.PlanStore(os.path.join(CACHE_DIR, 'plans.sqlite'))
+        return self.planStore
+
+    def getPlanIdentity(self, volumeNode=None):
+        """Return the series UID and patient ID a plan is stored under, from a volume (default: the background
+        volume of the Red slice view). Volumes that were not loaded from DICOM are identified by their name."""
+        if volumeNode is None:
+            layoutManager = slicer.app.layoutManager()
+            compositeNode = layoutManager.sliceWidget('Red').mrmlSliceCompositeNode() if layoutManager else None
+            volumeID = compositeNode.GetBackgroundVolumeID() if compositeNode else None
+            volumeNode = slicer.mrmlScene.GetNodeByID(volumeID) if volumeID else None
+        if volumeNode is None:
+            return '', ''
+        shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+        itemID = shNode.GetItemByDataNode(volumeNode)
+        seriesUID = volumeNode.GetAttribute('DICOM.SeriesInstanceUID') or shNode.GetItemUID(itemID, 'DICOM') or \
+            volumeNode.GetName()
+        # Subject hierarchy of DICOM data: patient -> study -> series
+        patientItemID = shNode.GetItemParent(shNode.GetItemParent(itemID)) if itemID else 0
+        patientID = volumeNode.GetAttribute('DICOM.PatientID') or \
+            (shNode.GetItemAttribute(patientItemID, 'DICOM.PatientID') if patientItemID else '')
+        return seriesUID, patientID or ''
+
+    def showPlanDiff(self, diff, planA, planB, modelNode=None):
+        """Highlight the differences of two plans (see surgery_planner_diff.diff_plans) with one line model:
+        a line from every entry, target and plane center of plan A to its match in plan B, and the plan A
+        trajectories, colored by displacement (mm). Removed trajectories are drawn at the top of the color range.
+        OUTPUT: the (created or updated) vtkMRMLModelNode
+        """
+        arraysA, arraysB = planA[1], planB[1]
+        trajectories, planes = diff['trajectories'], diff['planes']
+        ia, ib = trajectories['index_a'], trajectories['index_b']
+        deltas = trajectories['deltas']
+        centersA, _ = sg.plane_frames(arraysA['plane_matrices'])
+        centersB, _ = sg.plane_frames(arraysB['plane_matrices'])
+        removed = trajectories['removed']
+
+        starts = [arraysA['entries'][ia], arraysA['targets'][ia], centersA[planes['index_a']], arraysA['entries'][ia]]
+        ends = [arraysB['entries'][ib], arraysB['targets'][ib], centersB[planes['index_b']], arraysA['targets'][ia]]
+        scalars = [deltas['entry_mm'], deltas['target_mm'], planes['deltas']['translation_mm'],
+                   np.maximum(deltas['entry_mm'], deltas['target_mm'])]
+        maxDelta = max([float(np.max(values)) for values in scalars if len(values)] + [1.0])
+        starts.append(arraysA['entries'][removed])
+        ends.append(arraysA['targets'][removed])
+        scalars.append(np.full(len(removed), maxDelta))
+
+        starts, ends, scalars = np.concatenate(starts), np.concatenate(ends), np.concatenate(scalars)
+        points = np.empty((2 * len(starts), 3))
+        points[0::2] = starts
+        points[1::2] = ends
+        vtkPoints = vtk.vtkPoints()
+        vtkPoints.SetData(numpy_support.numpy_to_vtk(points, deep=1))
+        lines = vtk.vtkCellArray()
+        lines.SetData(numpy_support.numpy_to_vtkIdTypeArray(np.arange(0, len(points) + 1, 2, dtype=np.int64), deep=1),
+                      numpy_support.numpy_to_vtkIdTypeArray(np.arange(len(points), dtype=np.int64), deep=1))
+        polyData = vtk.vtkPolyData()
+        polyData.SetPoints(vtkPoints)
+        polyData.SetLines(lines)
+        deltaArray = numpy_support.numpy_to_vtk(np.ascontiguousarray(scalars, dtype=float), deep=1)
+        deltaArray.SetName("DeltaMM")
+        polyData.GetCellData().SetScalars(deltaArray)
+
+        if modelNode is None or not slicer.mrmlScene.IsNodePresent(modelNode):
+            modelNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", "PlanDiff")
+            modelNode.CreateDefaultDisplayNodes()
+            displayNode = modelNode.GetDisplayNode()
+            displayNode.SetLineWidth(3)
+            displayNode.SetVisibility2D(True)
+            displayNode.SetSliceDisplayModeToProjection()
+            displayNode.SetActiveScalar("DeltaMM", vtk.vtkAssignAttribute.CELL_DATA)
+            displayNode.SetAndObserveColorNodeID("vtkMRMLColorTableNodeFileColdToHotRainbow.txt")
+            displayNode.SetScalarRangeFlag(slicer.vtkMRMLDisplayNode.UseManualScalarRange)
+            displayNode.SetScalarVisibility(True)
+        modelNode.SetAndObservePolyData(polyData)
+        modelNode.GetDisplayNode().SetScalarRange(0.0, maxDelta)
+        return modelNode
+
+    REGISTRATION_TRANSFORM_NAME = "PlanRegistration"
+
+    def getRegistrationTransformNode(self, create=False):
+        transformNode = slicer.mrmlScene.GetFirstNodeByName(self.REGISTRATION_TRANSFORM_NAME)
+        if transformNode is None and create:
+            transformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode",
+                                                               self.REGISTRATION_TRANSFORM_NAME)
+        return transformNode
+
+    def getRegistrationPoints(self, movingNode, fixedNode):
+        """Pair the control points of the pre-op (moving) and intra-op (fixed) fiducials: by label when every moving
+        label is found in the fixed node, else in order. Moving points already under the registration transform are
+        taken in plan (pre-registration) coordinates so that registering again does not compound.
+        OUTPUT: labels [list of str], moving points (N,3), fixed points (N,3)
+        """
+        registrationNode = self.getRegistrationTransformNode()
+        underRegistration = registrationNode is not None and \
+            movingNode.GetTransformNodeID() == registrationNode.GetID()
+        moving = slicer.util.arrayFromMarkupsControlPoints(movingNode, world=not underRegistration).reshape(-1, 3)
+        fixed = slicer.util.arrayFromMarkupsControlPoints(fixedNode, world=True).reshape(-1, 3)
+        movingLabels = [movingNode.GetNthControlPointLabel(i) for i in range(len(moving))]
+        fixedIndex = {fixedNode.GetNthControlPointLabel(i): i for i in range(len(fixed))}
+        if len(set(movingLabels)) == len(movingLabels) and all(label in fixedIndex for label in movingLabels):
+            return movingLabels, moving, fixed[[fixedIndex[label] for label in movingLabels]].reshape(-1, 3)
+        n = min(len(moving), len(fixed))
+        return movingLabels[:n], moving[:n], fixed[:n]
+
+    def registerPlan(self, movingNode, fixedNode, planNodes, similarity=False, harden=False):
+        """Register the plan to intra-op fiducials (paired with getRegistrationPoints).
+        The transform is either set on a single parent transform node observed by all plan nodes (and the moving
+        fiducials), or hardened into the plan: all control points of each markups node and all plane matrices are
+        transformed with one batched operation.
+        INPUT: planNodes [list] - landmarks node, trajectory line models and plane nodes
+        OUTPUT: labels [list of str], result of surgery_planner_geometry.register_points
+        """
+        labels, moving, fixed = self.getRegistrationPoints(movingNode, fixedNode)
+        result = sg.register_points(moving, fixed, scale=similarity)
+        with bulkOperation():
+            if harden:
+                self.hardenPlanTransform(result['matrix'], list(planNodes) + [movingNode], result['scale'])
+            else:
+                transformNode = self.getRegistrationTransformNode(create=True)
+                transformNode.SetMatrixTransformToParent(slicer.util.vtkMatrixFromArray(result['matrix']))
+                transformNodeID = transformNode.GetID()
+                for node in list(planNodes) + [movingNode]:
+                    if node.GetTransformNodeID() != transformNodeID:
+                        node.SetAndObserveTransformNodeID(transformNodeID)
+        return labels, result
+
+    def hardenPlanTransform(self, matrix, nodes, scale=1.0):
+        """Apply a 4x4 RAS transform to the world positions of markups nodes: control points with one batched
+        transform per node, reference plane poses as one stacked matrix product (plane sizes follow the scale).
+        Other nodes (e.g. trajectory line models) follow their control points and are skipped."""
+        matrix = np.asarray(matrix, dtype=float)
+        planeNodes = [node for node in nodes if node.IsA("vtkMRMLMarkupsPlaneNode")]
+        with bulkOperation():
+            for node in nodes:
+                if not node.IsA("vtkMRMLMarkupsFiducialNode") or node.GetNumberOfControlPoints() == 0:
+                    continue
+                points = slicer.util.arrayFromMarkupsControlPoints(node, world=True).reshape(-1, 3)
+                vtkPoints = vtk.vtkPoints()
+                vtkPoints.SetData(numpy_support.numpy_to_vtk(sg.transform_points(matrix, points), deep=1))
+                wasModified = node.StartModify()
+                node.SetControlPointPositionsWorld(vtkPoints)
+                node.EndModify(wasModified)
+            if planeNodes:
+                _, planeMatrices, planeSizes = self.getReferencePlaneArrays(planeNodes)
+                planeMatrices = np.einsum('ij,njk->nik', matrix, planeMatrices)
+                for planeNode, planeMatrix, planeSize in zip(planeNodes, planeMatrices, planeSizes * scale):
+                    wasModified = planeNode.StartModify()
+                    self.setPlaneNodePose(planeNode, planeMatrix)
+                    planeNode.SetSize(planeSize[0], planeSize[1])
+                    planeNode.EndModify(wasModified)
+
+    def computeTrajectoryPlaneIntersections(self, markupNode, planeNodes=None):
+        """Intersect all trajectories of the landmarks node with all reference planes.
+        The returned IntersectionTable can be updated per trajectory (row) or per plane (column)."""
+        trajNums, entries, targets = self.getTrajectoryArrays(markupNode)
+        planeNames, matrices, sizes = self.getReferencePlaneArrays(planeNodes)
+        trajNames = [f"traj_{n}" for n in trajNums]
+        return sg.IntersectionTable(trajNames, entries, targets, planeNames, matrices, sizes)
+
+    def updateTableNodeFromColumns(self, tableNode, columns):
+        """Fill a vtkMRMLTableNode from a dict of 1-D numpy arrays (string columns are supported)."""
+        table = tableNode.GetTable()
+        wasModified = tableNode.StartModify()
+        table.Initialize()
+        for name, values in columns.items():
+            values = np.asarray(values)
+            if values.dtype.kind in ('U', 'S', 'O'):
+                array = vtk.vtkStringArray()
+                array.SetNumberOfValues(len(values))
+                for i, value in enumerate(values):
+                    array.SetValue(i, str(value))
+            else:
+                array = numpy_support.numpy_to_vtk(np.ascontiguousarray(values, dtype=float), deep=1)
+            array.SetName(name)
+            table.AddColumn(array)
+        tableNode.EndModify(wasModified)
+
+    def getSegmentSurfaces(self):
+        """Return {(segmentationNodeID, segmentID): closed surface vtkPolyData} for all segmentations in the scene."""
+        surfaces = {}
+        for segmentationNode in slicer.util.getNodesByClass("vtkMRMLSegmentationNode"):
+            segmentation = segmentationNode.GetSegmentation()
+            if segmentation.GetNumberOfSegments() == 0:
+                continue
+            # Only converts if the representation does not exist yet
+            segmentationNode.CreateClosedSurfaceRepresentation()
+            for i in range(segmentation.GetNumberOfSegments()):
+                segmentID = segmentation.GetNthSegmentID(i)
+                polyData = segmentationNode.GetClosedSurfaceInternalRepresentation(segmentID)
+                if polyData and polyData.GetNumberOfCells() > 0:
+                    surfaces[(segmentationNode.GetID(), segmentID)] = polyData
+        return surfaces
+
+    def computePlaneContour(self, contourCache, planeNode, surfaces=None):
+        """Append the cached cross-section contours of all segment surfaces for one plane node."""
+        if surfaces is None:
+            surfaces = self.getSegmentSurfaces()
+        _, matrices, sizes = self.getReferencePlaneArrays([planeNode])
+        append = vtk.vtkAppendPolyData()
+        for surfaceKey, polyData in surfaces.items():
+            append.AddInputData(contourCache.getContour(surfaceKey, polyData, matrices[0], sizes[0]))
+        if append.GetNumberOfInputConnections(0) == 0:
+            return vtk.vtkPolyData()
+        append.Update()
+        return append.GetOutput()
+
+    def computeResectionVolume(self, labelmapNode, planeNodes, mode='between', labelValue=None, calculator=None):
+        """Volume (mm^3) and centroid (RAS) of the labelmap voxels in the region bounded by the plane nodes.
+        mode is 'between', 'above' or 'below' (see surgery_planner_geometry.halfspace_region_stats).
+        Pass the same ResectionVolumeCalculator on repeated calls to reuse the cached labelmap mask."""
+        if calculator is None:
+            calculator = ResectionVolumeCalculator()
+        _, matrices, sizes = self.getReferencePlaneArrays(planeNodes)
+        return calculator.compute(labelmapNode, matrices, sizes, mode, labelValue)
+
+    def computeToolTraversal(self, labelmapNode, markupNode, radius, length=None, corticalLabels=()):
+        """Voxels crossed by a tool of the given radius (mm) and length (mm, default: entry to target) along every
+        trajectory of the landmarks node (see surgery_planner_geometry.swept_cylinder_traversal).
+        Returns the trajectory numbers and the traversal result dict."""
+        trajNums, entries, targets = self.getTrajectoryArrays(markupNode)
+        ijkToRAS, _ = self.getVolumeMatrices(labelmapNode)
+        result = sg.swept_cylinder_traversal(slicer.util.arrayFromVolume(labelmapNode), ijkToRAS, entries, targets,
+                                             radius, length, corticalLabels,
+                                             executable=getWorkerExecutable())
+        return trajNums, result
+
+    def getNodePoints(self, node):
+        """Return the (N,3) world positions of a markups node's control points or a model node's points."""
+        if node.IsA("vtkMRMLMarkupsNode"):
+            return slicer.util.arrayFromMarkupsControlPoints(node, world=True)
+        if node.IsA("vtkMRMLModelNode"):
+            points = slicer.util.arrayFromModelPoints(node)
+            transformNode = node.GetParentTransformNode()
+            if transformNode:
+                toWorld = vtk.vtkMatrix4x4()
+                transformNode.GetMatrixTransformToWorld(toWorld)
+                points = sg.transform_points(slicer.util.arrayFromVTKMatrix(toWorld), points)
+            return points
+        raise ValueError(f"Cannot get points from {node.GetClassName()}")
+
+    def fitPlaneToPoints(self, points, useRansac=False, threshold=1.0, iterations=500):
+        """Fit a plane with SVD (or RANSAC + SVD refit).
+        OUTPUT: 4x4 Object-to-World matrix, signed residuals (N,), inlier mask (N,)"""
+        if useRansac:
+            center, axes, residuals, inliers = sg.fit_plane_ransac(points, threshold, iterations)
+        else:
+            center, axes, residuals = sg.fit_plane_svd(points)
+            inliers = np.ones(len(residuals), dtype=bool)
+        matrix = np.eye(4)
+        matrix[:3, :3] = axes
+        matrix[:3, 3] = center
+        return matrix, residuals, inliers
+
+    def getVolumeMatrices(self, volumeNode):
+        """Return the IJK to RAS and RAS to IJK matrices of a volume node as numpy arrays."""
+        ijkToRAS = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRAS)
+        ijkToRAS = slicer.util.arrayFromVTKMatrix(ijkToRAS)
+        return ijkToRAS, np.linalg.inv(ijkToRAS)
+
+    def getROIExtent(self, volumeNode, roiNode=None):
+        """Inclusive IJK extent (i0, i1, j0, j1, k0, k1) of the volume, cropped to the ROI node bounds if given."""
+        dims = volumeNode.GetImageData().GetDimensions()
+        boxMin = np.zeros(3, dtype=int)
+        boxMax = np.array(dims) - 1
+        if roiNode:
+            bounds = [0.0] * 6
+            roiNode.GetRASBounds(bounds)
+            corners = np.array([[x, y, z] for x in bounds[0:2] for y in bounds[2:4] for z in bounds[4:6]])
+            ijk = sg.transform_points(self.getVolumeMatrices(volumeNode)[1], corners)
+            boxMin = np.maximum(boxMin, np.floor(ijk.min(axis=0)).astype(int))
+            boxMax = np.minimum(boxMax, np.ceil(ijk.max(axis=0)).astype(int))
+        return (int(boxMin[0]), int(boxMax[0]), int(boxMin[1]), int(boxMax[1]), int(boxMin[2]), int(boxMax[2]))
+
+    def selectConnectedComponent(self, mask, seedKJI=None):
+        """Return the connected component of a (K,J,I) bool mask that contains the seed, or the largest one."""
+        ndimage = getNdimage()
+        if ndimage is not None:
+            labels, _ = ndimage.label(mask)
+            if seedKJI is not None:
+                label = labels[tuple(seedKJI)]
+            else:
+                counts = np.bincount(labels.ravel())
+                counts[0] = 0
+                label = int(np.argmax(counts))
+            if label == 0:
+                return np.zeros_like(mask)
+            return labels == label
+
+        # Fall back to VTK when scipy is not installed
+        image = vtk.vtkImageData()
+        image.SetDimensions(mask.shape[2], mask.shape[1], mask.shape[0])
+        image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(mask.ravel().astype(np.uint8), deep=1))
+        connectivity = vtk.vtkImageConnectivityFilter()
+        connectivity.SetInputData(image)
+        connectivity.SetScalarRange(1, 1)
+        if seedKJI is not None:
+            seedPoints = vtk.vtkPoints()
+            seedPoints.InsertNextPoint(seedKJI[2], seedKJI[1], seedKJI[0])
+            seedData = vtk.vtkPolyData()
+            seedData.SetPoints(seedPoints)
+            connectivity.SetSeedData(seedData)
+            connectivity.SetExtractionModeToSeededRegions()
+        else:
+            connectivity.SetExtractionModeToLargestRegion()
+        connectivity.Update()
+        return numpy_support.vtk_to_numpy(connectivity.GetOutput().GetPointData().GetScalars()).reshape(mask.shape) > 0
+
+    def setSegmentFromMask(self, segmentationNode, segmentID, mask, extent, ijkToRAS):
+        """Write a (K,J,I) bool mask covering the IJK extent into a segment as its binary labelmap."""
+        labelmap = slicer.vtkOrientedImageData()
+        labelmap.SetExtent(*extent)
+        labelmap.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+        numpy_support.vtk_to_numpy(labelmap.GetPointData().GetScalars()).reshape(mask.shape)[:] = mask
+        labelmap.SetImageToWorldMatrix(slicer.util.vtkMatrixFromArray(ijkToRAS))
+        slicer.vtkSlicerSegmentationsModuleLogic.SetBinaryLabelmapToSegment(
+            labelmap, segmentationNode, segmentID, slicer.vtkSlicerSegmentationsModuleLogic.MODE_REPLACE, extent)
+
+    def quickSegment(self, volumeNode, lower, upper, roiNode=None, seedRAS=None, segmentationNode=None,
+                     segmentName="QuickSegment"):
+        """Threshold the volume (cropped to the ROI) and keep one connected component as a new segment.
+        The component is the one containing seedRAS, or the largest one if no seed is given.
+        OUTPUT: segmentation node, segment ID, component mask (K,J,I) and its IJK extent"""
+        extent = self.getROIExtent(volumeNode, roiNode)
+        i0, i1, j0, j1, k0, k1 = extent
+        if i1 < i0 or j1 < j0 or k1 < k0:
+            raise ValueError("The ROI does not overlap the volume")
+        voxels = slicer.util.arrayFromVolume(volumeNode)
+        crop = voxels[k0:k1 + 1, j0:j1 + 1, i0:i1 + 1]
+        mask = (crop >= lower) & (crop <= upper)
+
+        ijkToRAS, rasToIJK = self.getVolumeMatrices(volumeNode)
+        seedKJI = None
+        if seedRAS is not None:
+            seedIJK = np.round(sg.transform_points(rasToIJK, seedRAS)[0]).astype(int)
+            seedKJI = (seedIJK - np.array([i0, j0, k0]))[::-1]
+            if np.any(seedKJI < 0) or np.any(seedKJI >= np.array(mask.shape)):
+                raise ValueError("The seed point is outside the ROI")
+        component = self.selectConnectedComponent(mask, seedKJI)
+
+        if segmentationNode is None:
+            segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+            segmentationNode.CreateDefaultDisplayNodes()
+            segmentationNode.SetName("SurgeryPlannerSegmentation")
+            segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(volumeNode)
+        segmentID = segmentationNode.GetSegmentation().AddEmptySegment(segmentName)
+        self.setSegmentFromMask(segmentationNode, segmentID, component, extent, ijkToRAS)
+        return segmentationNode, segmentID, component, extent
+
+    def getSegmentMask(self, segmentationNode, segmentID, extent=None):
+        """Return the bool (K,J,I) mask of a segment over an inclusive IJK extent of its internal labelmap
+        (default: the labelmap extent), the extent itself and the labelmap IJK to RAS matrix."""
+        labelmap = segmentationNode.GetBinaryLabelmapInternalRepresentation(segmentID)
+        segment = segmentationNode.GetSegmentation().GetSegment(segmentID)
+        if labelmap is None or segment is None:
+            return None, None, None
+        imageExtent = np.array(labelmap.GetExtent())
+        if extent is None:
+            extent = imageExtent
+        extent = np.array(extent)
+        ijkToRAS = vtk.vtkMatrix4x4()
+        labelmap.GetImageToWorldMatrix(ijkToRAS)
+        mask = np.zeros((extent[5] - extent[4] + 1, extent[3] - extent[2] + 1, extent[1] - extent[0] + 1), dtype=bool)
+
+        # Copy the overlap of the requested extent with the labelmap extent
+        low = np.maximum(extent[0::2], imageExtent[0::2])
+        high = np.minimum(extent[1::2], imageExtent[1::2])
+        scalars = labelmap.GetPointData().GetScalars()
+        if scalars is not None and np.all(high >= low):
+            dims = imageExtent[1::2] - imageExtent[0::2] + 1
+            voxels = numpy_support.vtk_to_numpy(scalars).reshape(dims[::-1])
+            src = low - imageExtent[0::2]
+            dst = low - extent[0::2]
+            size = high - low + 1
+            mask[dst[2]:dst[2] + size[2], dst[1]:dst[1] + size[1], dst[0]:dst[0] + size[0]] = \
+                voxels[src[2]:src[2] + size[2], src[1]:src[1] + size[1], src[0]:src[0] + size[0]] \
+                == segment.GetLabelValue()
+        return mask, tuple(int(e) for e in extent), slicer.util.arrayFromVTKMatrix(ijkToRAS)
+
+    def getSegmentSurfaceLevels(self, surfaceCache, segmentationNode, segmentID):
+        """Return the cached multi-resolution surfaces (coarse to fine) of a segment, generating them if needed."""
+        labelmap = segmentationNode.GetBinaryLabelmapInternalRepresentation(segmentID)
+        if labelmap is None:
+            return []
+        surfaceKey = (segmentationNode.GetID(), segmentID)
+        surfaces = surfaceCache.get(surfaceKey, labelmap.GetMTime())
+        if surfaces is not None:
+            return surfaces
+        mask, extent, ijkToRAS = self.getSegmentMask(segmentationNode, segmentID)
+        if mask is None or not mask.any():
+            return []
+        # Crop to the voxels of the segment before contouring
+        nonzero = [np.flatnonzero(mask.any(axis=axes)) for axes in [(0, 1), (0, 2), (1, 2)]]
+        low = np.array([n[0] for n in nonzero])
+        high = np.array([n[-1] for n in nonzero])
+        mask = mask[low[2]:high[2] + 1, low[1]:high[1] + 1, low[0]:high[0] + 1]
+        cropExtent = (extent[0] + low[0], extent[0] + high[0], extent[2] + low[1], extent[2] + high[1],
+                      extent[4] + low[2], extent[4] + high[2])
+        return surfaceCache.getSurfaces(surfaceKey, labelmap.GetMTime(), mask, cropExtent, ijkToRAS)
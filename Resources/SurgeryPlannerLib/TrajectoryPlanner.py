@@ -1,4 +1,6 @@
 import os
+import time
+import getpass
 import vtk
 import qt
 import ctk
@@ -6,17 +8,28 @@ import slicer
 import numpy as np
 from datetime import datetime
 import SurgeryPlannerLib.surgery_planner_helper as sh
-from .SurgeryPlannerLogic import SurgeryPlannerLogic, setSlicePoseFromSliceNormalAndPosition
+import SurgeryPlannerLib.surgery_planner_io as sio
+import SurgeryPlannerLib.surgery_planner_diff as sdiff
+from .SurgeryPlannerLogic import SurgeryPlannerLogic, setSlicePoseFromSliceNormalAndPosition, bulkOperation, \
+    deferDuringBulkOperation, CACHE_DIR
+
+# Icons are cached per file so that widgets created later (or recreated) do not read them again
+_icons = {}
+
+
+def getIcon(module_dir, name):
+    path = os.path.join(module_dir, 'Resources', 'Icons', name)
+    icon = _icons.get(path)
+    if icon is None:
+        icon = _icons[path] = qt.QIcon(path)
+    return icon
 
-try:
-    import yaml
-except ImportError:
-    yaml = None
 
 class TrajectoryPlannerWidget(qt.QWidget):
     def __init__(self, parent=None, logic=None, module_dir=None):
         super(TrajectoryPlannerWidget, self).__init__(parent)
         self.logic = logic if logic else SurgeryPlannerLogic()
+        self.ownsLogic = logic is None  # a logic created here is released by cleanup
         self.module_dir = module_dir
         if not self.module_dir:
             # Fallback if not provided, assuming standard structure
@@ -30,6 +43,8 @@ class TrajectoryPlannerWidget(qt.QWidget):
         self.trajList = np.array([])
         self.downAxisBool = False
         self.session_timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        # Set by the module widget to restore whole plans (trajectories and planes); trajectories only otherwise
+        self.restorePlanCallback = None
         
         # Load Config
         self.config = self.load_config()
@@ -38,6 +53,12 @@ class TrajectoryPlannerWidget(qt.QWidget):
         self.setup_ui()
         self.setup_scene()
 
+    def cleanup(self):
+        # Release the logic of a standalone planner (the module's logic is released by SurgeryPlannerWidget)
+        self.stopToolMonitor()
+        if self.ownsLogic:
+            self.logic.cleanup()
+
     def setup_ui(self):
         self.main_layout = qt.QVBoxLayout(self)
         
@@ -189,7 +210,7 @@ class TrajectoryPlannerWidget(qt.QWidget):
         self.moveTargetToIntersectionButton.toolTip = "Align slice intersections (hover while pressing shift may " \
                                                       "help). Click button to move target point here"
         self.moveTargetToIntersectionButton.enabled = True
-        setTargetIcon = qt.QIcon(os.path.join(self.module_dir, 'Resources/Icons/setTarget.png'))
+        setTargetIcon = getIcon(self.module_dir, 'setTarget.png')
         self.moveTargetToIntersectionButton.setIcon(setTargetIcon)
         self.moveTargetToIntersectionButton.setIconSize(qt.QSize(50,50))
         self.movePointsButtonLayout.addWidget(self.moveTargetToIntersectionButton)
@@ -199,7 +220,7 @@ class TrajectoryPlannerWidget(qt.QWidget):
         self.moveEntryToIntersectionButton.toolTip = "Align slice intersections (hover while pressing shift may " \
                                                      "help). Click button to move target point here"
         self.moveEntryToIntersectionButton.enabled = True
-        setEntryIcon = qt.QIcon(os.path.join(self.module_dir, 'Resources/Icons/setEntry.png'))
+        setEntryIcon = getIcon(self.module_dir, 'setEntry.png')
         self.moveEntryToIntersectionButton.setIcon(setEntryIcon)
         self.moveEntryToIntersectionButton.setIconSize(qt.QSize(50,50))
         x = qt.QLabel()
@@ -222,7 +243,7 @@ class TrajectoryPlannerWidget(qt.QWidget):
         """Jump To Target Point Button"""
         self.jumpToTargetButton = qt.QPushButton("View Target Point")
         self.jumpToTargetButton.toolTip = "Press to see the target point in all slices"
-        moveToTargetIcon = qt.QIcon(os.path.join(self.module_dir, 'Resources/Icons/moveToTarget.png'))
+        moveToTargetIcon = getIcon(self.module_dir, 'moveToTarget.png')
         self.jumpToTargetButton.setIcon(moveToTargetIcon)
         self.jumpToTargetButton.setIconSize(qt.QSize(50,50))
         self.jumpVizButtonsLayout.addWidget(self.jumpToTargetButton)
@@ -230,7 +251,7 @@ class TrajectoryPlannerWidget(qt.QWidget):
         """Jump To Entry Point Button"""
         self.jumpToEntryButton = qt.QPushButton("View Entry Point")
         self.jumpToEntryButton.toolTip = "Press to see the Entry point in all slices"
-        moveToEntryIcon = qt.QIcon(os.path.join(self.module_dir, 'Resources/Icons/moveToEntry.png'))
+        moveToEntryIcon = getIcon(self.module_dir, 'moveToEntry.png')
         self.jumpToEntryButton.setIcon(moveToEntryIcon)
         self.jumpToEntryButton.setIconSize(qt.QSize(50,50))
         self.jumpVizButtonsLayout.addWidget(self.jumpToEntryButton)
@@ -249,7 +270,7 @@ class TrajectoryPlannerWidget(qt.QWidget):
         self.alignAxesToASCButton = qt.QPushButton("Standard")
         self.alignAxesToASCButton.toolTip = "Returns to default axial, sagittal, coronal slice views"
 
-        standardViewIcon = qt.QIcon(os.path.join(self.module_dir, 'Resources/Icons/standard.png'))
+        standardViewIcon = getIcon(self.module_dir, 'standard.png')
         self.alignAxesToASCButton.setIcon(standardViewIcon)
         self.alignAxesToASCButton.setIconSize(qt.QSize(50, 50))
         self.sliceVizButtonsLayout.addWidget(self.alignAxesToASCButton)
@@ -259,7 +280,7 @@ class TrajectoryPlannerWidget(qt.QWidget):
         self.alignAxesToTrajectoryButton.toolTip = "Axial view switches to down-trajectory view. " \
                                                    "Other planes rotate by same amount to remain orthogonal"
 
-        downTrajIcon = qt.QIcon(os.path.join(self.module_dir, 'Resources/Icons/downTraj.png'))
+        downTrajIcon = getIcon(self.module_dir, 'downTraj.png')
         self.alignAxesToTrajectoryButton.setIcon(downTrajIcon)
         self.alignAxesToTrajectoryButton.setIconSize(qt.QSize(50, 50))
         self.sliceVizButtonsLayout.addWidget(self.alignAxesToTrajectoryButton)
@@ -287,7 +308,242 @@ class TrajectoryPlannerWidget(qt.QWidget):
         self.deleteTrajectoryButton.connect('clicked(bool)', self.onDeleteTrajectoryButton)
 
         self.toggleSliceIntersectionButton.connect('clicked(bool)', self.onToggleSliceIntersectionButton)
-        
+
+        # Tool Traversal (Trajectory)
+        traversalCollapsibleButton = ctk.ctkCollapsibleButton()
+        traversalCollapsibleButton.text = "Tool Traversal"
+        self.main_layout.addWidget(traversalCollapsibleButton)
+        traversalCollapsibleButton.setChecked(False)
+        traversalFormLayout = qt.QFormLayout(traversalCollapsibleButton)
+
+        self.traversalLabelmapSelector = slicer.qMRMLNodeComboBox()
+        self.traversalLabelmapSelector.nodeTypes = ["vtkMRMLLabelMapVolumeNode"]
+        self.traversalLabelmapSelector.addEnabled = False
+        self.traversalLabelmapSelector.removeEnabled = False
+        self.traversalLabelmapSelector.noneEnabled = True
+        self.traversalLabelmapSelector.setMRMLScene(slicer.mrmlScene)
+        self.traversalLabelmapSelector.setToolTip("Labelmap of the anatomy crossed by the tools")
+        traversalFormLayout.addRow("Labelmap:", self.traversalLabelmapSelector)
+
+        self.toolRadiusSpinBox = qt.QDoubleSpinBox()
+        self.toolRadiusSpinBox.setRange(0.05, 20.0)
+        self.toolRadiusSpinBox.setSingleStep(0.1)
+        self.toolRadiusSpinBox.setDecimals(3)
+        self.toolRadiusSpinBox.setValue(0.635)  # 18 ga needle
+        self.toolRadiusSpinBox.setSuffix(" mm")
+        traversalFormLayout.addRow("Tool Radius:", self.toolRadiusSpinBox)
+
+        self.toolLengthSpinBox = qt.QDoubleSpinBox()
+        self.toolLengthSpinBox.setRange(0.0, 500.0)
+        self.toolLengthSpinBox.setValue(0.0)
+        self.toolLengthSpinBox.setSuffix(" mm")
+        self.toolLengthSpinBox.setSpecialValueText("Entry to target")
+        traversalFormLayout.addRow("Tool Length:", self.toolLengthSpinBox)
+
+        self.corticalLabelsBox = qt.QLineEdit()
+        self.corticalLabelsBox.setPlaceholderText("e.g. 1, 2")
+        self.corticalLabelsBox.setToolTip("Labels whose contact past the first 5 mm of the path is reported as a breach")
+        traversalFormLayout.addRow("Cortical Labels:", self.corticalLabelsBox)
+
+        self.computeTraversalButton = qt.QPushButton("Compute Tool Traversal")
+        self.computeTraversalButton.toolTip = "Rasterize the tool along every trajectory and count the voxels it crosses"
+        self.computeTraversalButton.connect('clicked(bool)', self.onComputeTraversalButton)
+        traversalFormLayout.addRow(self.computeTraversalButton)
+
+        self.traversalTable = qt.QTableWidget()
+        self.traversalTable.setColumnCount(5)
+        self.traversalTable.setHorizontalHeaderLabels(["Trajectory", "First Contact (mm)", "First Label", "Breach",
+                                                       "Voxels per Label"])
+        self.traversalTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+        self.traversalTable.setMinimumHeight(120)
+        traversalFormLayout.addRow(self.traversalTable)
+
+        # Plan Repository (trajectories and reference planes stored as revisions in the local plan store)
+        repositoryCollapsibleButton = ctk.ctkCollapsibleButton()
+        repositoryCollapsibleButton.text = "Plan Repository"
+        self.main_layout.addWidget(repositoryCollapsibleButton)
+        repositoryCollapsibleButton.setChecked(False)
+        repositoryFormLayout = qt.QFormLayout(repositoryCollapsibleButton)
+
+        self.planNameBox = qt.QLineEdit()
+        self.planNameBox.text = "plan"
+        self.planNameBox.toolTip = "Name of the plan; each save adds a revision of the plan for the current series"
+        repositoryFormLayout.addRow("Plan Name:", self.planNameBox)
+
+        self.planAuthorBox = qt.QLineEdit()
+        self.planAuthorBox.text = getpass.getuser()
+        repositoryFormLayout.addRow("Author:", self.planAuthorBox)
+
+        self.planRepositoryButtonLayout = qt.QHBoxLayout()
+        self.savePlanRevisionButton = qt.QPushButton("Save Revision")
+        self.savePlanRevisionButton.toolTip = "Store the current trajectories and reference planes as a new revision"
+        self.savePlanRevisionButton.connect('clicked(bool)', self.onSavePlanRevisionButton)
+        self.planRepositoryButtonLayout.addWidget(self.savePlanRevisionButton)
+
+        self.loadPlanRevisionButton = qt.QPushButton("Load Selected")
+        self.loadPlanRevisionButton.toolTip = "Load the selected revision (Replaces current scene)"
+        self.loadPlanRevisionButton.connect('clicked(bool)', self.onLoadPlanRevisionButton)
+        self.planRepositoryButtonLayout.addWidget(self.loadPlanRevisionButton)
+
+        self.importPlanFolderButton = qt.QPushButton("Import TXT Folder")
+        self.importPlanFolderButton.toolTip = "Import all landmarks / planes TXT outputs of a folder (and subfolders)"
+        self.importPlanFolderButton.connect('clicked(bool)', self.onImportPlanFolderButton)
+        self.planRepositoryButtonLayout.addWidget(self.importPlanFolderButton)
+        repositoryFormLayout.addRow(self.planRepositoryButtonLayout)
+
+        self.planFilterBox = qt.QLineEdit()
+        self.planFilterBox.setPlaceholderText("Plan name, series / patient UID or author")
+        self.planFilterBox.connect('textChanged(QString)', self.refreshPlanTable)
+        repositoryFormLayout.addRow("Filter:", self.planFilterBox)
+
+        self.latestRevisionsCheckBox = qt.QCheckBox("Latest revision only")
+        self.latestRevisionsCheckBox.setChecked(True)
+        self.latestRevisionsCheckBox.connect('toggled(bool)', self.refreshPlanTable)
+        repositoryFormLayout.addRow(self.latestRevisionsCheckBox)
+
+        self.planTable = qt.QTableWidget()
+        self.planTable.setColumnCount(7)
+        self.planTable.setHorizontalHeaderLabels(["Plan", "Revision", "Saved", "Author", "Trajectories", "Planes",
+                                                  "Series"])
+        self.planTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+        self.planTable.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+        self.planTable.setSelectionMode(qt.QAbstractItemView.ExtendedSelection)
+        self.planTable.setMinimumHeight(150)
+        repositoryFormLayout.addRow(self.planTable)
+        self.planRows = []
+
+        # Plan diff / QA: one selected revision is compared with the scene, two selected revisions with each other
+        self.planDiffButtonLayout = qt.QHBoxLayout()
+        self.comparePlansButton = qt.QPushButton("Compare")
+        self.comparePlansButton.toolTip = ("Compare the selected revision with the scene, or two selected revisions, "
+                                           "and highlight the differences")
+        self.comparePlansButton.connect('clicked(bool)', self.onComparePlansButton)
+        self.planDiffButtonLayout.addWidget(self.comparePlansButton)
+
+        self.exportPlanDiffButton = qt.QPushButton("Export Diff Report")
+        self.exportPlanDiffButton.toolTip = "Save the last comparison as a CSV report"
+        self.exportPlanDiffButton.connect('clicked(bool)', self.onExportPlanDiffButton)
+        self.planDiffButtonLayout.addWidget(self.exportPlanDiffButton)
+
+        self.clearPlanDiffButton = qt.QPushButton("Clear Highlight")
+        self.clearPlanDiffButton.connect('clicked(bool)', self.onClearPlanDiffButton)
+        self.planDiffButtonLayout.addWidget(self.clearPlanDiffButton)
+        repositoryFormLayout.addRow(self.planDiffButtonLayout)
+
+        self.planDiffLabel = qt.QLabel("")
+        self.planDiffLabel.setWordWrap(True)
+        repositoryFormLayout.addRow(self.planDiffLabel)
+        self.planDiff = None
+        self.planDiffModel = None
+
+        # Plan Registration (maps the whole plan onto intra-operative fiducials)
+        registrationCollapsibleButton = ctk.ctkCollapsibleButton()
+        registrationCollapsibleButton.text = "Plan Registration"
+        self.main_layout.addWidget(registrationCollapsibleButton)
+        registrationCollapsibleButton.setChecked(False)
+        registrationFormLayout = qt.QFormLayout(registrationCollapsibleButton)
+
+        self.registrationMovingSelector = slicer.qMRMLNodeComboBox()
+        self.registrationMovingSelector.nodeTypes = ["vtkMRMLMarkupsFiducialNode"]
+        self.registrationMovingSelector.addEnabled = False
+        self.registrationMovingSelector.removeEnabled = False
+        self.registrationMovingSelector.noneEnabled = True
+        self.registrationMovingSelector.setMRMLScene(slicer.mrmlScene)
+        self.registrationMovingSelector.setToolTip("Fiducials in plan (pre-op image) coordinates")
+        registrationFormLayout.addRow("Pre-op Fiducials:", self.registrationMovingSelector)
+
+        self.registrationFixedSelector = slicer.qMRMLNodeComboBox()
+        self.registrationFixedSelector.nodeTypes = ["vtkMRMLMarkupsFiducialNode"]
+        self.registrationFixedSelector.addEnabled = False
+        self.registrationFixedSelector.removeEnabled = False
+        self.registrationFixedSelector.noneEnabled = True
+        self.registrationFixedSelector.setMRMLScene(slicer.mrmlScene)
+        self.registrationFixedSelector.setToolTip("The same fiducials as tracked intra-operatively. Points are paired "
+                                                  "by label when all labels match, else in order.")
+        registrationFormLayout.addRow("Intra-op Fiducials:", self.registrationFixedSelector)
+
+        self.registrationScalingCheckBox = qt.QCheckBox("Allow isotropic scaling (similarity)")
+        registrationFormLayout.addRow(self.registrationScalingCheckBox)
+
+        self.registrationModeSelector = qt.QComboBox()
+        self.registrationModeSelector.addItem("Parent transform")
+        self.registrationModeSelector.addItem("Harden into plan")
+        self.registrationModeSelector.setToolTip("Parent transform: the plan observes one 'PlanRegistration' transform "
+                                                 "(registering again replaces it). Harden: positions are moved.")
+        registrationFormLayout.addRow("Apply As:", self.registrationModeSelector)
+
+        self.registerPlanButton = qt.QPushButton("Register Plan")
+        self.registerPlanButton.toolTip = "Register all trajectories and reference planes to the intra-op fiducials"
+        self.registerPlanButton.connect('clicked(bool)', self.onRegisterPlanButton)
+        registrationFormLayout.addRow(self.registerPlanButton)
+
+        self.registrationResultLabel = qt.QLabel("")
+        registrationFormLayout.addRow("FRE:", self.registrationResultLabel)
+
+        self.registrationTable = qt.QTableWidget()
+        self.registrationTable.setColumnCount(2)
+        self.registrationTable.setHorizontalHeaderLabels(["Fiducial", "Residual (mm)"])
+        self.registrationTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+        self.registrationTable.setMinimumHeight(100)
+        registrationFormLayout.addRow(self.registrationTable)
+
+        # Tool Monitor (live deviation of a tracked tool from the planned trajectories)
+        monitorCollapsibleButton = ctk.ctkCollapsibleButton()
+        monitorCollapsibleButton.text = "Tool Monitor"
+        self.main_layout.addWidget(monitorCollapsibleButton)
+        monitorCollapsibleButton.setChecked(False)
+        monitorFormLayout = qt.QFormLayout(monitorCollapsibleButton)
+
+        self.igtlConnectLayout = qt.QHBoxLayout()
+        self.igtlHostBox = qt.QLineEdit()
+        self.igtlHostBox.text = "localhost"
+        self.igtlConnectLayout.addWidget(self.igtlHostBox)
+        self.igtlPortSpinBox = qt.QSpinBox()
+        self.igtlPortSpinBox.setRange(1, 65535)
+        self.igtlPortSpinBox.setValue(18944)
+        self.igtlConnectLayout.addWidget(self.igtlPortSpinBox)
+        self.igtlConnectButton = qt.QPushButton("Connect")
+        self.igtlConnectButton.toolTip = "Create an OpenIGTLink client connector to receive the tool pose"
+        self.igtlConnectButton.connect('clicked(bool)', self.onIgtlConnectButton)
+        self.igtlConnectLayout.addWidget(self.igtlConnectButton)
+        monitorFormLayout.addRow("OpenIGTLink:", self.igtlConnectLayout)
+
+        self.toolTransformSelector = slicer.qMRMLNodeComboBox()
+        self.toolTransformSelector.nodeTypes = ["vtkMRMLLinearTransformNode"]
+        self.toolTransformSelector.addEnabled = False
+        self.toolTransformSelector.removeEnabled = False
+        self.toolTransformSelector.noneEnabled = True
+        self.toolTransformSelector.setMRMLScene(slicer.mrmlScene)
+        self.toolTransformSelector.setToolTip("Tracked tool pose (tool to RAS), e.g. received on the IGTL connector")
+        monitorFormLayout.addRow("Tool Transform:", self.toolTransformSelector)
+
+        self.toolTipOffsetBox = qt.QLineEdit()
+        self.toolTipOffsetBox.text = "0, 0, 0"
+        self.toolTipOffsetBox.setToolTip("Tool tip position in the tool coordinates (mm)")
+        monitorFormLayout.addRow("Tip Offset:", self.toolTipOffsetBox)
+
+        self.toolAxisBox = qt.QLineEdit()
+        self.toolAxisBox.text = "0, 0, 1"
+        self.toolAxisBox.setToolTip("Tool axis (towards the tip) in the tool coordinates")
+        monitorFormLayout.addRow("Tool Axis:", self.toolAxisBox)
+
+        self.toolMonitorButton = qt.QPushButton("Start Monitoring")
+        self.toolMonitorButton.setCheckable(True)
+        self.toolMonitorButton.toolTip = ("Report the deviation of the tool from the nearest trajectory and log every "
+                                          "pose to ~/.slicer_surgery_planner/tool_logs")
+        self.toolMonitorButton.connect('toggled(bool)', self.onToolMonitorToggled)
+        monitorFormLayout.addRow(self.toolMonitorButton)
+
+        self.monitorLabels = {}
+        for key, title in (('trajectory', "Nearest Trajectory:"), ('target_mm', "Distance to Target:"),
+                           ('lateral_mm', "Lateral Offset:"), ('remaining_mm', "Remaining Depth:"),
+                           ('angle_deg', "Angular Deviation:"), ('rate', "Pose Rate:")):
+            self.monitorLabels[key] = qt.QLabel("-")
+            monitorFormLayout.addRow(title, self.monitorLabels[key])
+        self.toolMonitor = None
+        repositoryCollapsibleButton.connect('contentsCollapsed(bool)',
+                                            lambda collapsed: None if collapsed else self.refreshPlanTable())
+
         self.main_layout.addStretch(1)
 
     def setup_scene(self):
@@ -388,6 +644,270 @@ class TrajectoryPlannerWidget(qt.QWidget):
             if idx >= 0:
                 self.logic.moveEntryToIntersectionButton(self.sharedMarkupNode, idx)
 
+    def setSelectedTrajectoryTarget(self, position):
+        """Move the target point of the selected trajectory to a RAS position (e.g. a segment centroid)."""
+        if not self.selectedTraj:
+            print("[TrajectoryPlanner] No trajectory selected")
+            return
+        idx = self.sharedMarkupNode.GetControlPointIndexByID(self.selectedTraj.targetFiducialID)
+        if idx >= 0:
+            self.sharedMarkupNode.SetNthControlPointPosition(idx, position[0], position[1], position[2])
+            self.writeLandmarksToFile()
+            self.onJumpToTargetButton()
+
+    def onComputeTraversalButton(self):
+        labelmapNode = self.traversalLabelmapSelector.currentNode()
+        if not labelmapNode or not self.sharedMarkupNode:
+            print("[TrajectoryPlanner] Select a labelmap and add trajectories first")
+            return
+        try:
+            corticalLabels = [int(v) for v in self.corticalLabelsBox.text.replace(',', ' ').split()]
+        except ValueError:
+            print("[TrajectoryPlanner] Cortical labels must be integers")
+            return
+        length = self.toolLengthSpinBox.value or None
+        start = time.perf_counter()
+        trajNums, result = self.logic.computeToolTraversal(labelmapNode, self.sharedMarkupNode,
+                                                           self.toolRadiusSpinBox.value, length, corticalLabels)
+        print(f"[TrajectoryPlanner] Tool traversal of {len(trajNums)} trajectories in {time.perf_counter() - start:.2f} s")
+
+        colorNode = labelmapNode.GetDisplayNode().GetColorNode() if labelmapNode.GetDisplayNode() else None
+        labelNames = [colorNode.GetColorName(int(v)) if colorNode else str(v) for v in result['label_values']]
+        self.traversalTable.setRowCount(len(trajNums))
+        for row, num in enumerate(trajNums):
+            depth = result['first_contact_depth'][row]
+            firstLabel = int(result['first_contact_label'][row])
+            counts = ", ".join(f"{name}: {count}" for value, name, count
+                               in zip(result['label_values'], labelNames, result['label_counts'][row])
+                               if value != 0 and count)  # background is not listed
+            values = [f"Trajectory {num}",
+                      "" if np.isnan(depth) else f"{depth:.1f}",
+                      colorNode.GetColorName(firstLabel) if colorNode and firstLabel else str(firstLabel or ""),
+                      "Yes" if result['breach'][row] else "No",
+                      counts]
+            for column, value in enumerate(values):
+                self.traversalTable.setItem(row, column, qt.QTableWidgetItem(value))
+
+    def refreshPlanTable(self, *args):
+        try:
+            start = time.perf_counter()
+            rows = self.logic.getPlanStore().query(text=self.planFilterBox.text.strip() or None,
+                                                   latest_only=self.latestRevisionsCheckBox.checked)
+        except Exception as e:
+            print(f"[TrajectoryPlanner] Failed to query the plan repository: {e}")
+            return
+        self.planRows = rows
+        self.planTable.setRowCount(len(rows))
+        for r, row in enumerate(rows):
+            values = [row['name'], str(row['revision']),
+                      datetime.fromtimestamp(row['timestamp']).strftime('%Y-%m-%d %H:%M'), row['author'],
+                      str(row['trajectory_count']), str(row['plane_count']), row['series_uid']]
+            for column, value in enumerate(values):
+                self.planTable.setItem(r, column, qt.QTableWidgetItem(value))
+        print(f"[TrajectoryPlanner] Listed {len(rows)} plan revisions in {time.perf_counter() - start:.3f} s")
+
+    def onSavePlanRevisionButton(self):
+        name = self.planNameBox.text.strip()
+        if not name:
+            print("Please specify a plan name.")
+            return
+        try:
+            selectedNum = self.selectedTraj.trajNum if self.selectedTraj else None
+            metadata, arrays = self.logic.collectSessionState(self.sharedMarkupNode, selectedNum)
+            seriesUID, patientID = self.logic.getPlanIdentity()
+            revisionID = self.logic.getPlanStore().save_revision(name, metadata, arrays, seriesUID, patientID,
+                                                                 self.planAuthorBox.text.strip())
+            print(f"[TrajectoryPlanner] Saved plan '{name}' ({metadata['trajectory_count']} trajectories, "
+                  f"{metadata['plane_count']} planes) as revision {revisionID}")
+        except Exception as e:
+            print(f"[TrajectoryPlanner] Failed to save plan revision: {e}")
+            return
+        self.refreshPlanTable()
+
+    def onLoadPlanRevisionButton(self):
+        row = self.planTable.currentRow()
+        if row < 0 or row >= len(self.planRows):
+            print("Please select a plan revision to load.")
+            return
+        ret = qt.QMessageBox.warning(None, "Load Plan",
+                                     "This will remove all current landmarks and planes in the scene. "
+                                     "Do you want to proceed?",
+                                     qt.QMessageBox.Yes | qt.QMessageBox.No)
+        if ret == qt.QMessageBox.No:
+            return
+        try:
+            start = time.perf_counter()
+            metadata, arrays = self.logic.getPlanStore().load_revision(self.planRows[row]['revision_id'])
+            if self.restorePlanCallback:
+                self.restorePlanCallback(metadata, arrays)
+            else:
+                self.restoreTrajectories(arrays['trajectory_numbers'], arrays['entries'], arrays['targets'],
+                                         metadata.get('selected_trajectory'))
+            print(f"[TrajectoryPlanner] Loaded plan revision {self.planRows[row]['revision_id']} "
+                  f"in {time.perf_counter() - start:.2f} s")
+        except Exception as e:
+            print(f"[TrajectoryPlanner] Failed to load plan revision: {e}")
+
+    def onComparePlansButton(self):
+        rows = sorted({index.row() for index in self.planTable.selectionModel().selectedRows()})
+        if len(rows) not in (1, 2):
+            print("Please select one revision (compared with the scene) or two revisions.")
+            return
+        try:
+            start = time.perf_counter()
+            store = self.logic.getPlanStore()
+            # The table lists the newest revisions first: the older revision is the reference (A)
+            labels = [f"{self.planRows[r]['name']} rev {self.planRows[r]['revision']}" for r in rows]
+            planA = store.load_revision(self.planRows[rows[-1]]['revision_id'])
+            if len(rows) == 2:
+                planB = store.load_revision(self.planRows[rows[0]]['revision_id'])
+                labelA, labelB = labels[1], labels[0]
+            else:
+                planB = self.logic.collectSessionState(self.sharedMarkupNode)
+                labelA, labelB = labels[0], "Scene"
+            diff = sdiff.diff_plans(planA, planB)
+            self.planDiff = (diff, planA, planB, labelA, labelB)
+            self.planDiffModel = self.logic.showPlanDiff(diff, planA, planB, self.planDiffModel)
+        except Exception as e:
+            print(f"[TrajectoryPlanner] Failed to compare plans: {e}")
+            return
+        summary = []
+        for kind, section, key, point in (("Trajectories", diff['trajectories'], 'target_mm', "target"),
+                                          ("Planes", diff['planes'], 'translation_mm', "center")):
+            line = (f"{kind}: {len(section['index_a'])} matched ({np.count_nonzero(~section['by_name'])} renamed), "
+                    f"{len(section['removed'])} removed, {len(section['added'])} added")
+            if len(section['deltas'][key]):
+                line += f", max {point} shift {section['deltas'][key].max():.2f} mm"
+            summary.append(line)
+        self.planDiffLabel.text = f"{labelA} -> {labelB}\n" + "\n".join(summary)
+        print(f"[TrajectoryPlanner] Compared {labelA} with {labelB} in {time.perf_counter() - start:.3f} s")
+
+    def onExportPlanDiffButton(self):
+        if self.planDiff is None:
+            print("Please compare two plans first.")
+            return
+        filepath = qt.QFileDialog.getSaveFileName(None, "Export Plan Diff Report",
+                                                  os.path.join(self.outputDirSelector.currentPath, "plan_diff.csv"),
+                                                  "CSV files (*.csv)")
+        if not filepath:
+            return
+        diff, planA, planB, labelA, labelB = self.planDiff
+        try:
+            sdiff.write_report(filepath, diff, planA, planB, labelA, labelB)
+            print(f"[TrajectoryPlanner] Exported plan diff report to {filepath}")
+        except Exception as e:
+            print(f"[TrajectoryPlanner] Failed to export plan diff report: {e}")
+
+    def onClearPlanDiffButton(self):
+        if self.planDiffModel and slicer.mrmlScene.IsNodePresent(self.planDiffModel):
+            slicer.mrmlScene.RemoveNode(self.planDiffModel)
+        self.planDiffModel = None
+        self.planDiffLabel.text = ""
+
+    def onRegisterPlanButton(self):
+        movingNode = self.registrationMovingSelector.currentNode()
+        fixedNode = self.registrationFixedSelector.currentNode()
+        if not movingNode or not fixedNode or movingNode == fixedNode:
+            print("Please select the pre-op and intra-op fiducials.")
+            return
+        planNodes = slicer.util.getNodesByClass("vtkMRMLMarkupsPlaneNode")
+        if self.sharedMarkupNode:
+            planNodes += [self.sharedMarkupNode] + [traj.lineModelNode for traj in self.trajList]
+        try:
+            start = time.perf_counter()
+            labels, result = self.logic.registerPlan(movingNode, fixedNode, planNodes,
+                                                     self.registrationScalingCheckBox.checked,
+                                                     harden=self.registrationModeSelector.currentIndex == 1)
+        except Exception as e:
+            print(f"[TrajectoryPlanner] Registration failed: {e}")
+            self.registrationResultLabel.text = str(e)
+            return
+        scale = f", scale {result['scale']:.4f}" if self.registrationScalingCheckBox.checked else ""
+        self.registrationResultLabel.text = f"{result['fre']:.3f} mm RMS over {len(labels)} fiducials{scale}"
+        self.registrationTable.setRowCount(len(labels))
+        for row, (label, residual) in enumerate(zip(labels, result['residuals'])):
+            self.registrationTable.setItem(row, 0, qt.QTableWidgetItem(label))
+            self.registrationTable.setItem(row, 1, qt.QTableWidgetItem(f"{residual:.3f}"))
+        self.writeLandmarksToFile()
+        print(f"[TrajectoryPlanner] Registered plan (FRE {result['fre']:.3f} mm) in {time.perf_counter() - start:.3f} s")
+
+    def onIgtlConnectButton(self):
+        connector = sh.make_igtl_node(self.igtlHostBox.text.strip(), self.igtlPortSpinBox.value, "SurgeryPlannerIGTL")
+        print(f"[TrajectoryPlanner] Created IGTL connector {connector.GetName()} to "
+              f"{self.igtlHostBox.text.strip()}:{self.igtlPortSpinBox.value}")
+
+    def onToolMonitorToggled(self, checked):
+        if not checked:
+            self.stopToolMonitor()
+            return
+        transformNode = self.toolTransformSelector.currentNode()
+        try:
+            tipOffset = [float(v) for v in self.toolTipOffsetBox.text.replace(',', ' ').split()]
+            toolAxis = [float(v) for v in self.toolAxisBox.text.replace(',', ' ').split()]
+        except ValueError:
+            tipOffset = toolAxis = []
+        if not transformNode or len(tipOffset) != 3 or len(toolAxis) != 3 or not any(toolAxis):
+            print("[TrajectoryPlanner] Select the tool transform and enter a valid tip offset and axis")
+            self.toolMonitorButton.setChecked(False)
+            return
+
+        logDir = os.path.join(CACHE_DIR, 'tool_logs')
+        os.makedirs(logDir, exist_ok=True)
+        self.pruneToolLogs(logDir)
+        logFile = os.path.join(logDir, f"deviations_{self.session_timestamp}.bin")
+        self.toolMonitor = sh.ToolDeviationMonitor(tipOffset, toolAxis, logFile)
+        self.toolMonitor.set_trajectories(*self.logic.getTrajectoryArrays(self.sharedMarkupNode))
+        self.toolMonitor.update_listeners.append(self.onToolDeviationUpdate)
+        self.toolMonitor.attach_to_transform(transformNode)
+        self.toolMonitorButton.text = "Stop Monitoring"
+        print(f"[TrajectoryPlanner] Monitoring {transformNode.GetName()}, logging to {logFile}")
+
+    TOOL_LOGS_KEEP = 10
+
+    def pruneToolLogs(self, logDir):
+        # Keep the logs of the newest sessions (each log is a fixed-size ring buffer file)
+        names = [n for n in os.listdir(logDir) if n.startswith('deviations_') and n.endswith('.bin')]
+        logs = sorted((os.path.join(logDir, n) for n in names), key=os.path.getmtime, reverse=True)
+        current = os.path.join(logDir, f"deviations_{self.session_timestamp}.bin")
+        for filename in [f for f in logs if f != current][self.TOOL_LOGS_KEEP - 1:]:
+            try:
+                os.remove(filename)
+            except OSError as e:
+                print(f"[TrajectoryPlanner] Failed to remove old tool log {filename}: {e}")
+
+    def stopToolMonitor(self):
+        if self.toolMonitor:
+            self.toolMonitor.detach()
+            print(f"[TrajectoryPlanner] Tool monitor stopped after {self.toolMonitor.pose_count} poses")
+        self.toolMonitor = None
+        self.toolMonitorButton.text = "Start Monitoring"
+
+    def onToolDeviationUpdate(self, deviation):
+        if deviation['trajectory'] < 0:
+            self.monitorLabels['trajectory'].text = "No trajectory"
+        else:
+            self.monitorLabels['trajectory'].text = f"Trajectory {deviation['trajectory']}"
+            self.monitorLabels['target_mm'].text = f"{deviation['target_mm']:.2f} mm"
+            self.monitorLabels['lateral_mm'].text = f"{deviation['lateral_mm']:.2f} mm"
+            self.monitorLabels['remaining_mm'].text = f"{deviation['remaining_mm']:.2f} mm"
+            self.monitorLabels['angle_deg'].text = f"{deviation['angle_deg']:.2f} deg"
+        self.monitorLabels['rate'].text = f"{self.toolMonitor.pose_rate_hz:.0f} Hz"
+
+    def onImportPlanFolderButton(self):
+        directory = qt.QFileDialog.getExistingDirectory(None, "Import Plan TXT Files",
+                                                        self.loadingDirSelector.currentPath)
+        if not directory:
+            return
+        try:
+            start = time.perf_counter()
+            count = self.logic.getPlanStore().import_directory(directory, author=self.planAuthorBox.text.strip())
+            print(f"[TrajectoryPlanner] Imported {count} plan files from {directory} "
+                  f"in {time.perf_counter() - start:.2f} s")
+        except Exception as e:
+            print(f"[TrajectoryPlanner] Failed to import plans from {directory}: {e}")
+            return
+        self.refreshPlanTable()
+
     def onJumpToTargetButton(self):
         if self.selectedTraj:
             idx = self.sharedMarkupNode.GetControlPointIndexByID(self.selectedTraj.targetFiducialID)
@@ -405,8 +925,9 @@ class TrajectoryPlannerWidget(qt.QWidget):
             targetIdx = self.sharedMarkupNode.GetControlPointIndexByID(self.selectedTraj.targetFiducialID)
             entryIdx = self.sharedMarkupNode.GetControlPointIndexByID(self.selectedTraj.EntryFiducialID)
             if targetIdx >= 0 and entryIdx >= 0:
-                self.logic.alignAxesWithTrajectory(self.sharedMarkupNode, targetIdx, self.sharedMarkupNode, entryIdx)
-                self.onJumpToTargetButton()  # return crosshair to target point
+                with self.logic.sliceUpdateBatch():
+                    self.logic.alignAxesWithTrajectory(self.sharedMarkupNode, targetIdx, self.sharedMarkupNode, entryIdx)
+                    self.onJumpToTargetButton()  # return crosshair to target point
                 layoutManager = slicer.app.layoutManager()
                 threeDWidget = layoutManager.threeDWidget(0)
                 threeDView = threeDWidget.threeDView()
@@ -417,21 +938,24 @@ class TrajectoryPlannerWidget(qt.QWidget):
         if self.selectedTraj:
             idx = self.sharedMarkupNode.GetControlPointIndexByID(self.selectedTraj.targetFiducialID)
             if idx >= 0:
-                self.logic.resetAxesToASC(self.sharedMarkupNode, idx)
-                self.onJumpToTargetButton()  # return crosshair to target point
+                with self.logic.sliceUpdateBatch():
+                    self.logic.resetAxesToASC(self.sharedMarkupNode, idx)
+                    self.onJumpToTargetButton()  # return crosshair to target point
         
         self.downAxisBool = False
 
     def onTrajSelectionChange(self, index):
-        if self.selectedTraj:  # skips for delete case
-            self.onAlignAxesToASCButton()
-            self.selectedTraj.deselect()
-        # Observers are now global on the shared node, so we don't need to remove/add them per trajectory
-        if index >= 0:
-            self.selectedTraj = self.trajList[index]
-            self.addSelectedTrajObservers(self.selectedTraj)
-            self.selectedTraj.select()
-            self.onJumpToTargetButton()
+        # All slice view changes of a selection change are rendered once
+        with self.logic.sliceUpdateBatch():
+            if self.selectedTraj:  # skips for delete case
+                self.onAlignAxesToASCButton()
+                self.selectedTraj.deselect()
+            # Observers are now global on the shared node, so we don't need to remove/add them per trajectory
+            if index >= 0:
+                self.selectedTraj = self.trajList[index]
+                self.addSelectedTrajObservers(self.selectedTraj)
+                self.selectedTraj.select()
+                self.onJumpToTargetButton()
 
     def redSliceModifiedCallback(self, caller, event):
         pass
@@ -459,8 +983,9 @@ class TrajectoryPlannerWidget(qt.QWidget):
         # unless we can easily get the point ID.
         
     def onLandmarkModified(self, caller, event):
-        # Handle real-time updates if needed
-        pass
+        # The tool monitor compares poses against the current plan
+        if self.toolMonitor:
+            self.toolMonitor.set_trajectories(*self.logic.getTrajectoryArrays(self.sharedMarkupNode))
     
     def load_config(self):
         config_path = os.path.join(self.module_dir, 'Resources', 'config.yaml')
@@ -475,6 +1000,12 @@ class TrajectoryPlannerWidget(qt.QWidget):
             print(f"Config file not found at {config_path}, using defaults")
             return default_config
             
+        # yaml is optional and only needed here, so it is imported when the config is read
+        try:
+            import yaml
+        except ImportError:
+            yaml = None
+
         try:
             if yaml:
                 with open(config_path, 'r') as f:
@@ -517,6 +1048,7 @@ class TrajectoryPlannerWidget(qt.QWidget):
             print(f"Error loading config: {e}")
             return default_config
 
+    @deferDuringBulkOperation
     def writeLandmarksToFile(self, output_file=None):
         try:
             if output_file is None:
@@ -543,8 +1075,9 @@ class TrajectoryPlannerWidget(qt.QWidget):
                             if len(parts) > 1:
                                 traj_name = "traj_" + parts[-1]
                         
+                        # World coordinates, so that registered plans are saved as registered
                         pos = np.array([0.0, 0.0, 0.0])
-                        self.sharedMarkupNode.GetNthControlPointPosition(i, pos)
+                        self.sharedMarkupNode.GetNthControlPointPositionWorld(i, pos)
                         f.write(f"{traj_name},{label},{pos[0]:.4f},{pos[1]:.4f},{pos[2]:.4f}\n")
                     
             print(f"Updated landmarks in {output_file}")
@@ -583,11 +1116,27 @@ class TrajectoryPlannerWidget(qt.QWidget):
         else:
             print("No landmarks to save.")
 
+    @bulkOperation()
     def clearAllTrajectories(self):
         # Remove all trajectories
         while self.trajSelector.count > 0:
              self.onDeleteTrajectoryButton()
 
+    def restoreTrajectories(self, trajNums, entries, targets, selectedNum=None):
+        """Replace all trajectories with the given numbered trajectories ((N,3) entry / target positions, RAS)."""
+        self.ensureSharedMarkupNodeExists()
+        with bulkOperation():
+            self.clearAllTrajectories()
+            for num, entry, target in zip(trajNums, entries, targets):
+                traj = sh.SlicerTrajectoryModel(int(num), self.sharedMarkupNode, p_entry=np.array(entry),
+                                                p_target=np.array(target))
+                self.trajList = np.append(self.trajList, traj)
+                self.trajSelector.addItem("Trajectory " + str(int(num)))
+            nums = [int(num) for num in trajNums]
+            if selectedNum in nums:
+                self.trajSelector.setCurrentIndex(nums.index(selectedNum))
+            self.writeLandmarksToFile()
+
     def onLoadFromTxtButton(self):
         self.ensureSharedMarkupNodeExists()
         output_dir = self.loadingDirSelector.currentPath
@@ -607,51 +1156,9 @@ class TrajectoryPlannerWidget(qt.QWidget):
         if ret == qt.QMessageBox.No:
             return
 
-        self.clearAllTrajectories()
-
         try:
-            traj_data = {} # id -> {label: pos}
-            with open(filepath, 'r') as f:
-                for line in f:
-                    if line.startswith('#') or "Trajectory,Landmark,X,Y,Z" in line:
-                        continue
-                    parts = line.strip().split(',')
-                    if len(parts) >= 5:
-                        traj_name = parts[0] # traj_1
-                        label = parts[1] # Target_1
-                        x, y, z = float(parts[2]), float(parts[3]), float(parts[4])
-                        
-                        # Extract ID
-                        if "_" in traj_name:
-                            tid = int(traj_name.split('_')[-1])
-                            if tid not in traj_data:
-                                traj_data[tid] = {}
-                            traj_data[tid][label] = [x, y, z]
-
-            # Reconstruct
-            for tid in sorted(traj_data.keys()):
-                self.onAddTrajectoryButton() # Will create ID 1, then 2, etc. if we cleared everything
-                
-                current_traj = self.trajList[-1] # The one we just added
-                points = traj_data[tid]
-                
-                idx_target = self.sharedMarkupNode.GetControlPointIndexByID(current_traj.targetFiducialID)
-                idx_entry = self.sharedMarkupNode.GetControlPointIndexByID(current_traj.EntryFiducialID)
-                
-                target_pos = None
-                entry_pos = None
-                
-                for lbl, pos in points.items():
-                    if "Target" in lbl:
-                        target_pos = pos
-                    elif "Entry" in lbl:
-                        entry_pos = pos
-                
-                if target_pos and idx_target >= 0:
-                    self.sharedMarkupNode.SetNthControlPointPosition(idx_target, target_pos[0], target_pos[1], target_pos[2])
-                if entry_pos and idx_entry >= 0:
-                    self.sharedMarkupNode.SetNthControlPointPosition(idx_entry, entry_pos[0], entry_pos[1], entry_pos[2])
-            
+            landmarks = sio.read_landmarks_file(filepath)
+            self.restoreTrajectories(landmarks['trajectory_numbers'], landmarks['entries'], landmarks['targets'])
             print(f"Loaded landmarks from {filepath}")
 
         except Exception as e:
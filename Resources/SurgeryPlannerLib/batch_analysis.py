@@ -0,0 +1,293 @@
+""" batch_analysis
+Retrospective analysis of archived plans from the command line (no Slicer needed):
+
+    cd SurgeryPlanner/Resources
+    python -m SurgeryPlannerLib.batch_analysis CASES_DIR RESULTS.npz [--workers N] [--max-tasks-per-child N]
+                                                                     [--memory-limit-mb MB]
+
+Every directory under CASES_DIR holding landmarks and / or planes files (the planners' TXT outputs or the .npz planes
+equivalent) is a case; each landmarks file of a case is analyzed against all plane files of the case. Tasks run on a
+process pool whose workers are recycled after --max-tasks-per-child tasks (and optionally capped in memory). Each
+finished task writes its rows to RESULTS.parts/ and is logged to RESULTS.manifest.jsonl, so an interrupted run resumes
+where it stopped and unchanged cases are not analyzed again. The results of all cases are then consolidated into one
+columnar .npz file with "<table>.<column>" arrays for the tables:
+
+    trajectories - case, source, trajectory, length_mm, direction_x/y/z, angle_r/a/s_deg (to the patient axes),
+                   nearest_trajectory, min_clearance_mm (closest approach to another trajectory), min_angle_deg
+    planes       - case, source, plane, center_x/y/z, normal_x/y/z, width, height, min_plane_angle_deg
+    crossings    - case, source, trajectory, plane, x, y, z, depth_fraction, in_bounds, angle_deg
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from . import surgery_planner_io as sio
+from . import surgery_planner_geometry as sg
+
+TABLES = {
+    'trajectories': ('case', 'source', 'trajectory', 'length_mm', 'direction_x', 'direction_y', 'direction_z',
+                     'angle_r_deg', 'angle_a_deg', 'angle_s_deg', 'nearest_trajectory', 'min_clearance_mm',
+                     'min_angle_deg'),
+    'planes': ('case', 'source', 'plane', 'center_x', 'center_y', 'center_z', 'normal_x', 'normal_y', 'normal_z',
+               'width', 'height', 'min_plane_angle_deg'),
+    'crossings': ('case', 'source', 'trajectory', 'plane', 'x', 'y', 'z', 'depth_fraction', 'in_bounds',
+                  'angle_deg'),
+}
+
+
+def _is_planes_npz(filename):
+    try:
+        with np.load(filename, allow_pickle=False) as data:
+            return 'matrices' in data.files and 'names' in data.files
+    except Exception:
+        return False
+
+
+def _signature(filenames):
+    # Changes whenever one of the input files is modified, replaced or removed
+    parts = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        parts.append(f"{os.path.basename(filename)}|{stat.st_size}|{stat.st_mtime_ns}")
+    return hashlib.sha1("\n".join(parts).encode()).hexdigest()
+
+
+def find_tasks(cases_dir):
+    """Scan a case archive. OUTPUT: list of task dicts (task id, case, landmarks file or None, plane files, signature)"""
+    tasks = []
+    for root, dirs, names in os.walk(cases_dir):
+        dirs.sort()
+        landmarks = []
+        planes = []
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            extension = os.path.splitext(name)[1].lower()
+            if extension == '.txt':
+                kind = sio.detect_plan_file(path)
+            elif extension == '.npz':
+                kind = 'planes' if _is_planes_npz(path) else None
+            else:
+                continue
+            if kind == 'landmarks':
+                landmarks.append(path)
+            elif kind == 'planes':
+                planes.append(path)
+        if not landmarks and not planes:
+            continue
+        case = os.path.relpath(root, cases_dir)
+        for landmarks_file in landmarks or [None]:
+            inputs = ([landmarks_file] if landmarks_file else []) + planes
+            tasks.append({'task': os.path.relpath(landmarks_file, cases_dir) if landmarks_file else case,
+                          'case': case, 'landmarks': landmarks_file, 'planes': planes, 'signature': _signature(inputs)})
+    return tasks
+
+
+def _read_planes(filenames):
+    names, matrices, sizes = [], [np.zeros((0, 4, 4))], [np.zeros((0, 2))]
+    for filename in filenames:
+        planes = sio.read_planes_file(filename)
+        plane_matrices = planes['matrices']
+        if planes['coordinate_system'] == 'LPS':
+            plane_matrices = sio.convert_matrices_lps_ras(plane_matrices)
+        names += planes['names']
+        matrices.append(plane_matrices)
+        sizes.append(planes['sizes'])
+    return names, np.concatenate(matrices), np.concatenate(sizes)
+
+
+def _min_off_diagonal(values):
+    # Per row minimum and its column, ignoring the diagonal (nan / -1 when there is no other item)
+    if len(values) < 2:
+        return np.full(len(values), np.nan), np.full(len(values), -1)
+    values = values + np.diag(np.full(len(values), np.inf))
+    index = np.argmin(values, axis=1)
+    return values[np.arange(len(values)), index], index
+
+
+def analyze_task(task):
+    """Compute the metrics of one task. OUTPUT: dict table name -> dict of equal-length columns (see TABLES)"""
+    if task['landmarks']:
+        landmarks = sio.read_landmarks_file(task['landmarks'])
+        numbers, entries, targets = landmarks['trajectory_numbers'], landmarks['entries'], landmarks['targets']
+    else:
+        numbers, entries, targets = np.zeros(0, dtype=np.int32), np.zeros((0, 3)), np.zeros((0, 3))
+    plane_names, plane_matrices, plane_sizes = _read_planes(task['planes'])
+    n, m = len(numbers), len(plane_names)
+    source = os.path.basename(task['landmarks']) if task['landmarks'] else ''
+
+    directions = targets - entries
+    lengths = np.linalg.norm(directions, axis=1)
+    unit = directions / np.maximum(lengths, 1e-12)[:, np.newaxis]
+    clearances, _, _ = sg.segment_distances(entries, targets)
+    min_clearance, nearest = _min_off_diagonal(clearances)
+    min_angle, _ = _min_off_diagonal(np.degrees(np.arccos(np.clip(unit @ unit.T, -1.0, 1.0))))
+    axis_angles = np.degrees(np.arccos(np.clip(np.abs(unit), 0.0, 1.0)))
+    trajectories = {
+        'case': np.full(n, task['case']), 'source': np.full(n, source), 'trajectory': numbers.astype(np.int32),
+        'length_mm': lengths, 'direction_x': unit[:, 0], 'direction_y': unit[:, 1], 'direction_z': unit[:, 2],
+        'angle_r_deg': axis_angles[:, 0], 'angle_a_deg': axis_angles[:, 1], 'angle_s_deg': axis_angles[:, 2],
+        'nearest_trajectory': np.where(nearest >= 0, numbers[np.maximum(nearest, 0)], -1),
+        'min_clearance_mm': min_clearance, 'min_angle_deg': min_angle,
+    }
+
+    centers, axes = sg.plane_frames(plane_matrices)
+    normals = axes[:, :, 2]
+    # Planes are unoriented: the angle between two planes is within [0, 90]
+    min_plane_angle, _ = _min_off_diagonal(np.degrees(np.arccos(np.clip(np.abs(normals @ normals.T), 0.0, 1.0))))
+    planes = {
+        'case': np.full(m, task['case']), 'source': np.full(m, source), 'plane': np.array(plane_names, dtype=str),
+        'center_x': centers[:, 0], 'center_y': centers[:, 1], 'center_z': centers[:, 2],
+        'normal_x': normals[:, 0], 'normal_y': normals[:, 1], 'normal_z': normals[:, 2],
+        'width': plane_sizes[:, 0], 'height': plane_sizes[:, 1], 'min_plane_angle_deg': min_plane_angle,
+    }
+
+    table = sg.IntersectionTable(numbers, entries, targets, plane_names, plane_matrices, plane_sizes).columns()
+    crossings = {
+        'case': np.full(n * m, task['case']), 'source': np.full(n * m, source),
+        'trajectory': np.repeat(numbers.astype(np.int32), m), 'plane': table['Plane'],
+        'x': table['X'], 'y': table['Y'], 'z': table['Z'], 'depth_fraction': table['DepthFraction'],
+        'in_bounds': table['InBounds'], 'angle_deg': table['AngleDeg'],
+    }
+    return {'trajectories': trajectories, 'planes': planes, 'crossings': crossings}
+
+
+def _part_filename(parts_dir, task):
+    return os.path.join(parts_dir, hashlib.sha1(task['task'].encode()).hexdigest() + '.npz')
+
+
+def run_task(task, parts_dir):
+    """Analyze a task and write its rows to a part file (in the worker, so only a small summary is sent back)."""
+    start = time.perf_counter()
+    entry = {'task': task['task'], 'signature': task['signature']}
+    try:
+        tables = analyze_task(task)
+        part = _part_filename(parts_dir, task)
+        with open(part + '.tmp', 'wb') as f:
+            np.savez(f, **{f"{table}.{column}": values for table, columns in tables.items()
+                           for column, values in columns.items()})
+        os.replace(part + '.tmp', part)
+        entry.update(status='done', part=os.path.basename(part), rows=len(tables['trajectories']['trajectory']))
+    except Exception as e:
+        entry.update(status='failed', error=f"{type(e).__name__}: {e}")
+    entry['seconds'] = round(time.perf_counter() - start, 4)
+    return entry
+
+
+def _limit_worker_memory(memory_limit_mb):
+    # Worker initializer: cap the address space so that a runaway case fails alone instead of exhausting the machine
+    try:
+        import resource
+    except ImportError:  # not available on Windows
+        return
+    limit = int(memory_limit_mb) * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def read_manifest(filename):
+    """Return the last manifest entry of every task."""
+    entries = {}
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:  # line cut by an interrupted run
+                    continue
+                entries[entry['task']] = entry
+    return entries
+
+
+def consolidate(parts, output):
+    """Concatenate the part files of all tasks into one columnar .npz file."""
+    columns = {f"{table}.{column}": [] for table, names in TABLES.items() for column in names}
+    for part in parts:
+        with np.load(part, allow_pickle=False) as data:
+            for key in columns:
+                columns[key].append(data[key])
+    arrays = {key: np.concatenate(values) if values else np.zeros(0) for key, values in columns.items()}
+    with open(output + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(output + '.tmp', output)
+    return arrays
+
+
+def run_batch(cases_dir, output, workers=None, max_tasks_per_child=20, memory_limit_mb=None, manifest=None,
+              executable=None):
+    """Analyze all cases of an archive (see the module docstring). OUTPUT: dict of done / skipped / failed counts"""
+    manifest = manifest or output + '.manifest.jsonl'
+    parts_dir = output + '.parts'
+    os.makedirs(parts_dir, exist_ok=True)
+    tasks = find_tasks(cases_dir)
+    previous = read_manifest(manifest)
+
+    def is_done(task):
+        entry = previous.get(task['task'])
+        return entry is not None and entry['status'] == 'done' and entry['signature'] == task['signature'] and \
+            os.path.exists(os.path.join(parts_dir, entry['part']))
+
+    pending = [task for task in tasks if not is_done(task)]
+    counts = {'done': 0, 'skipped': len(tasks) - len(pending), 'failed': 0}
+    print(f"[batch_analysis] {len(tasks)} tasks in {cases_dir}, {counts['skipped']} already done")
+
+    start = time.perf_counter()
+    with open(manifest, 'a') as log:
+        def record(entry):
+            log.write(json.dumps(entry) + "\n")
+            log.flush()
+            counts[entry['status']] += 1
+            finished = counts['done'] + counts['failed']
+            message = entry.get('error', f"{entry.get('rows', 0)} trajectories")
+            print(f"[batch_analysis] {finished}/{len(pending)} {entry['task']}: {entry['status']} ({message}, "
+                  f"{entry['seconds']:.2f} s)")
+
+        workers = workers or os.cpu_count() or 1
+        if workers == 1 or len(pending) <= 1:
+            for task in pending:
+                record(run_task(task, parts_dir))
+        else:
+            context = multiprocessing.get_context('spawn')
+            if executable:
+                context.set_executable(executable)
+            initializer, initargs = (_limit_worker_memory, (memory_limit_mb,)) if memory_limit_mb else (None, ())
+            # Worker recycling needs Python 3.11 (Slicer 5.10 ships 3.12)
+            recycling = {'max_tasks_per_child': max_tasks_per_child} if sys.version_info >= (3, 11) else {}
+            with ProcessPoolExecutor(max_workers=min(workers, len(pending)), mp_context=context,
+                                     initializer=initializer, initargs=initargs, **recycling) as pool:
+                futures = [pool.submit(run_task, task, parts_dir) for task in pending]
+                for future in as_completed(futures):
+                    record(future.result())
+
+    entries = read_manifest(manifest)
+    parts = [os.path.join(parts_dir, entries[task['task']]['part']) for task in sorted(tasks, key=lambda t: t['task'])
+             if entries.get(task['task'], {}).get('status') == 'done']
+    arrays = consolidate(parts, output)
+    print(f"[batch_analysis] Wrote {len(arrays['trajectories.trajectory'])} trajectories of {len(parts)} tasks to "
+          f"{output} in {time.perf_counter() - start:.1f} s ({counts['failed']} failed)")
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m SurgeryPlannerLib.batch_analysis',
+                                     description="Compute trajectory and plane metrics over a directory of cases.")
+    parser.add_argument('cases_dir', help="directory of cases (searched recursively for landmarks / planes files)")
+    parser.add_argument('output', help="consolidated results (.npz)")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('--max-tasks-per-child', type=int, default=20,
+                        help="tasks run by a worker before it is replaced (bounds memory growth)")
+    parser.add_argument('--memory-limit-mb', type=int, default=None, help="address space limit per worker (POSIX)")
+    parser.add_argument('--manifest', default=None, help="progress manifest (default: OUTPUT.manifest.jsonl)")
+    args = parser.parse_args(argv)
+    output = args.output if args.output.lower().endswith('.npz') else args.output + '.npz'
+    counts = run_batch(args.cases_dir, output, args.workers, args.max_tasks_per_child, args.memory_limit_mb,
+                       args.manifest)
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+""" surgery_planner_diff
+Comparison of two plans (e.g. a resident's and an attending's, or two revisions of the same plan) for QA.
+
+Plans are (metadata, arrays) pairs as stored in session snapshots and the plan repository (see
+SurgeryPlannerLogic.collectSessionState). Trajectories and planes are matched by name first; items left over
+(renamed) are matched by minimum total distance. Like surgery_planner_io, this module does not depend on Slicer:
+
+    python -m SurgeryPlannerLib.surgery_planner_diff -a points_a.txt planes_a.txt -b points_b.txt planes_b.txt \
+        -o report.csv
+"""
+
+import sys
+import argparse
+import numpy as np
+from . import surgery_planner_io as sio
+from . import surgery_planner_geometry as sg
+from . import surgery_planner_store as sps
+
+REPORT_COLUMNS = ('Type', 'NameA', 'NameB', 'Status', 'EntryMM', 'TargetMM', 'AngleDeg', 'LengthMM',
+                  'TranslationMM', 'RotationDeg', 'NormalDeg', 'WidthMM', 'HeightMM')
+
+
+def _trajectory_names(arrays):
+    return [f"Trajectory {n}" for n in arrays['trajectory_numbers']]
+
+
+def _unmatched(count, matched):
+    return np.setdiff1d(np.arange(count), matched)
+
+
+def diff_plans(plan_a, plan_b, max_match_mm=20.0, plane_angle_weight=1.0):
+    """Compare two plans.
+    INPUT:  plan_a, plan_b     [(metadata, arrays)]
+            max_match_mm       [float] - renamed items further apart than this are reported as removed / added
+            plane_angle_weight [float] - mm of cost per degree between plane normals when matching renamed planes
+    OUTPUT: dict with keys 'trajectories' and 'planes', each a dict of
+              index_a, index_b [(K,) int]  - matched items
+              by_name          [(K,) bool] - False for renamed items matched by distance
+              deltas           [dict]      - sg.trajectory_deltas / sg.plane_pose_deltas of the matched items
+              removed, added   [int array] - items only in plan a / plan b
+    """
+    (metadata_a, arrays_a), (metadata_b, arrays_b) = plan_a, plan_b
+    entries_a, targets_a = arrays_a['entries'], arrays_a['targets']
+    entries_b, targets_b = arrays_b['entries'], arrays_b['targets']
+
+    def trajectory_cost(rest_a, rest_b):
+        return 0.5 * (sg.pairwise_distances(entries_a[rest_a], entries_b[rest_b]) +
+                      sg.pairwise_distances(targets_a[rest_a], targets_b[rest_b]))
+
+    names_a, names_b = _trajectory_names(arrays_a), _trajectory_names(arrays_b)
+    index_a, index_b, by_name = sg.match_items(names_a, names_b, trajectory_cost, max_match_mm)
+    trajectories = {
+        'index_a': index_a, 'index_b': index_b, 'by_name': by_name,
+        'deltas': sg.trajectory_deltas(entries_a[index_a], targets_a[index_a], entries_b[index_b], targets_b[index_b]),
+        'removed': _unmatched(len(names_a), index_a), 'added': _unmatched(len(names_b), index_b),
+    }
+
+    centers_a, axes_a = sg.plane_frames(arrays_a['plane_matrices'])
+    centers_b, axes_b = sg.plane_frames(arrays_b['plane_matrices'])
+
+    def plane_cost(rest_a, rest_b):
+        cosine = np.abs(axes_a[rest_a, :, 2] @ axes_b[rest_b, :, 2].T)
+        return sg.pairwise_distances(centers_a[rest_a], centers_b[rest_b]) + \
+            plane_angle_weight * np.degrees(np.arccos(np.clip(cosine, 0.0, 1.0)))
+
+    index_a, index_b, by_name = sg.match_items(metadata_a['plane_names'], metadata_b['plane_names'], plane_cost,
+                                               max_match_mm)
+    planes = {
+        'index_a': index_a, 'index_b': index_b, 'by_name': by_name,
+        'deltas': sg.plane_pose_deltas(arrays_a['plane_matrices'][index_a], arrays_a['plane_sizes'][index_a],
+                                       arrays_b['plane_matrices'][index_b], arrays_b['plane_sizes'][index_b]),
+        'removed': _unmatched(len(metadata_a['plane_names']), index_a),
+        'added': _unmatched(len(metadata_b['plane_names']), index_b),
+    }
+    return {'trajectories': trajectories, 'planes': planes}
+
+
+def report_columns(diff, plan_a, plan_b):
+    """Flatten a diff into report columns (one row per matched, removed or added item; nan where not applicable)."""
+    rows = {'Type': [], 'NameA': [], 'NameB': [], 'Status': []}
+    values = {column: [] for column in REPORT_COLUMNS[4:]}
+    sections = (('Trajectory', diff['trajectories'], _trajectory_names(plan_a[1]), _trajectory_names(plan_b[1]),
+                 {'EntryMM': 'entry_mm', 'TargetMM': 'target_mm', 'AngleDeg': 'angle_deg', 'LengthMM': 'length_mm'}),
+                ('Plane', diff['planes'], plan_a[0]['plane_names'], plan_b[0]['plane_names'],
+                 {'TranslationMM': 'translation_mm', 'RotationDeg': 'rotation_deg', 'NormalDeg': 'normal_deg',
+                  'WidthMM': 'width_mm', 'HeightMM': 'height_mm'}))
+    for kind, section, names_a, names_b, delta_columns in sections:
+        matched, removed, added = len(section['index_a']), len(section['removed']), len(section['added'])
+        count = matched + removed + added
+        rows['Type'] += [kind] * count
+        rows['NameA'] += [names_a[i] for i in section['index_a']] + [names_a[i] for i in section['removed']] + \
+            [''] * added
+        rows['NameB'] += [names_b[i] for i in section['index_b']] + [''] * removed + \
+            [names_b[i] for i in section['added']]
+        rows['Status'] += np.where(section['by_name'], 'matched', 'renamed').tolist() + ['removed'] * removed + \
+            ['added'] * added
+        for column in values:
+            column_values = np.full(count, np.nan)
+            if column in delta_columns:
+                column_values[:matched] = section['deltas'][delta_columns[column]]
+            values[column].append(column_values)
+    columns = {column: np.array(rows[column], dtype=str) for column in rows}
+    columns.update({column: np.concatenate(parts) for column, parts in values.items()})
+    return columns
+
+
+def write_report(filename, diff, plan_a, plan_b, label_a='A', label_b='B'):
+    """Write the diff report as CSV (see report_columns) with a summary in the header comments."""
+    trajectories, planes = diff['trajectories'], diff['planes']
+    comments = [f"SurgeryPlanner Plan Diff: {label_a} -> {label_b}",
+                f"Trajectories: {len(trajectories['index_a'])} matched "
+                f"({np.count_nonzero(~trajectories['by_name'])} renamed), {len(trajectories['removed'])} removed, "
+                f"{len(trajectories['added'])} added",
+                f"Planes: {len(planes['index_a'])} matched ({np.count_nonzero(~planes['by_name'])} renamed), "
+                f"{len(planes['removed'])} removed, {len(planes['added'])} added"]
+    sio.write_table_csv(filename, report_columns(diff, plan_a, plan_b), comments)
+
+
+def read_plan_files(filenames):
+    """Combine landmarks / planes TXT outputs into one plan (metadata, arrays)."""
+    plans = []
+    for filename in filenames:
+        plan = sps.read_plan_file(filename)
+        if plan is None:
+            raise ValueError(f"{filename} is not a landmarks or planes file")
+        plans.append(plan[:2])
+    return sps.combine_plans(plans)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m SurgeryPlannerLib.surgery_planner_diff',
+                                     description="Compare the landmarks / planes outputs of two plans.")
+    parser.add_argument('-a', nargs='+', required=True, help="landmarks and / or planes files of the first plan")
+    parser.add_argument('-b', nargs='+', required=True, help="landmarks and / or planes files of the second plan")
+    parser.add_argument('-o', '--output', required=True, help="report (CSV)")
+    parser.add_argument('--max-match-mm', type=float, default=20.0,
+                        help="renamed items further apart than this are reported as removed / added")
+    args = parser.parse_args(argv)
+    plan_a, plan_b = read_plan_files(args.a), read_plan_files(args.b)
+    diff = diff_plans(plan_a, plan_b, args.max_match_mm)
+    write_report(args.output, diff, plan_a, plan_b, " ".join(args.a), " ".join(args.b))
+    print(f"[surgery_planner_diff] Wrote {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
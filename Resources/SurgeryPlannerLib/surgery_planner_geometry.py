@@ -0,0 +1,685 @@
+""" surgery_planner_geometry
+Vectorized geometry on trajectories (entry/target segments) and reference planes (Object-to-World matrices).
+
+Everything in this module works on stacked numpy arrays and only depends on numpy so that it can be used
+outside of Slicer (e.g. batch scripts). scipy is used for optimal assignments when it is available.
+"""
+
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+
+def plane_frames(plane_matrices):
+    """Split (M,4,4) Object-to-World matrices into centers (M,3) and unit axes (M,3,3) (axes are columns)."""
+    plane_matrices = np.asarray(plane_matrices, dtype=float).reshape(-1, 4, 4)
+    axes = plane_matrices[:, :3, :3]
+    axes = axes / np.maximum(np.linalg.norm(axes, axis=1, keepdims=True), 1e-12)
+    return plane_matrices[:, :3, 3], axes
+
+
+def intersect_segments_with_planes(entries, targets, plane_matrices, plane_sizes, eps=1e-9):
+    """Intersect every trajectory segment with every reference plane in one broadcast operation.
+    INPUT:  entries        [(N,3) array]   - trajectory entry points
+            targets        [(N,3) array]   - trajectory target points
+            plane_matrices [(M,4,4) array] - plane Object-to-World matrices (z axis is the plane normal)
+            plane_sizes    [(M,2) array]   - plane width, height
+    OUTPUT: dict of arrays
+            points     [(N,M,3)] - intersection of the trajectory line with the plane (nan if parallel)
+            t          [(N,M)]   - position along the segment (0 at entry, 1 at target)
+            on_segment [(N,M)]   - intersection lies between entry and target
+            in_bounds  [(N,M)]   - intersection lies on the segment and inside the plane's width x height
+            angle_deg  [(N,M)]   - crossing angle between trajectory and plane (90 = perpendicular)
+    """
+    entries = np.asarray(entries, dtype=float).reshape(-1, 3)
+    targets = np.asarray(targets, dtype=float).reshape(-1, 3)
+    plane_sizes = np.asarray(plane_sizes, dtype=float).reshape(-1, 2)
+    centers, axes = plane_frames(plane_matrices)
+    normals = axes[:, :, 2]
+
+    directions = targets - entries
+    denom = directions @ normals.T
+    num = np.sum(normals * centers, axis=1)[np.newaxis, :] - entries @ normals.T
+    parallel = np.abs(denom) < eps
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(parallel, np.nan, num / np.where(parallel, 1.0, denom))
+
+    points = entries[:, np.newaxis, :] + t[:, :, np.newaxis] * directions[:, np.newaxis, :]
+    local = np.einsum('nmk,mkj->nmj', points - centers[np.newaxis, :, :], axes)
+    with np.errstate(invalid='ignore'):
+        on_segment = (t >= 0.0) & (t <= 1.0)
+        in_bounds = on_segment & (np.abs(local[:, :, 0]) <= plane_sizes[np.newaxis, :, 0] / 2.0) \
+                    & (np.abs(local[:, :, 1]) <= plane_sizes[np.newaxis, :, 1] / 2.0)
+
+    lengths = np.maximum(np.linalg.norm(directions, axis=1), eps)
+    sin_angle = np.clip(np.abs(denom) / lengths[:, np.newaxis], 0.0, 1.0)
+    angle_deg = np.degrees(np.arcsin(sin_angle))
+    return {'points': points, 't': t, 'on_segment': on_segment, 'in_bounds': in_bounds, 'angle_deg': angle_deg}
+
+
+def segment_distances(entries, targets, eps=1e-12):
+    """Closest approach between every pair of trajectory segments (e.g. clearance between two tools).
+    INPUT:  entries [(N,3) array] - trajectory entry points
+            targets [(N,3) array] - trajectory target points
+    OUTPUT: distances [(N,N) array] - minimum distance between segment i and segment j
+            s         [(N,N) array] - position of the closest point along segment i (0 at entry, 1 at target)
+            t         [(N,N) array] - position of the closest point along segment j
+    """
+    entries = np.asarray(entries, dtype=float).reshape(-1, 3)
+    directions = np.asarray(targets, dtype=float).reshape(-1, 3) - entries
+    r = entries[:, np.newaxis, :] - entries[np.newaxis, :, :]
+    a = np.sum(directions * directions, axis=1)[:, np.newaxis]
+    e = np.sum(directions * directions, axis=1)[np.newaxis, :]
+    b = directions @ directions.T
+    c = np.einsum('ik,ijk->ij', directions, r)
+    f = np.einsum('jk,ijk->ij', directions, r)
+    a_safe = np.where(a > eps, a, 1.0)
+    e_safe = np.where(e > eps, e, 1.0)
+
+    # Closest points of the two lines, clamped to the segments (Ericson, Real-Time Collision Detection 5.1.9)
+    denom = a * e - b * b
+    non_parallel = denom > eps * np.maximum(a * e, eps)
+    s = np.where(non_parallel, np.clip((b * f - c * e) / np.where(non_parallel, denom, 1.0), 0.0, 1.0), 0.0)
+    t = (b * s + f) / e_safe
+    s = np.where(t < 0.0, np.clip(-c / a_safe, 0.0, 1.0), np.where(t > 1.0, np.clip((b - c) / a_safe, 0.0, 1.0), s))
+    t = np.clip(t, 0.0, 1.0)
+    # Degenerate (zero-length) segments are points
+    s = np.where(e <= eps, np.clip(-c / a_safe, 0.0, 1.0), s)
+    s = np.where(a <= eps, 0.0, s)
+    t = np.where(e <= eps, 0.0, np.where(a <= eps, np.clip(f / e_safe, 0.0, 1.0), t))
+
+    closest = r + s[:, :, np.newaxis] * directions[:, np.newaxis, :] - t[:, :, np.newaxis] * directions[np.newaxis, :, :]
+    return np.linalg.norm(closest, axis=2), s, t
+
+
+class IntersectionTable:
+    """All-pairs trajectory x plane intersections that can be updated one row / column at a time.
+    Row i is trajectory i, column j is plane j. Use update_trajectory / update_plane when a single item moves;
+    anything that changes the number of items should call set_all again."""
+
+    _fields = ('points', 't', 'on_segment', 'in_bounds', 'angle_deg')
+
+    def __init__(self, trajectory_names, entries, targets, plane_names, plane_matrices, plane_sizes):
+        self.set_all(trajectory_names, entries, targets, plane_names, plane_matrices, plane_sizes)
+
+    def set_all(self, trajectory_names, entries, targets, plane_names, plane_matrices, plane_sizes):
+        self.trajectory_names = list(trajectory_names)
+        self.plane_names = list(plane_names)
+        self.entries = np.array(entries, dtype=float).reshape(-1, 3)
+        self.targets = np.array(targets, dtype=float).reshape(-1, 3)
+        self.plane_matrices = np.array(plane_matrices, dtype=float).reshape(-1, 4, 4)
+        self.plane_sizes = np.array(plane_sizes, dtype=float).reshape(-1, 2)
+        self.results = intersect_segments_with_planes(self.entries, self.targets,
+                                                      self.plane_matrices, self.plane_sizes)
+
+    def update_trajectory(self, i, entry, target):
+        """Recompute row i after trajectory i moved."""
+        self.entries[i] = entry
+        self.targets[i] = target
+        row = intersect_segments_with_planes(self.entries[i:i + 1], self.targets[i:i + 1],
+                                             self.plane_matrices, self.plane_sizes)
+        for key in self._fields:
+            self.results[key][i] = row[key][0]
+
+    def update_plane(self, j, matrix, size):
+        """Recompute column j after plane j moved or was resized."""
+        self.plane_matrices[j] = matrix
+        self.plane_sizes[j] = size
+        column = intersect_segments_with_planes(self.entries, self.targets,
+                                                self.plane_matrices[j:j + 1], self.plane_sizes[j:j + 1])
+        for key in self._fields:
+            self.results[key][:, j] = column[key][:, 0]
+
+    def columns(self):
+        """Return the table as flat columns (one row per trajectory / plane pair)."""
+        n, m = len(self.trajectory_names), len(self.plane_names)
+        points = self.results['points'].reshape(n * m, 3)
+        return {
+            'Trajectory': np.repeat(np.array(self.trajectory_names, dtype=str), m),
+            'Plane': np.tile(np.array(self.plane_names, dtype=str), n),
+            'X': points[:, 0],
+            'Y': points[:, 1],
+            'Z': points[:, 2],
+            'DepthFraction': self.results['t'].ravel(),
+            'OnSegment': self.results['on_segment'].ravel(),
+            'InBounds': self.results['in_bounds'].ravel(),
+            'AngleDeg': self.results['angle_deg'].ravel(),
+        }
+
+
+def transform_points(matrix, points):
+    """Apply a 4x4 homogeneous matrix to (N,3) points with one matmul."""
+    matrix = np.asarray(matrix, dtype=float)
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    return points @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def plane_corners(plane_matrices, plane_sizes):
+    """Return the (M,4,3) corner points of the plane rectangles."""
+    centers, axes = plane_frames(plane_matrices)
+    half = np.asarray(plane_sizes, dtype=float).reshape(-1, 2) / 2.0
+    signs = np.array([[-1.0, -1.0], [-1.0, 1.0], [1.0, -1.0], [1.0, 1.0]])
+    offsets_x = (signs[np.newaxis, :, 0] * half[:, np.newaxis, 0])[:, :, np.newaxis] * axes[:, np.newaxis, :, 0]
+    offsets_y = (signs[np.newaxis, :, 1] * half[:, np.newaxis, 1])[:, :, np.newaxis] * axes[:, np.newaxis, :, 1]
+    return centers[:, np.newaxis, :] + offsets_x + offsets_y
+
+
+def _ijk_box(ras_to_ijk, points, shape_kji):
+    # Inclusive [min, max] IJK box of the points, clipped to the volume
+    ijk = transform_points(ras_to_ijk, points)
+    box_min = np.maximum(np.floor(ijk.min(axis=0)).astype(int), 0)
+    box_max = np.minimum(np.ceil(ijk.max(axis=0)).astype(int), np.array(shape_kji[::-1]) - 1)
+    return box_min, box_max
+
+
+def halfspace_region_stats(mask, ijk_to_ras, plane_matrices, plane_sizes, mode='between', depth=None):
+    """Volume and centroid of the voxels of mask that lie in a region bounded by planes.
+    INPUT:  mask           [(K,J,I) bool array] - voxels of interest (e.g. bone), in numpy (k, j, i) order
+            ijk_to_ras     [(4,4) array]        - volume IJK to RAS matrix
+            plane_matrices [(M,4,4) array]      - plane Object-to-World matrices (z axis is the normal)
+            plane_sizes    [(M,2) array]        - plane width, height
+            mode           [str]                - 'between': on the side of each plane facing the other planes
+                                                  'above' / 'below': on the normal / opposite side of every plane
+                                                  In all modes the region is limited to each plane rectangle swept
+                                                  `depth` mm along the normal (towards the region), so the result
+                                                  does not depend on how the planes sit in the voxel grid
+            depth          [float]              - sweep depth (default: largest plane size for 'above' / 'below',
+                                                  twice the largest distance between plane corners for 'between')
+    OUTPUT: dict with voxel_count, volume_mm3, centroid_ras (nan if empty) and extent (i0, i1, j0, j1, k0, k1)
+    The mask is cropped to the box bounded by the swept rectangles first, and every half-space test is a separable
+    linear function of (i, j, k) evaluated by broadcasting, so no coordinate grid is materialized.
+    """
+    ijk_to_ras = np.asarray(ijk_to_ras, dtype=float)
+    ras_to_ijk = np.linalg.inv(ijk_to_ras)
+    plane_sizes = np.asarray(plane_sizes, dtype=float).reshape(-1, 2)
+    centers, axes = plane_frames(plane_matrices)
+    normals = axes[:, :, 2]
+    n_planes = len(centers)
+    corners = plane_corners(plane_matrices, plane_sizes)
+
+    if mode == 'between':
+        if n_planes < 2:
+            raise ValueError("'between' needs at least two planes")
+        others = (centers.sum(axis=0) - centers) / (n_planes - 1)
+        sides = np.sign(np.sum(normals * (others - centers), axis=1))
+        sides[sides == 0] = 1.0
+        if depth is None:
+            points = corners.reshape(-1, 3)
+            depth = 2.0 * float(np.sqrt(((points[:, None, :] - points[None, :, :]) ** 2).sum(axis=2).max()))
+    elif mode in ('above', 'below'):
+        if n_planes < 1:
+            raise ValueError(f"'{mode}' needs at least one plane")
+        sides = np.full(n_planes, 1.0 if mode == 'above' else -1.0)
+        if depth is None:
+            depth = float(plane_sizes.max())
+    else:
+        raise ValueError(f"Unknown mode: {mode}")
+    box_min = np.zeros(3, dtype=int)
+    box_max = np.array(mask.shape[::-1]) - 1
+    for m in range(n_planes):
+        swept = np.concatenate([corners[m], corners[m] + sides[m] * depth * normals[m]])
+        plane_min, plane_max = _ijk_box(ras_to_ijk, swept, mask.shape)
+        box_min = np.maximum(box_min, plane_min)
+        box_max = np.minimum(box_max, plane_max)
+
+    extent = (box_min[0], box_max[0], box_min[1], box_max[1], box_min[2], box_max[2])
+    voxel_volume = abs(np.linalg.det(ijk_to_ras[:3, :3]))
+    if np.any(box_max < box_min):
+        return {'voxel_count': 0, 'volume_mm3': 0.0, 'centroid_ras': np.full(3, np.nan), 'extent': extent}
+
+    region = mask[box_min[2]:box_max[2] + 1, box_min[1]:box_max[1] + 1, box_min[0]:box_max[0] + 1].copy()
+    i = np.arange(box_min[0], box_max[0] + 1, dtype=np.float32)
+    j = np.arange(box_min[1], box_max[1] + 1, dtype=np.float32)
+    k = np.arange(box_min[2], box_max[2] + 1, dtype=np.float32)
+
+    def linear_field(direction, point):
+        # direction . (ras(i, j, k) - point) as a broadcast sum of three 1-D terms
+        g = ijk_to_ras[:3, :3].T @ direction
+        g0 = np.dot(direction, ijk_to_ras[:3, 3] - point)
+        return (g[0] * i)[np.newaxis, np.newaxis, :] + (g[1] * j)[np.newaxis, :, np.newaxis] \
+            + (g[2] * k + g0)[:, np.newaxis, np.newaxis]
+
+    for m in range(n_planes):
+        axial = sides[m] * linear_field(normals[m], centers[m])
+        region &= (axial >= 0) & (axial <= depth)
+        region &= np.abs(linear_field(axes[m, :, 0], centers[m])) <= plane_sizes[m, 0] / 2.0
+        region &= np.abs(linear_field(axes[m, :, 1], centers[m])) <= plane_sizes[m, 1] / 2.0
+
+    count = int(np.count_nonzero(region))
+    if count == 0:
+        return {'voxel_count': 0, 'volume_mm3': 0.0, 'centroid_ras': np.full(3, np.nan), 'extent': extent}
+    centroid_ijk = np.array([
+        np.dot(region.sum(axis=(0, 1)), i),
+        np.dot(region.sum(axis=(0, 2)), j),
+        np.dot(region.sum(axis=(1, 2)), k)]) / count
+    return {'voxel_count': count, 'volume_mm3': count * voxel_volume,
+            'centroid_ras': transform_points(ijk_to_ras, centroid_ijk)[0], 'extent': extent}
+
+
+def fit_plane_svd(points):
+    """Least-squares plane through (N,3) points.
+    OUTPUT: center [(3,)], axes [(3,3)] (columns: in-plane x, in-plane y, normal; right-handed),
+            residuals [(N,)] signed point-to-plane distances
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    if len(points) < 3:
+        raise ValueError("At least 3 points are needed to fit a plane")
+    center = points.mean(axis=0)
+    _, _, vt = np.linalg.svd(points - center, full_matrices=False)
+    axes = vt.T.copy()
+    axes[:, 2] = np.cross(axes[:, 0], axes[:, 1])
+    residuals = (points - center) @ axes[:, 2]
+    return center, axes, residuals
+
+
+def fit_plane_ransac(points, threshold, iterations=500, seed=None, max_batch_elements=4000000):
+    """Robust plane fit: RANSAC over 3-point hypotheses followed by an SVD refit on the inliers.
+    All hypotheses are scored in batched matrix form ((N,3) points against (K,3) normals), in chunks that keep
+    the N x K distance matrix under max_batch_elements.
+    OUTPUT: center, axes, residuals (as fit_plane_svd, residuals for all points) and inliers [(N,) bool]
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    n_points = len(points)
+    if n_points < 3:
+        raise ValueError("At least 3 points are needed to fit a plane")
+    rng = np.random.default_rng(seed)
+    samples = rng.integers(0, n_points, size=(iterations, 3))
+    p0 = points[samples[:, 0]]
+    normals = np.cross(points[samples[:, 1]] - p0, points[samples[:, 2]] - p0)
+    norms = np.linalg.norm(normals, axis=1)
+    valid = norms > 1e-9
+    normals = normals[valid] / norms[valid, np.newaxis]
+    offsets = np.sum(normals * p0[valid], axis=1)
+    if len(normals) == 0:
+        raise ValueError("Points are degenerate (all hypotheses are collinear)")
+
+    batch = max(1, max_batch_elements // n_points)
+    counts = np.empty(len(normals), dtype=np.int64)
+    for start in range(0, len(normals), batch):
+        distances = np.abs(points @ normals[start:start + batch].T - offsets[start:start + batch])
+        counts[start:start + batch] = np.count_nonzero(distances <= threshold, axis=0)
+    best = int(np.argmax(counts))
+    inliers = np.abs(points @ normals[best] - offsets[best]) <= threshold
+    if np.count_nonzero(inliers) < 3:
+        inliers[:] = True
+
+    center, axes, _ = fit_plane_svd(points[inliers])
+    residuals = (points - center) @ axes[:, 2]
+    return center, axes, residuals, inliers
+
+
+_cylinder_stencils = {}
+
+
+def _stencil_key(direction, radius, length, linear, max_axis_error=0.25):
+    """Cache key, quantized direction and rounded length of a cylinder stencil (see cylinder_stencil)."""
+    norm = np.linalg.norm(direction)
+    if not norm > 0:
+        raise ValueError("Cylinder stencil direction must be a non-zero vector")
+    # Round the length up so that trajectories of similar lengths reuse the same stencil
+    length = 10.0 * np.ceil(length / 10.0)
+    # Rounding each component to 1/resolution bends the axis by at most sqrt(3)/(2 resolution) rad: choose the
+    # resolution so that the axis moves less than max_axis_error voxels at the end of the stencil
+    spacing = np.linalg.norm(linear, axis=0).min()
+    resolution = max(int(np.ceil(np.sqrt(3) / 2 * length / (max_axis_error * spacing))), 16)
+    quantized = np.round(np.asarray(direction, dtype=float) / norm * resolution).astype(int)
+    key = (tuple(quantized), round(float(radius), 6), tuple(np.round(linear, 6).ravel()))
+    return key, quantized, length
+
+
+def cylinder_stencil(direction, radius, length, ijk_to_ras, max_axis_error=0.25, max_batch_elements=2000000):
+    """Voxels swept by a cylinder of radius (mm) starting at the origin voxel and extending length (mm) along
+    direction (RAS), for a volume with the given IJK to RAS matrix.
+    OUTPUT: offsets [(S,3) int]  - (k,j,i) offsets from the entry voxel, sorted by depth
+            depths  [(S,) float] - depth (mm) of each voxel along the axis
+    Directions are quantized so that (nearly) parallel trajectories share a stencil; the quantization moves the axis
+    by less than max_axis_error voxels over the stencil length. Stencils are cached (the same arrays are returned
+    for the same key) and a longer length only rebuilds a stencil when no cached one is long enough."""
+    linear = np.asarray(ijk_to_ras, dtype=float)[:3, :3]
+    key, quantized, length = _stencil_key(direction, radius, length, linear, max_axis_error)
+    cached = _cylinder_stencils.get(key)
+    if cached is not None and cached[0] >= length:
+        return cached[1], cached[2]
+
+    axis = quantized / np.linalg.norm(quantized)
+    ras_to_ijk = np.linalg.inv(linear)
+    corners = np.array([[x, y, z] for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)], dtype=float) * radius
+    box = np.vstack([corners, corners + axis * length]) @ ras_to_ijk.T
+    low = np.floor(box.min(axis=0)).astype(int)
+    high = np.ceil(box.max(axis=0)).astype(int)
+
+    # Evaluate the bounding box in slabs of k to bound the memory of long oblique cylinders
+    i, j = np.meshgrid(np.arange(low[0], high[0] + 1), np.arange(low[1], high[1] + 1), indexing='ij')
+    i = i.ravel()
+    j = j.ravel()
+    slab = max(max_batch_elements // len(i), 1)
+    offsets = []
+    depths = []
+    for k0 in range(low[2], high[2] + 1, slab):
+        k = np.arange(k0, min(k0 + slab, high[2] + 1))
+        ijk = np.stack([np.tile(i, len(k)), np.tile(j, len(k)), np.repeat(k, len(i))], axis=1)
+        ras = ijk @ linear.T
+        axial = ras @ axis
+        radial2 = np.einsum('ij,ij->i', ras, ras) - axial ** 2
+        inside = (axial >= 0) & (axial <= length) & (radial2 <= radius ** 2)
+        offsets.append(ijk[inside][:, ::-1])
+        depths.append(axial[inside])
+    offsets = np.concatenate(offsets)
+    depths = np.concatenate(depths)
+    order = np.argsort(depths, kind='stable')
+    offsets, depths = offsets[order], depths[order]
+    _cylinder_stencils[key] = (length, offsets, depths)
+    return offsets, depths
+
+
+def _traverse(labels, ijk_to_ras, entries, targets, radius, lengths, cortical_labels, entry_depth):
+    """swept_cylinder_traversal on one process; label_counts has one column per label value 0..max."""
+    ras_to_ijk = np.linalg.inv(ijk_to_ras)
+    shape = np.array(labels.shape)
+    n = len(entries)
+    directions = targets - entries
+    entry_kji = np.rint(transform_points(ras_to_ijk, entries)).astype(int)[:, ::-1]
+    counts = [np.zeros(1, dtype=np.int64)] * n
+    breach = np.zeros(n, dtype=bool)
+    contact_depth = np.full(n, np.nan)
+    contact_label = np.zeros(n, dtype=int)
+
+    # Trajectories sharing a quantized direction share a stencil and are rasterized together. Degenerate
+    # trajectories (entry at the target) have no direction and are reported as crossing nothing.
+    linear = ijk_to_ras[:3, :3]
+    length = lengths.max() if n else 0.0
+    groups = {}
+    valid = np.linalg.norm(directions, axis=1) > 1e-9
+    for t in np.flatnonzero(valid):
+        groups.setdefault(_stencil_key(directions[t], radius, length, linear)[0], []).append(t)
+    for members in groups.values():
+        members = np.array(members)
+        offsets, depths = cylinder_stencil(directions[members[0]], radius, length, ijk_to_ras)
+        kji = entry_kji[members, None, :] + offsets[None, :, :]
+        inside = np.all((kji >= 0) & (kji < shape), axis=2) & (depths[None, :] <= lengths[members, None])
+        kji = np.where(inside[..., None], kji, 0)
+        values = np.where(inside, labels[kji[..., 0], kji[..., 1], kji[..., 2]], 0).astype(np.int64)
+        n_labels = int(values.max()) + 1
+        rows = np.broadcast_to(np.arange(len(members))[:, None], values.shape)
+        group_counts = np.bincount((rows * n_labels + values)[inside], minlength=len(members) * n_labels)
+        group_counts = group_counts.reshape(len(members), n_labels)
+        contact = inside & (values != 0)
+        first = np.argmax(contact, axis=1)  # stencil voxels are sorted by depth
+        hit = contact[np.arange(len(members)), first]
+        contact_depth[members[hit]] = depths[first[hit]]
+        contact_label[members[hit]] = values[hit, first[hit]]
+        if len(cortical_labels):
+            breach[members] = np.any(inside & np.isin(values, cortical_labels) & (depths[None, :] > entry_depth), axis=1)
+        for r, t in enumerate(members):
+            counts[t] = group_counts[r]
+
+    width = max([len(c) for c in counts] + [1])
+    label_counts = np.zeros((n, width), dtype=np.int64)
+    for t, c in enumerate(counts):
+        label_counts[t, :len(c)] = c
+    return label_counts, breach, contact_depth, contact_label
+
+
+def _traverse_shared(shm_name, shape, dtype, *args):
+    # Worker entry point: the labelmap is read from shared memory instead of being pickled to every worker
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        labels = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        return _traverse(labels, *args)
+    finally:
+        shm.close()
+
+
+def swept_cylinder_traversal(labels, ijk_to_ras, entries, targets, radius, length=None, cortical_labels=(),
+                             entry_depth=5.0, parallel_threshold=36, processes=None, executable=None):
+    """Rasterize the cylinder swept by a tool of the given radius (mm) along each trajectory and report what it crosses.
+    INPUT:  labels          [(K,J,I) int array] - labelmap voxels (non-negative labels, 0 is background)
+            ijk_to_ras      [(4,4) array]       - labelmap IJK to RAS matrix
+            entries/targets [(N,3) array]       - trajectory end points (RAS), the tool starts at the entry; a
+                                                  trajectory whose entry equals its target crosses nothing
+            length          [float or (N,)]     - tool length (mm); defaults to each entry-target distance
+            cortical_labels [sequence of int]   - labels whose contact deeper than entry_depth (mm) is a breach
+            parallel_threshold, processes       - above parallel_threshold trajectories, chunks are processed by a
+                                                  process pool sharing the labelmap through shared memory
+            executable      [str]               - Python interpreter for the workers (e.g. PythonSlicer)
+    OUTPUT: dict with keys
+            label_values        [(L,) int]    - labels crossed by at least one tool
+            label_counts        [(N,L) int]   - voxels of each label inside each swept cylinder
+            breach              [(N,) bool]   - cortical label reached past entry_depth
+            first_contact_depth [(N,) float]  - depth (mm) of the first non-background voxel, nan if none
+            first_contact_label [(N,) int]    - label of that voxel (0 if none)
+    """
+    entries = np.asarray(entries, dtype=float).reshape(-1, 3)
+    targets = np.asarray(targets, dtype=float).reshape(-1, 3)
+    ijk_to_ras = np.asarray(ijk_to_ras, dtype=float)
+    n = len(entries)
+    if length is None:
+        lengths = np.linalg.norm(targets - entries, axis=1)
+    else:
+        lengths = np.broadcast_to(np.asarray(length, dtype=float), (n,)).copy()
+    cortical_labels = np.asarray(cortical_labels, dtype=np.int64)
+    args = (ijk_to_ras, entries, targets, radius, lengths, cortical_labels, entry_depth)
+
+    if n == 0:
+        results = [(np.zeros((0, 1), dtype=np.int64), np.zeros(0, dtype=bool), np.zeros(0), np.zeros(0, dtype=int))]
+    elif n <= parallel_threshold or processes == 1:
+        results = [_traverse(labels, *args)]
+    else:
+        processes = processes or os.cpu_count() or 1
+        chunks = np.array_split(np.arange(n), min(processes, n))
+        context = multiprocessing.get_context('spawn')
+        if executable:
+            context.set_executable(executable)
+        labels = np.ascontiguousarray(labels)
+        shm = shared_memory.SharedMemory(create=True, size=max(labels.nbytes, 1))
+        try:
+            np.ndarray(labels.shape, dtype=labels.dtype, buffer=shm.buf)[...] = labels
+            with ProcessPoolExecutor(max_workers=len(chunks), mp_context=context) as pool:
+                futures = [pool.submit(_traverse_shared, shm.name, labels.shape, labels.dtype.str, ijk_to_ras,
+                                       entries[c], targets[c], radius, lengths[c], cortical_labels, entry_depth)
+                           for c in chunks]
+                results = [f.result() for f in futures]
+        finally:
+            shm.close()
+            shm.unlink()
+
+    width = max(r[0].shape[1] for r in results)
+    label_counts = np.concatenate([np.pad(r[0], ((0, 0), (0, width - r[0].shape[1]))) for r in results])
+    label_values = np.flatnonzero(label_counts.any(axis=0))
+    return {
+        'label_values': label_values,
+        'label_counts': label_counts[:, label_values],
+        'breach': np.concatenate([r[1] for r in results]),
+        'first_contact_depth': np.concatenate([r[2] for r in results]),
+        'first_contact_label': np.concatenate([r[3] for r in results]),
+    }
+
+
+def pairwise_distances(points_a, points_b):
+    """(Na,Nb) Euclidean distances between two point sets, computed with one matmul (no (Na,Nb,3) temporary)."""
+    points_a = np.asarray(points_a, dtype=float).reshape(-1, 3)
+    points_b = np.asarray(points_b, dtype=float).reshape(-1, 3)
+    squared = np.sum(points_a ** 2, axis=1)[:, np.newaxis] + np.sum(points_b ** 2, axis=1)[np.newaxis, :] \
+        - 2.0 * points_a @ points_b.T
+    return np.sqrt(np.maximum(squared, 0.0))
+
+
+def assign_min_cost(cost):
+    """One-to-one assignment of the rows and columns of a cost matrix with minimum total cost (inf = not allowed).
+    Uses the Hungarian algorithm of scipy when it is available, else a greedy assignment (cheapest pairs first).
+    OUTPUT: rows, columns [(K,) int arrays] - assigned pairs
+    """
+    cost = np.asarray(cost, dtype=float)
+    finite = np.isfinite(cost)
+    if not finite.any():
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    try:
+        from scipy.optimize import linear_sum_assignment
+    except ImportError:
+        linear_sum_assignment = None
+
+    if linear_sum_assignment is not None:
+        # Forbidden pairs get a cost no valid assignment can beat, and are dropped afterwards
+        forbidden = (cost[finite].max() + 1.0) * (min(cost.shape) + 1)
+        rows, columns = linear_sum_assignment(np.where(finite, cost, forbidden))
+        keep = finite[rows, columns]
+        return rows[keep], columns[keep]
+
+    order = np.argsort(cost, axis=None, kind='stable')
+    order = order[finite.ravel()[order]]
+    used_rows = np.zeros(cost.shape[0], dtype=bool)
+    used_columns = np.zeros(cost.shape[1], dtype=bool)
+    rows, columns = [], []
+    for r, c in zip(*np.unravel_index(order, cost.shape)):
+        if used_rows[r] or used_columns[c]:
+            continue
+        used_rows[r] = used_columns[c] = True
+        rows.append(r)
+        columns.append(c)
+        if len(rows) == min(cost.shape):
+            break
+    return np.array(rows, dtype=int), np.array(columns, dtype=int)
+
+
+def match_items(names_a, names_b, cost_function=None, max_cost=np.inf):
+    """Match the items of two plans by name, then the remaining (e.g. renamed) items by minimum cost.
+    INPUT:  names_a, names_b [sequence of str] - item names of plan a and plan b
+            cost_function    - cost_function(index_a, index_b) returns the (len(index_a), len(index_b)) cost of
+                               pairing the items left unmatched by name; pairs costing more than max_cost are not
+                               matched. Without a cost function only names are matched.
+    OUTPUT: index_a, index_b [(K,) int arrays]  - matched pairs
+            by_name          [(K,) bool array]  - False for pairs matched by cost
+    """
+    position_b = {}
+    for j, name in enumerate(names_b):
+        position_b.setdefault(name, j)
+    index_a, index_b = [], []
+    for i, name in enumerate(names_a):
+        j = position_b.pop(name, None)
+        if j is not None:
+            index_a.append(i)
+            index_b.append(j)
+    by_name = [True] * len(index_a)
+
+    if cost_function is not None:
+        rest_a = np.setdiff1d(np.arange(len(names_a)), index_a)
+        rest_b = np.setdiff1d(np.arange(len(names_b)), index_b)
+        if len(rest_a) and len(rest_b):
+            cost = np.asarray(cost_function(rest_a, rest_b), dtype=float)
+            rows, columns = assign_min_cost(np.where(cost <= max_cost, cost, np.inf))
+            index_a += rest_a[rows].tolist()
+            index_b += rest_b[columns].tolist()
+            by_name += [False] * len(rows)
+    return np.array(index_a, dtype=int), np.array(index_b, dtype=int), np.array(by_name, dtype=bool)
+
+
+def trajectory_deltas(entries_a, targets_a, entries_b, targets_b):
+    """Differences between matched trajectories (row i of plan a against row i of plan b).
+    OUTPUT: dict of (K,) arrays
+            entry_mm, target_mm - entry / target displacements
+            angle_deg           - angle between the trajectory directions
+            length_mm           - length change (b - a)
+    """
+    entries_a, targets_a, entries_b, targets_b = (np.asarray(x, dtype=float).reshape(-1, 3)
+                                                  for x in (entries_a, targets_a, entries_b, targets_b))
+    directions_a = targets_a - entries_a
+    directions_b = targets_b - entries_b
+    lengths_a = np.linalg.norm(directions_a, axis=1)
+    lengths_b = np.linalg.norm(directions_b, axis=1)
+    cosine = np.sum(directions_a * directions_b, axis=1) / np.maximum(lengths_a * lengths_b, 1e-12)
+    return {
+        'entry_mm': np.linalg.norm(entries_b - entries_a, axis=1),
+        'target_mm': np.linalg.norm(targets_b - targets_a, axis=1),
+        'angle_deg': np.degrees(np.arccos(np.clip(cosine, -1.0, 1.0))),
+        'length_mm': lengths_b - lengths_a,
+    }
+
+
+def plane_pose_deltas(matrices_a, sizes_a, matrices_b, sizes_b):
+    """Differences between matched planes (row i of plan a against row i of plan b).
+    OUTPUT: dict of (K,) arrays
+            translation_mm       - center displacement
+            rotation_deg         - angle of the relative rotation of the plane axes
+            normal_deg           - angle between the planes (unoriented normals, 0 to 90)
+            width_mm, height_mm  - size change (b - a)
+    """
+    centers_a, axes_a = plane_frames(matrices_a)
+    centers_b, axes_b = plane_frames(matrices_b)
+    sizes_a = np.asarray(sizes_a, dtype=float).reshape(-1, 2)
+    sizes_b = np.asarray(sizes_b, dtype=float).reshape(-1, 2)
+    # trace(R_a^T R_b) = 1 + 2 cos(angle)
+    trace = np.einsum('nij,nij->n', axes_a, axes_b)
+    normal_cosine = np.abs(np.sum(axes_a[:, :, 2] * axes_b[:, :, 2], axis=1))
+    return {
+        'translation_mm': np.linalg.norm(centers_b - centers_a, axis=1),
+        'rotation_deg': np.degrees(np.arccos(np.clip((trace - 1.0) / 2.0, -1.0, 1.0))),
+        'normal_deg': np.degrees(np.arccos(np.clip(normal_cosine, 0.0, 1.0))),
+        'width_mm': sizes_b[:, 0] - sizes_a[:, 0],
+        'height_mm': sizes_b[:, 1] - sizes_a[:, 1],
+    }
+
+
+def register_points(moving, fixed, scale=False):
+    """Least-squares rigid (or similarity) transform mapping paired moving points onto fixed points (Umeyama 1991).
+    INPUT:  moving, fixed [(N,3) array] - paired points (N >= 3, not collinear)
+            scale         [bool]        - also estimate an isotropic scale (similarity transform)
+    OUTPUT: dict with keys
+            matrix    [(4,4) array] - moving to fixed homogeneous transform
+            scale     [float]       - isotropic scale (1 for a rigid transform)
+            residuals [(N,) array]  - distance of each registered moving point to its fixed point (mm)
+            fre       [float]       - fiducial registration error (RMS of the residuals)
+    """
+    moving = np.asarray(moving, dtype=float).reshape(-1, 3)
+    fixed = np.asarray(fixed, dtype=float).reshape(-1, 3)
+    if len(moving) != len(fixed) or len(moving) < 3:
+        raise ValueError("Registration needs at least 3 paired points")
+    mean_moving = moving.mean(axis=0)
+    mean_fixed = fixed.mean(axis=0)
+    centered_moving = moving - mean_moving
+    centered_fixed = fixed - mean_fixed
+    u, singular_values, vt = np.linalg.svd(centered_fixed.T @ centered_moving / len(moving))
+    if singular_values[1] < 1e-9 * max(singular_values[0], 1e-12):
+        raise ValueError("Registration points are collinear")
+    # Reflection guard: the closest proper rotation flips the axis of the smallest singular value
+    d = np.array([1.0, 1.0, np.sign(np.linalg.det(u) * np.linalg.det(vt)) or 1.0])
+    rotation = (u * d) @ vt
+    s = float(np.sum(singular_values * d) / np.mean(np.sum(centered_moving ** 2, axis=1))) if scale else 1.0
+
+    matrix = np.eye(4)
+    matrix[:3, :3] = s * rotation
+    matrix[:3, 3] = mean_fixed - s * rotation @ mean_moving
+    residuals = np.linalg.norm(transform_points(matrix, moving) - fixed, axis=1)
+    return {'matrix': matrix, 'scale': s, 'residuals': residuals, 'fre': float(np.sqrt(np.mean(residuals ** 2)))}
+
+
+def tool_deviations(tip, axis, entries, targets):
+    """Deviation of a tracked tool from every planned trajectory in one pass.
+    INPUT:  tip             [(3,) array]   - tool tip position
+            axis            [(3,) array]   - unit tool axis, pointing from the handle to the tip
+            entries/targets [(N,3) array]  - planned trajectories
+    OUTPUT: dict of (N,) arrays
+            target_mm    - distance from the tip to the target
+            lateral_mm   - distance from the tip to the planned line (perpendicular offset)
+            remaining_mm - distance left to the target along the planned line (negative past the target)
+            angle_deg    - angle between the tool axis and the planned entry to target direction
+            segment_mm   - distance from the tip to the planned segment (to find the nearest trajectory)
+    """
+    tip = np.asarray(tip, dtype=float)
+    entries = np.asarray(entries, dtype=float).reshape(-1, 3)
+    targets = np.asarray(targets, dtype=float).reshape(-1, 3)
+    directions = targets - entries
+    lengths = np.maximum(np.linalg.norm(directions, axis=1), 1e-12)
+    unit = directions / lengths[:, np.newaxis]
+    relative = tip - entries
+    depth = np.sum(relative * unit, axis=1)
+    lateral = np.linalg.norm(relative - depth[:, np.newaxis] * unit, axis=1)
+    clamped = np.clip(depth, 0.0, lengths)
+    return {
+        'target_mm': np.linalg.norm(tip - targets, axis=1),
+        'lateral_mm': lateral,
+        'remaining_mm': lengths - depth,
+        'angle_deg': np.degrees(np.arccos(np.clip(unit @ np.asarray(axis, dtype=float), -1.0, 1.0))),
+        'segment_mm': np.hypot(lateral, depth - clamped),
+    }
@@ -34,9 +34,13 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import slicer
 import vtk
+import qt
 import time
 import numpy as np
 import os
+from contextlib import contextmanager
+from . import surgery_planner_geometry as sg
+from . import surgery_planner_io as sio
 
 """The following block of functions are from slicer.util, but are not included in the current 4.10 code base. 
 They are quite helpful so I am housing them here until they are returned to the main code
@@ -49,12 +53,9 @@ def arrayFromVTKMatrix(vmatrix):
   To set VTK matrix from a numpy array, use :py:meth:`vtkMatrixFromArray` or
   :py:meth:`updateVTKMatrixFromArray`.
   """
-    from vtk import vtkMatrix4x4
-    from vtk import vtkMatrix3x3
-    import numpy as np
-    if isinstance(vmatrix, vtkMatrix4x4):
+    if isinstance(vmatrix, vtk.vtkMatrix4x4):
         matrixSize = 4
-    elif isinstance(vmatrix, vtkMatrix3x3):
+    elif isinstance(vmatrix, vtk.vtkMatrix3x3):
         matrixSize = 3
     else:
         raise RuntimeError("Input must be vtk.vtkMatrix3x3 or vtk.vtkMatrix4x4")
@@ -69,15 +70,13 @@ def vtkMatrixFromArray(narray):
   The returned matrix is just a copy and so any modification in the array will not affect the output matrix.
   To set numpy array from VTK matrix, use :py:meth:`arrayFromVTKMatrix`.
   """
-    from vtk import vtkMatrix4x4
-    from vtk import vtkMatrix3x3
     narrayshape = narray.shape
     if narrayshape == (4, 4):
-        vmatrix = vtkMatrix4x4()
+        vmatrix = vtk.vtkMatrix4x4()
         updateVTKMatrixFromArray(vmatrix, narray)
         return vmatrix
     elif narrayshape == (3, 3):
-        vmatrix = vtkMatrix3x3()
+        vmatrix = vtk.vtkMatrix3x3()
         updateVTKMatrixFromArray(vmatrix, narray)
         return vmatrix
     else:
@@ -90,11 +89,9 @@ def updateVTKMatrixFromArray(vmatrix, narray):
   :param narray: input numpy array
   To set numpy array from VTK matrix, use :py:meth:`arrayFromVTKMatrix`.
   """
-    from vtk import vtkMatrix4x4
-    from vtk import vtkMatrix3x3
-    if isinstance(vmatrix, vtkMatrix4x4):
+    if isinstance(vmatrix, vtk.vtkMatrix4x4):
         matrixSize = 4
-    elif isinstance(vmatrix, vtkMatrix3x3):
+    elif isinstance(vmatrix, vtk.vtkMatrix3x3):
         matrixSize = 3
     else:
         raise RuntimeError("Output vmatrix must be vtk.vtkMatrix3x3 or vtk.vtkMatrix4x4")
@@ -103,16 +100,17 @@ def updateVTKMatrixFromArray(vmatrix, narray):
     vmatrix.DeepCopy(narray.ravel())
 
 
-def arrayFromTransformMatrix(transformNode, toWorld=False):
+def arrayFromTransformMatrix(transformNode, toWorld=False, transformCache=None):
     """Return 4x4 transformation matrix as numpy array.
   :param toWorld: if set to True then the transform to world coordinate system is returned
     (effect of parent transform to the node is applied), otherwise transform to parent transform is returned.
+  :param transformCache: optional :py:class:`TransformChainCache` used for the to world matrix
   The returned array is just a copy and so any modification in the array will not affect the transform node.
   To set transformation matrix from a numpy array, use :py:meth:`updateTransformMatrixFromArray`.
   """
-    import numpy as np
-    from vtk import vtkMatrix4x4
-    vmatrix = vtkMatrix4x4()
+    if toWorld and transformCache is not None:
+        return transformCache.to_world(transformNode).copy()
+    vmatrix = vtk.vtkMatrix4x4()
     if toWorld:
         success = transformNode.GetMatrixTransformToWorld(vmatrix)
     else:
@@ -122,31 +120,222 @@ def arrayFromTransformMatrix(transformNode, toWorld=False):
     return arrayFromVTKMatrix(vmatrix)
 
 
-def updateTransformMatrixFromArray(transformNode, narray, toWorld=False):
+def updateTransformMatrixFromArray(transformNode, narray, toWorld=False, transformCache=None):
     """Set transformation matrix from a numpy array of size 4x4 (toParent).
   :param world: if set to True then the transform will be set so that transform
     to world matrix will be equal to narray; otherwise transform to parent will be
     set as narray.
+  :param transformCache: optional :py:class:`TransformChainCache` providing the cached inverse of the parent
+    to world matrix (the update is then one matrix product)
   """
-    import numpy as np
-    from vtk import vtkMatrix4x4
     narrayshape = narray.shape
     if narrayshape != (4, 4):
         raise RuntimeError("Unsupported numpy array shape: " + str(narrayshape) + " expected (4,4)")
-    if toWorld and transformNode.GetParentTransformNode():
+    if toWorld and transformCache is not None:
+        transformCache.set_to_world(transformNode, narray)
+    elif toWorld and transformNode.GetParentTransformNode():
         # thisToParent = worldToParent * thisToWorld = inv(parentToWorld) * toWorld
-        narrayParentToWorld = arrayFromTransformMatrix(transformNode.GetParentTransformNode())
+        narrayParentToWorld = arrayFromTransformMatrix(transformNode.GetParentTransformNode(), toWorld=True)
         thisToParent = np.dot(np.linalg.inv(narrayParentToWorld), narray)
         updateTransformMatrixFromArray(transformNode, thisToParent, toWorld=False)
     else:
-        vmatrix = vtkMatrix4x4()
+        vmatrix = vtk.vtkMatrix4x4()
         updateVTKMatrixFromArray(vmatrix, narray)
         transformNode.SetMatrixTransformToParent(vmatrix)
 
 
+"""Batch variants of the functions above for stacks of transforms (e.g. updating many transform nodes per frame).
+They reuse a module-level scratch vtkMatrix4x4 and write into caller-provided arrays when given, so no VTK or numpy
+objects are created per node."""
+
+_scratch_vmatrix = vtk.vtkMatrix4x4()
+
+
+def arraysFromTransformMatrices(transformNodes, toWorld=False, out=None):
+    """Return the 4x4 matrices of N transform nodes as an (N,4,4) numpy array.
+  :param toWorld: see :py:meth:`arrayFromTransformMatrix`
+  :param out: optional preallocated C-contiguous (N,4,4) float64 array that receives the matrices
+  """
+    if out is None:
+        out = np.empty((len(transformNodes), 4, 4))
+    for n, transformNode in enumerate(transformNodes):
+        if toWorld:
+            success = transformNode.GetMatrixTransformToWorld(_scratch_vmatrix)
+        else:
+            success = transformNode.GetMatrixTransformToParent(_scratch_vmatrix)
+        if not success:
+            raise RuntimeError("Failed to get transformation matrix from node " + transformNode.GetID())
+        _scratch_vmatrix.DeepCopy(out[n].ravel(), _scratch_vmatrix)
+    return out
+
+
+def updateTransformMatricesFromArrays(transformNodes, narrays, toWorld=False):
+    """Set the matrices of N transform nodes from an (N,4,4) numpy array.
+  :param toWorld: if set to True then each transform to world matrix will be equal to its narray; the parent
+    to world matrices are read in one batch and inverted with a single stacked inverse.
+  """
+    narrays = np.asarray(narrays, dtype=float)
+    if narrays.shape != (len(transformNodes), 4, 4):
+        raise RuntimeError("Unsupported numpy array shape: " + str(narrays.shape) +
+                           " expected ({0},4,4)".format(len(transformNodes)))
+    if toWorld:
+        parents = [transformNode.GetParentTransformNode() for transformNode in transformNodes]
+        withParent = [n for n, parent in enumerate(parents) if parent is not None]
+        if withParent:
+            parentToWorld = arraysFromTransformMatrices([parents[n] for n in withParent], toWorld=True)
+            narrays = narrays.copy()
+            narrays[withParent] = np.linalg.inv(parentToWorld) @ narrays[withParent]
+    narrays = np.ascontiguousarray(narrays)
+    for transformNode, narray in zip(transformNodes, narrays):
+        _scratch_vmatrix.DeepCopy(narray.ravel())
+        transformNode.SetMatrixTransformToParent(_scratch_vmatrix)
+
+
 """My custom code below"""
 
 
+class TransformChainCache:
+    """ Caches the to-world matrix of transform nodes and its inverse. Each cached node is observed; when its
+    TransformModifiedEvent fires (its own matrix or its parent changed), the node and every cached node below it are
+    invalidated, so world-space reads are a dictionary lookup and world-space writes one matrix product """
+
+    def __init__(self):
+        # node ID -> [node, to_world, world_to_node, observer tag, parent ID, child IDs]
+        self.entries = {}
+
+    def _entry(self, transform_node):
+        node_id = transform_node.GetID()
+        entry = self.entries.get(node_id)
+        if entry is None:
+            tag = transform_node.AddObserver(slicer.vtkMRMLTransformableNode.TransformModifiedEvent,
+                                             self.transform_modified_callback)
+            entry = [transform_node, None, None, tag, None, set()]
+            self.entries[node_id] = entry
+        if entry[1] is None:
+            self._update(entry)
+        return entry
+
+    def _update(self, entry):
+        transform_node = entry[0]
+        parent = transform_node.GetParentTransformNode()
+        parent_id = parent.GetID() if parent is not None else None
+        if entry[4] != parent_id:  # re-parented
+            if entry[4] in self.entries:
+                self.entries[entry[4]][5].discard(transform_node.GetID())
+            entry[4] = parent_id
+        if not transform_node.GetMatrixTransformToParent(_scratch_vmatrix):
+            raise RuntimeError("Failed to get transformation matrix from node " + transform_node.GetID())
+        to_parent = np.eye(4)
+        _scratch_vmatrix.DeepCopy(to_parent.ravel(), _scratch_vmatrix)
+        if parent is not None:
+            parent_entry = self._entry(parent)
+            parent_entry[5].add(transform_node.GetID())
+            entry[1] = parent_entry[1] @ to_parent
+        else:
+            entry[1] = to_parent
+        entry[2] = None  # inverse computed on first use
+
+    def to_world(self, transform_node):
+        """ Cached (4,4) to-world matrix of the node (do not modify the returned array) """
+        return self._entry(transform_node)[1]
+
+    def world_to_node(self, transform_node):
+        """ Cached inverse of the to-world matrix of the node (do not modify the returned array) """
+        entry = self._entry(transform_node)
+        if entry[2] is None:
+            entry[2] = np.linalg.inv(entry[1])
+        return entry[2]
+
+    def set_to_world(self, transform_node, narray):
+        """ Set the node's transform so that its to-world matrix equals narray """
+        entry = self._entry(transform_node)
+        parent = transform_node.GetParentTransformNode()
+        to_parent = self.world_to_node(parent) @ narray if parent is not None else narray
+        _scratch_vmatrix.DeepCopy(np.ascontiguousarray(to_parent, dtype=float).ravel())
+        transform_node.SetMatrixTransformToParent(_scratch_vmatrix)
+        # The modified event invalidated the subtree: store the known result directly
+        entry[1] = np.array(narray, dtype=float)
+        entry[2] = None
+
+    def invalidate(self, node_id):
+        """ Drop the cached matrices of a node and of all cached nodes below it """
+        stack = [node_id]
+        while stack:
+            entry = self.entries.get(stack.pop())
+            if entry is None or entry[1] is None:  # nodes below an invalid node are invalid already
+                continue
+            entry[1] = None
+            entry[2] = None
+            stack.extend(entry[5])
+
+    def transform_modified_callback(self, caller, event):
+        self.invalidate(caller.GetID())
+
+    def forget(self, transform_node):
+        """ Stop observing a node (e.g. before removing it from the scene) """
+        entry = self.entries.pop(transform_node.GetID(), None)
+        if entry is not None:
+            transform_node.RemoveObserver(entry[3])
+            for child_id in entry[5]:
+                self.invalidate(child_id)
+
+    def clear(self):
+        for entry in self.entries.values():
+            entry[0].RemoveObserver(entry[3])
+        self.entries = {}
+
+
+def get_ijk_to_ras(volume_node):
+    """ Returns the IJK to RAS matrix of a volume node as a (4,4) numpy array """
+    ijk_to_ras = vtk.vtkMatrix4x4()
+    volume_node.GetIJKToRASMatrix(ijk_to_ras)
+    return arrayFromVTKMatrix(ijk_to_ras)
+
+
+def ras_to_ijk_points(points_ras, volume_node=None, ras_to_ijk=None):
+    """ Converts RAS positions to (continuous) IJK voxel coordinates with one matrix product
+    INPUT: points_ras  [(N,3) or (3,) array]
+           volume_node [vtkMRMLVolumeNode] - volume defining the voxel grid, or
+           ras_to_ijk  [(4,4) array]        - RAS to IJK matrix
+    OUTPUT: points_ijk [(N,3) array] (round to get voxel indices) """
+    if ras_to_ijk is None:
+        ras_to_ijk = np.linalg.inv(get_ijk_to_ras(volume_node))
+    points_ras = np.atleast_2d(np.asarray(points_ras, dtype=float))
+    return points_ras @ ras_to_ijk[:3, :3].T + ras_to_ijk[:3, 3]
+
+
+def ijk_to_ras_points(points_ijk, volume_node=None, ijk_to_ras=None):
+    """ Converts IJK voxel coordinates (N,3) to RAS positions with one matrix product (see ras_to_ijk_points) """
+    if ijk_to_ras is None:
+        ijk_to_ras = get_ijk_to_ras(volume_node)
+    points_ijk = np.atleast_2d(np.asarray(points_ijk, dtype=float))
+    return points_ijk @ ijk_to_ras[:3, :3].T + ijk_to_ras[:3, 3]
+
+
+def evaluate_function_on_volume(volume_node, function, extent=None, max_chunk_voxels=2 ** 22):
+    """ Sets the voxels of a volume to a function of their RAS position, e.g.
+            evaluate_function_on_volume(node, lambda ras: (ras[..., 0] - 10) ** 2 + (ras[..., 1] + 15) ** 2)
+    INPUT: volume_node      [vtkMRMLScalarVolumeNode]
+           function         [callable] - maps a (..., 3) RAS array to an array of values of shape (...)
+           extent           [6 ints]   - inclusive IJK extent (i0, i1, j0, j1, k0, k1) to fill, default: whole volume
+           max_chunk_voxels [int]      - the volume is filled in slabs of k slices of at most this many voxels
+    The RAS grid of each slab is built from the matrix columns by broadcasting, and the values are written through
+    arrayFromVolume, so memory stays bounded and no per-voxel calls are made """
+    voxels = slicer.util.arrayFromVolume(volume_node)
+    if extent is None:
+        extent = (0, voxels.shape[2] - 1, 0, voxels.shape[1] - 1, 0, voxels.shape[0] - 1)
+    ijk_to_ras = get_ijk_to_ras(volume_node)
+    i = np.arange(extent[0], extent[1] + 1)
+    j = np.arange(extent[2], extent[3] + 1)
+    ij_ras = (i[None, :, None] * ijk_to_ras[:3, 0] + j[:, None, None] * ijk_to_ras[:3, 1]) + ijk_to_ras[:3, 3]
+    slab = max(int(max_chunk_voxels) // ij_ras[..., 0].size, 1)
+    for k0 in range(extent[4], extent[5] + 1, slab):
+        k = np.arange(k0, min(k0 + slab, extent[5] + 1))
+        ras = ij_ras[None] + k[:, None, None, None] * ijk_to_ras[:3, 2]
+        voxels[k[0]:k[-1] + 1, extent[2]:extent[3] + 1, extent[0]:extent[1] + 1] = function(ras)
+    slicer.util.arrayFromVolumeModified(volume_node)
+
+
 def make_igtl_node(ip, port, name):
     """ Creates an IGT_link node in Slicer that can be used to communicate with e.g. ROS
     INPUT: ip   [str]  - IP address, (accepts 'localhost')
@@ -202,7 +391,9 @@ def collapse_traj_markups_to_single_fcsv(data_dir,new_name):
 
 class SlicerVolumeModel:
     """ Takes a volume (nrrd, perhaps others), imports it into Slicer as segment. Allows for voxel manipulation from np
-    array """
+    array. Edits are tracked as a dirty IJK bounding box and coalesced: the visualizations are updated at most once per
+    event loop iteration (i.e. once per rendered frame), however many edits were made in between. The whole volume is
+    re-rendered; the dirty extent is only reported to dirty_listeners. """
 
     def __init__(self, volume_filename):
         """INPUT: volume_filename  [str] - filename with given mesh - accepts .stl and .dae """
@@ -216,13 +407,80 @@ class SlicerVolumeModel:
         slicer_logic.UpdateDisplayNodeFromVolumeNode(self.displayNode, self.label_volumeNode)
         self.label_volumeNode.AddAndObserveDisplayNodeID(self.displayNode.GetID())
         self.voxel_array = slicer.util.arrayFromVolume(self.label_volumeNode)
-        self.imageData=volumeNode.GetImageData()
+        self.imageData = self.label_volumeNode.GetImageData()
         self.voxel_extent = self.imageData.GetExtent()
 
+        # Dirty region as inclusive (k, j, i) array index bounds, None when clean
+        self.dirty_min = None
+        self.dirty_max = None
+        self.update_scheduled = False
+        # Called with the flushed IJK extent (i0, i1, j0, j1, k0, k1) so consumers can refresh only that region
+        self.dirty_listeners = []
+
+    def mark_dirty(self, kji_min, kji_max):
+        """ Grow the dirty region by the inclusive (k, j, i) array index box and schedule an update """
+        shape = np.array(self.voxel_array.shape) - 1
+        kji_min = np.clip(np.asarray(kji_min, dtype=int), 0, shape)
+        kji_max = np.clip(np.asarray(kji_max, dtype=int), 0, shape)
+        if np.any(kji_max < kji_min):
+            return
+        if self.dirty_min is None:
+            self.dirty_min, self.dirty_max = kji_min, kji_max
+        else:
+            self.dirty_min = np.minimum(self.dirty_min, kji_min)
+            self.dirty_max = np.maximum(self.dirty_max, kji_max)
+        if not self.update_scheduled:
+            self.update_scheduled = True
+            qt.QTimer.singleShot(0, self.flush)
+
+    def mark_dirty_indices(self, k_idx, j_idx, i_idx):
+        """ Mark the bounding box of edited voxels given as (k, j, i) index arrays """
+        if len(k_idx) == 0:
+            return
+        self.mark_dirty((np.min(k_idx), np.min(j_idx), np.min(i_idx)),
+                        (np.max(k_idx), np.max(j_idx), np.max(i_idx)))
+
+    @contextmanager
+    def edit(self, kji_min, kji_max):
+        """ Context manager yielding a view of voxel_array over the inclusive (k, j, i) box; the box is marked dirty
+        when the block exits, e.g.
+            with volume_model.edit((k0, j0, i0), (k1, j1, i1)) as voxels:
+                voxels[voxels == 2] = 0 """
+        lo = np.maximum(np.asarray(kji_min, dtype=int), 0)
+        hi = np.asarray(kji_max, dtype=int) + 1
+        try:
+            yield self.voxel_array[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+        finally:
+            self.mark_dirty(lo, hi - 1)
+
+    def dirty_extent(self):
+        """ Dirty region as an IJK extent (i0, i1, j0, j1, k0, k1), or None """
+        if self.dirty_min is None:
+            return None
+        offset = np.array(self.voxel_extent[0::2])[::-1]  # k, j, i
+        lo = self.dirty_min + offset
+        hi = self.dirty_max + offset
+        return (int(lo[2]), int(hi[2]), int(lo[1]), int(hi[1]), int(lo[0]), int(hi[0]))
+
+    def flush(self):
+        """ Push the pending edits to the visualizations now """
+        self.update_scheduled = False
+        extent = self.dirty_extent()
+        if extent is None:
+            return
+        self.dirty_min = None
+        self.dirty_max = None
+        # Marks the scalars and image data modified and invokes the node's ImageDataModifiedEvent, which is what
+        # requests a render of the slice and 3D views (a bare vtkImageData.Modified() raises no MRML event)
+        slicer.util.arrayFromVolumeModified(self.label_volumeNode)
+        for listener in self.dirty_listeners:
+            listener(extent)
+
     def register_visual_change(self):
-        """ Method to call after changing self.voxel_array so that the visualizations update """
-        self.label_volumeNode.Modified()  # Updates the visualizations
-        self.displayNode.Modified()
+        """ Method to call after changing self.voxel_array so that the visualizations update. The whole volume is
+        considered changed; prefer edit() or mark_dirty() when the edited region is known """
+        self.mark_dirty((0, 0, 0), np.array(self.voxel_array.shape) - 1)
+        self.flush()
 
 
 class SlicerTrajectoryModel:
@@ -324,142 +582,294 @@ class SlicerTrajectoryModel:
         if idx2 >= 0:
             self.sharedMarkupNode.RemoveNthControlPoint(idx2)
 
-# class SlicerDrillTip:
-#     def __init__(self, volume_model, radius):
-#         self.volume_model = volume_model
-#         self.radius = radius
-#         self.drillTipMarkupNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
-#         self.drillTipMarkupNode.SetName('Drill Tip')
-#         n = slicer.modules.markups.logic().AddFiducial()
-#         self.drillTipMarkupNode.SetNthFiducialLabel(0, "Drill Tip")
-#         # each markup is given a unique id which can be accessed from the superclass level
-#         self.drillTipFiducialID = self.drillTipMarkupNode.GetNthMarkupID(n)
-#         self.drillTipMarkupNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self.drill_tip_callback)
-#         self.cartesian_to_voxel_transform = vtk.vtkMatrix4x4()  # Slicer calls this RAS to IJK coordinates
-#         self.volume_model.label_volumeNode.GetRASToIJKMatrix(self.cartesian_to_voxel_transform)
-#         v_rad = [self.radius, 0, 0, 1]
-#         self.voxel_radius = np.linalg.norm(self.cartesian_to_voxel_transform.MultiplyPoint(v_rad))
-#
-#     def get_drill_tip_pos(self):
-#         pos = np.array([0.0, 0.0, 0.0])
-#         self.drillTipMarkupNode.GetNthFiducialPosition(0, pos)
-#         return pos
-#
-#     def drill_tip_callback(self):
-#         cartesian_position = np.append(self.get_drill_tip_pos(), 1.0)
-#         voxel_position = self.cartesian_to_voxel_transform.MultiplyPoint(cartesian_position)
-#
-#     def remove_material(self, bone, shape, prev_state, dim_scales):
-#         """
-#         Creates a mask based on the intersection of the drill and bone
-#         drill: mlab volume created in the run_mayavi function
-#         bone: mlab volume created from the voxels of the input nrrd
-#         shape: dimensions of the voxel data
-#         preve_state: mlab state stack created in the run_mayavi function
-#         dim_scales: list of dimensional scales based on voxel resolution
-#         dim_scales: list of dimensional scales based on voxel resolution
-#         """
-#         # setup voxel scales
-#         x_scale, y_scale, z_scale = dim_scales
-#         x_voxel, y_voxel, z_voxel = shared_vars.radius_voxel / x_scale, \
-#                                     shared_vars.radius_voxel / y_scale, \
-#                                     shared_vars.radius_voxel / z_scale
-#
-#         # rescale x, y, z positions
-#         x, y, z = drill.mlab_source.points[0, 0] / x_scale, \
-#                   drill.mlab_source.points[0, 1] / y_scale, \
-#                   drill.mlab_source.points[0, 2] / z_scale
-#
-#         if 0 <= x < shape[0] and 0 <= y < shape[1] and 0 <= z < shape[2]:
-#             # start = time.time()
-#             # set spherical mask based on the dimension of the drill
-#             x_range, y_range, z_range = np.arange(x - x_voxel, x + x_voxel), \
-#                                         np.arange(y - y_voxel, y + y_voxel), \
-#                                         np.arange(z - z_voxel, z + z_voxel)
-#
-#             mask = ((x_range[:, np.newaxis, np.newaxis] - x) * x_scale) ** 2 + \
-#                    ((y_range[np.newaxis, :, np.newaxis] - y) * y_scale) ** 2 + \
-#                    ((z_range[np.newaxis, np.newaxis, :] - z) * z_scale) ** 2 < shared_vars.radius_voxel ** 2
-#             x_idx, y_idx, z_idx = np.where(mask) + np.array([x - x_voxel, y - y_voxel, z - z_voxel]).astype(int)[:,
-#                                                    None]
-#             valid_idx = (0 <= x_idx) & (x_idx < shape[0]) & (0 <= y_idx) & (y_idx < shape[1]) & (0 <= z_idx) & (
-#                         z_idx < shape[2])
-#             x_idx = x_idx[valid_idx]
-#             y_idx = y_idx[valid_idx]
-#             z_idx = z_idx[valid_idx]
-#             prev_state['volume'] = bone.mlab_source.scalars[x_idx, y_idx, z_idx]  # record volume
-#             prev_state['index'] = [x_idx, y_idx, z_idx]  # record index
-#
-#             # Check if drill has come in contact with a segment
-#             if np.any(bone.mlab_source.scalars[x_idx, y_idx, z_idx]):
-#                 shared_vars.drill_contact = True
-#             else:
-#                 shared_vars.drill_contact = False
-#
-#             # Mask voxels intersecting with the drill
-#             bone.mlab_source.scalars[x_idx, y_idx, z_idx] = 0
-#             # print("Compute Mask:",time.time()-start)
-#             return True
-#         else:
-#             shared_vars.drill_contact = False
-#             return False
-#
-#
-# volumeNode=slicer.util.getNode('MRHead')
-# ijkToRas = vtk.vtkMatrix4x4()
-# volumeNode.GetIJKToRASMatrix(ijkToRas)
-#
-# for k in range(extent[4], extent[5]+1):
-#   for j in range(extent[2], extent[3]+1):
-#     for i in range(extent[0], extent[1]+1):
-#       position_Ijk=[i, j, k, 1]
-#       position_Ras=ijkToRas.MultiplyPoint(position_Ijk)
-#       r=position_Ras[0]
-#       a=position_Ras[1]
-#       s=position_Ras[2]
-#       functionValue=(r-10)*(r-10)+(a+15)*(a+15)+s*s
-#       imageData.SetScalarComponentFromDouble(i,j,k,0,functionValue)
-# imageData.Modified()
-#
-#
-#
-# >>>
-# >>> volumeNode.GetRASToIJKMatrix(rasToijk)
-# >>> rasToijk
-# (vtkCommonMathPython.vtkMatrix4x4)0x7fa1c167a940
-# >>> X = get_drill_position()
-# >>> X
-# array([  98.03942743,   54.84340186, -709.32807135])
-# >>> rasToijk.MultiplyPoint(X)
-# Traceback (most recent call last):
-#   File "<console>", line 1, in <module>
-# TypeError: MultiplyPoint argument 1: expected a sequence of 4 values, got 3 values
-# >>> rasToijk.MultiplyPoint(X.append(1))
-# Traceback (most recent call last):
-#   File "<console>", line 1, in <module>
-# AttributeError: 'numpy.ndarray' object has no attribute 'append'
-# >>> [X,1]
-# [array([  98.03942743,   54.84340186, -709.32807135]), 1]
-# >>> X.append(1)
-# Traceback (most recent call last):
-#   File "<console>", line 1, in <module>
-# AttributeError: 'numpy.ndarray' object has no attribute 'append'
-# >>>  Y = np.append(X,1)
-#   File "<console>", line 1
-#     Y = np.append(X,1)
-#     ^
-# IndentationError: unexpected indent
-# >>> Y = np.append(X,1)
-# >>> rasToijk.MultiplyPoint(Y)
-# (0.6970177888870239, 387.1557312011719, 376.3438720703125, 1.0)
-# >>> O = volumeNode.GetOrigin()
-# >>> np.append(O,1)
-# array([  98.30761719,  203.80761719, -897.5       ,    1.        ])
-# >>> rasToijk.MultiplyPoint(O)
-# Traceback (most recent call last):
-#   File "<console>", line 1, in <module>
-# TypeError: MultiplyPoint argument 1: expected a sequence of 4 values, got 3 values
-# >>> O = np.append(O,1)
-# >>> rasToijk.MultiplyPoint(O)
-# (0.0, 2.2737367544323206e-13, -2.2737367544323206e-13, 1.0)
-# >>>
+_sphere_stencils = {}
+
+
+def sphere_stencil(radius, spacing):
+    """ (N,3) int array of (k, j, i) offsets of the voxels whose centers are within radius (mm) of the center voxel
+    INPUT: radius  [float] - sphere radius in mm
+           spacing [3]     - voxel spacing along i, j, k in mm
+    Stencils are cached per (radius, spacing) so they are only built once per tool """
+    key = (round(float(radius), 6), tuple(round(float(s), 6) for s in spacing))
+    stencil = _sphere_stencils.get(key)
+    if stencil is None:
+        spacing_kji = np.asarray(spacing, dtype=float)[::-1]
+        half = np.floor(radius / spacing_kji).astype(int)
+        k, j, i = np.meshgrid(*[np.arange(-h, h + 1) for h in half], indexing='ij')
+        offsets = np.stack([k.ravel(), j.ravel(), i.ravel()], axis=1)
+        inside = np.sum((offsets * spacing_kji) ** 2, axis=1) <= radius ** 2
+        stencil = offsets[inside]
+        _sphere_stencils[key] = stencil
+    return stencil
+
+
+class SlicerDrillTip:
+    """ Spherical burr that removes material (sets voxels to 0) from a SlicerVolumeModel along a swept path, either
+    given as a list of RAS positions (e.g. a planned trajectory) or streamed from a tracked tool transform.
+    Voxels with a protected label are never removed; touching them is reported as contact. Removed voxels are
+    recorded per stroke (flat index + previous value) so strokes can be undone. Strokes are split every
+    max_stroke_voxels removed voxels (a tracked session is one long stroke) and the oldest strokes are dropped beyond
+    undo_limit strokes or undo_voxel_limit recorded voxels """
+
+    def __init__(self, volume_model, radius, protected_labels=(), max_batch_voxels=4000000, undo_limit=50,
+                 transform_cache=None, undo_voxel_limit=20000000, max_stroke_voxels=2000000):
+        self.volume_model = volume_model
+        self.transform_cache = transform_cache  # optional TransformChainCache for the tracked tool pose
+        self.radius = radius
+        self.protected_labels = np.asarray(protected_labels)
+        self.max_batch_voxels = int(max_batch_voxels)
+        self.undo_limit = undo_limit
+        self.undo_voxel_limit = int(undo_voxel_limit)
+        self.max_stroke_voxels = int(max_stroke_voxels)
+
+        volume_node = volume_model.label_volumeNode
+        ras_to_ijk = vtk.vtkMatrix4x4()  # Slicer calls this RAS to IJK coordinates
+        volume_node.GetRASToIJKMatrix(ras_to_ijk)
+        self.ras_to_ijk = arrayFromVTKMatrix(ras_to_ijk)
+        self.stencil = sphere_stencil(radius, volume_node.GetSpacing())
+        self.stencil_min = self.stencil.min(axis=0)
+        self.stencil_max = self.stencil.max(axis=0)
+        # Path samples closer than half the smallest voxel radius leave no gaps between stencils
+        self.step_voxels = max(0.5 * np.min(radius / np.asarray(volume_node.GetSpacing())), 0.5)
+
+        self.undo_stack = []  # strokes, each a list of (flat indices, previous values)
+        self.current_stroke = None
+        self.current_stroke_voxels = 0
+        self.undo_voxels = 0  # voxels recorded in the undo stack and the current stroke
+        self.contact = False
+        self.contact_labels = np.array([], dtype=self.volume_model.voxel_array.dtype)
+        self.contact_listeners = []  # called with the protected labels touched by the last removal
+
+        self.transform_node = None
+        self.transform_observer = None
+        self.tip_offset = np.zeros(3)
+        self.last_tip_ras = None
+
+    def ras_to_kji(self, points_ras):
+        """ (N,3) RAS positions to continuous (k, j, i) array coordinates """
+        ijk = ras_to_ijk_points(points_ras, ras_to_ijk=self.ras_to_ijk)
+        return ijk[:, ::-1] - np.array(self.volume_model.voxel_extent[0::2])[::-1]
+
+    def sample_path(self, points_kji):
+        """ Resample a polyline in (k, j, i) coordinates so that consecutive stencil centers overlap; returns the
+        unique integer centers """
+        if len(points_kji) > 1:
+            deltas = np.diff(points_kji, axis=0)
+            counts = np.maximum(np.ceil(np.linalg.norm(deltas, axis=1) / self.step_voxels).astype(int), 1)
+            segment = np.repeat(np.arange(len(deltas)), counts)
+            fraction = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)) / np.repeat(counts, counts)
+            samples = points_kji[segment] + deltas[segment] * fraction[:, None]
+            points_kji = np.vstack([samples, points_kji[-1:]])
+        return np.unique(np.rint(points_kji).astype(int), axis=0)
+
+    def remove_along_path(self, points_ras):
+        """ Remove the material swept by the burr moving through the RAS positions (N,3)
+        OUTPUT: removed [int] - number of voxels removed """
+        centers = self.sample_path(self.ras_to_kji(points_ras))
+        voxels = self.volume_model.voxel_array
+        shape = np.array(voxels.shape)
+        # Drop centers whose stencil cannot reach the volume
+        reachable = np.all((centers + self.stencil_max >= 0) & (centers + self.stencil_min < shape), axis=1)
+        centers = centers[reachable]
+        if len(centers) == 0:
+            return 0
+
+        flat_voxels = voxels.reshape(-1)
+        index_dtype = np.uint32 if voxels.size < 2 ** 32 else np.int64
+        batch = max(self.max_batch_voxels // len(self.stencil), 1)
+        removed = 0
+        touched = []
+        for b in range(0, len(centers), batch):
+            kji = (centers[b:b + batch, None, :] + self.stencil[None, :, :]).reshape(-1, 3)
+            kji = kji[np.all((kji >= 0) & (kji < shape), axis=1)]
+            flat = np.unique(np.ravel_multi_index(kji.T, shape))
+            values = flat_voxels[flat]
+            keep = values != 0
+            if self.protected_labels.size:
+                is_protected = np.isin(values, self.protected_labels)
+                if np.any(is_protected):
+                    touched.append(np.unique(values[is_protected]))
+                keep &= ~is_protected
+            flat = flat[keep]
+            if len(flat) == 0:
+                continue
+            self.record_undo(flat.astype(index_dtype), values[keep])
+            flat_voxels[flat] = 0
+            removed += len(flat)
+
+        self.contact = len(touched) > 0
+        self.contact_labels = np.unique(np.concatenate(touched)) if touched else self.contact_labels[:0]
+        if self.contact:
+            for listener in self.contact_listeners:
+                listener(self.contact_labels)
+        if removed:
+            self.volume_model.mark_dirty(centers.min(axis=0) + self.stencil_min, centers.max(axis=0) + self.stencil_max)
+        return removed
+
+    def record_undo(self, flat, values):
+        self.undo_voxels += len(flat)
+        if self.current_stroke is None:
+            self.push_stroke([(flat, values)])
+            return
+        self.current_stroke.append((flat, values))
+        self.current_stroke_voxels += len(flat)
+        if self.current_stroke_voxels >= self.max_stroke_voxels:
+            # Close the stroke so that the voxel limit can drop its oldest parts
+            self.push_stroke(self.current_stroke)
+            self.current_stroke = []
+            self.current_stroke_voxels = 0
+
+    def push_stroke(self, stroke):
+        self.undo_stack.append(stroke)
+        while self.undo_stack and (len(self.undo_stack) > self.undo_limit or
+                                   self.undo_voxels > self.undo_voxel_limit):
+            self.undo_voxels -= sum(len(flat) for flat, _ in self.undo_stack.pop(0))
+
+    def begin_stroke(self):
+        """ Group all following removals into one undo step (until end_stroke or max_stroke_voxels) """
+        self.current_stroke = []
+        self.current_stroke_voxels = 0
+
+    def end_stroke(self):
+        if self.current_stroke:
+            self.push_stroke(self.current_stroke)
+        self.current_stroke = None
+        self.current_stroke_voxels = 0
+
+    def undo(self):
+        """ Restore the voxels removed by the last stroke. OUTPUT: restored [int] - number of voxels restored """
+        if not self.undo_stack:
+            return 0
+        flat_voxels = self.volume_model.voxel_array.reshape(-1)
+        shape = self.volume_model.voxel_array.shape
+        restored = 0
+        for flat, values in reversed(self.undo_stack.pop()):
+            flat_voxels[flat] = values
+            self.volume_model.mark_dirty_indices(*np.unravel_index(flat, shape))
+            restored += len(flat)
+        self.undo_voxels -= restored
+        return restored
+
+    def attach_to_transform(self, transform_node, tip_offset=(0.0, 0.0, 0.0)):
+        """ Follow a tracked tool: material is removed between consecutive tip positions each time the transform
+        changes. tip_offset is the burr center in the transform coordinates. Removals until detach() form one stroke """
+        self.detach()
+        self.transform_node = transform_node
+        self.tip_offset = np.asarray(tip_offset, dtype=float)
+        self.last_tip_ras = None
+        self.begin_stroke()
+        self.transform_observer = transform_node.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent,
+                                                             self.transform_callback)
+
+    def detach(self):
+        if self.transform_node is not None:
+            self.transform_node.RemoveObserver(self.transform_observer)
+            self.end_stroke()
+        self.transform_node = None
+        self.transform_observer = None
+
+    def transform_callback(self, caller, event):
+        tip = arrayFromTransformMatrix(caller, toWorld=True, transformCache=self.transform_cache) @ \
+            np.append(self.tip_offset, 1.0)
+        path = [tip[:3]] if self.last_tip_ras is None else [self.last_tip_ras, tip[:3]]
+        self.last_tip_ras = tip[:3]
+        self.remove_along_path(path)
+
+
+# One logged tool pose: time (s since epoch), tip and axis (RAS), nearest trajectory number and its deviations
+DEVIATION_RECORD = np.dtype([('time', '<f8'), ('tip', '<f4', (3,)), ('axis', '<f4', (3,)), ('trajectory', '<i4'),
+                             ('target_mm', '<f4'), ('lateral_mm', '<f4'), ('remaining_mm', '<f4'),
+                             ('angle_deg', '<f4')])
+
+
+class ToolDeviationMonitor:
+    """ Live deviation of a tracked tool (e.g. a needle pose received on an IGTL connector, see make_igtl_node) from
+    the planned trajectories. Every pose is processed when its transform changes: deviations from all trajectories are
+    computed in one vectorized pass, the nearest trajectory is picked and the pose is logged to a binary ring buffer.
+    The UI is only updated by a timer at display rate (update_listeners get the latest deviations). The to-world
+    pose is read through a TransformChainCache, so tools under registration / tracker transforms only recompute
+    their own matrix per pose """
+
+    def __init__(self, tip_offset=(0.0, 0.0, 0.0), tool_axis=(0.0, 0.0, 1.0), log_filename=None,
+                 log_capacity=360000, display_rate_hz=30, transform_cache=None):
+        self.tip_offset = np.asarray(tip_offset, dtype=float)
+        axis = np.asarray(tool_axis, dtype=float)
+        self.tool_axis = axis / np.linalg.norm(axis)
+        self.trajectory_numbers = np.zeros(0, dtype=int)
+        self.entries = np.zeros((0, 3))
+        self.targets = np.zeros((0, 3))
+        # 360000 records is 30 min at 200 Hz
+        self.log = sio.RingBufferLog(log_filename, DEVIATION_RECORD, log_capacity) if log_filename else None
+
+        self.latest = None
+        self.pose_count = 0
+        self.displayed_count = 0
+        self.displayed_time = time.perf_counter()
+        self.pose_rate_hz = 0.0
+        self.update_listeners = []  # called with the latest deviations (dict) at display rate
+
+        self.display_timer = qt.QTimer()
+        self.display_timer.setInterval(int(1000 / display_rate_hz))
+        self.display_timer.timeout.connect(self.notify)
+        self.owns_transform_cache = transform_cache is None
+        self.transform_cache = transform_cache if transform_cache is not None else TransformChainCache()
+        self.transform_node = None
+        self.transform_observer = None
+
+    def set_trajectories(self, trajectory_numbers, entries, targets):
+        self.trajectory_numbers = np.asarray(trajectory_numbers, dtype=int)
+        self.entries = np.asarray(entries, dtype=float).reshape(-1, 3)
+        self.targets = np.asarray(targets, dtype=float).reshape(-1, 3)
+
+    def attach_to_transform(self, transform_node):
+        self.detach()
+        self.transform_node = transform_node
+        self.transform_observer = transform_node.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent,
+                                                             self.transform_callback)
+        self.displayed_time = time.perf_counter()
+        self.display_timer.start()
+
+    def detach(self):
+        if self.transform_node is not None:
+            self.transform_node.RemoveObserver(self.transform_observer)
+        self.transform_node = None
+        self.transform_observer = None
+        self.display_timer.stop()
+        if self.owns_transform_cache:
+            self.transform_cache.clear()
+        if self.log:
+            self.log.flush()
+
+    def transform_callback(self, caller, event):
+        # This observer may run before the cache's own one: invalidate the tool (its parents stay cached)
+        self.transform_cache.invalidate(caller.GetID())
+        self.process_pose(self.transform_cache.to_world(caller), time.time())
+
+    def process_pose(self, matrix, timestamp):
+        """ Compute (and log) the deviations of the tool pose given by a 4x4 tool-to-RAS matrix (not modified) """
+        tip = matrix[:3, :3] @ self.tip_offset + matrix[:3, 3]
+        axis = matrix[:3, :3] @ self.tool_axis
+        axis /= max(np.linalg.norm(axis), 1e-12)
+        latest = {'time': timestamp, 'tip': tip, 'axis': axis, 'trajectory': -1, 'target_mm': np.nan,
+                  'lateral_mm': np.nan, 'remaining_mm': np.nan, 'angle_deg': np.nan}
+        if len(self.entries):
+            deviations = sg.tool_deviations(tip, axis, self.entries, self.targets)
+            nearest = int(np.argmin(deviations['segment_mm']))
+            latest['trajectory'] = int(self.trajectory_numbers[nearest])
+            for key in ('target_mm', 'lateral_mm', 'remaining_mm', 'angle_deg'):
+                latest[key] = float(deviations[key][nearest])
+        self.latest = latest
+        self.pose_count += 1
+        if self.log:
+            self.log.append((timestamp, tip, axis, latest['trajectory'], latest['target_mm'], latest['lateral_mm'],
+                             latest['remaining_mm'], latest['angle_deg']))
+
+    def notify(self):
+        if self.pose_count == self.displayed_count:
+            return
+        now = time.perf_counter()
+        self.pose_rate_hz = (self.pose_count - self.displayed_count) / max(now - self.displayed_time, 1e-6)
+        self.displayed_count = self.pose_count
+        self.displayed_time = now
+        for listener in self.update_listeners:
+            listener(self.latest)
@@ -0,0 +1,553 @@
+""" surgery_planner_io
+Readers and writers for the SurgeryPlanner output formats (see Resources/OUTPUT_FORMATS.md).
+
+This module only depends on numpy so that it can be used outside of Slicer (e.g. batch scripts). DICOM reading
+additionally needs pydicom (bundled with Slicer).
+"""
+
+import os
+import io
+import json
+import importlib.util
+import hashlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+# pydicom is imported on first use so that loading this module stays cheap (see _require_pydicom)
+pydicom = None
+
+
+def pydicom_available():
+    return importlib.util.find_spec('pydicom') is not None
+
+
+def _require_pydicom():
+    global pydicom
+    if pydicom is None:
+        try:
+            import pydicom as module
+        except ImportError:
+            raise ImportError("pydicom is required to read DICOM series")
+        pydicom = module
+    return pydicom
+
+PLANE_FILE_HEADER = "PlaneName," + ",".join(f"Matrix{r}{c}" for r in range(4) for c in range(4)) + ",Width,Height"
+
+# M_LPS = T * M_RAS * T where T = diag(-1, -1, 1, 1); the same operation converts back
+_LPS_RAS_SIGNS = np.outer([-1.0, -1.0, 1.0, 1.0], [-1.0, -1.0, 1.0, 1.0])
+
+
+def convert_matrices_lps_ras(matrices):
+    """Convert a stack of (N,4,4) homogeneous matrices between LPS and RAS (the conversion is its own inverse)."""
+    return np.asarray(matrices, dtype=float) * _LPS_RAS_SIGNS
+
+
+def _read_header_value(line, key):
+    # Header lines look like "# Key: Value"
+    body = line.lstrip('#').strip()
+    if body.startswith(key + ':'):
+        return body.split(':', 1)[1].strip()
+    return None
+
+
+def read_planes_file(filename):
+    """Read a reference planes file written by the ReferencePlanePlanner.
+    INPUT:  filename [str] - planes TXT file or its binary (.npz) equivalent
+    OUTPUT: dict with keys
+              names             [list of str]   - plane names
+              matrices          [(N,4,4) array] - Object-to-World matrices
+              sizes             [(N,2) array]   - width, height in mm
+              coordinate_system [str]           - 'RAS' or 'LPS' (as stored in the file)
+              timestamp         [str or None]   - ISO timestamp of the TXT header
+    """
+    if os.path.splitext(filename)[1].lower() == '.npz':
+        with np.load(filename, allow_pickle=False) as data:
+            return {
+                'names': [str(n) for n in data['names']],
+                'matrices': np.array(data['matrices'], dtype=float).reshape(-1, 4, 4),
+                'sizes': np.array(data['sizes'], dtype=float).reshape(-1, 2),
+                'coordinate_system': str(data['coordinate_system']),
+                'timestamp': None,
+            }
+
+    coordinate_system = 'RAS'
+    timestamp = None
+    data_lines = []
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('#'):
+                value = _read_header_value(line, 'CoordinateSystem')
+                if value:
+                    coordinate_system = value
+                timestamp = _read_header_value(line, 'Timestamp') or timestamp
+                continue
+            if line.startswith('PlaneName,'):
+                continue
+            data_lines.append(line)
+
+    if not data_lines:
+        return {'names': [], 'matrices': np.zeros((0, 4, 4)), 'sizes': np.zeros((0, 2)),
+                'coordinate_system': coordinate_system, 'timestamp': timestamp}
+
+    # Parse all numeric columns in one pass; the name column is split off separately
+    names = [line.split(',', 1)[0] for line in data_lines]
+    values = np.loadtxt(data_lines, delimiter=',', usecols=range(1, 19), ndmin=2)
+    return {
+        'names': names,
+        'matrices': values[:, :16].reshape(-1, 4, 4),
+        'sizes': values[:, 16:18].copy(),
+        'coordinate_system': coordinate_system,
+        'timestamp': timestamp,
+    }
+
+
+def read_landmarks_file(filename):
+    """Read a landmarks file written by the TrajectoryPlanner.
+    INPUT:  filename [str] - landmarks TXT file (Trajectory,Landmark,X,Y,Z rows)
+    OUTPUT: dict with keys
+              trajectory_numbers [(N,) int array] - trajectories having both an entry and a target
+              entries            [(N,3) array]    - entry positions
+              targets            [(N,3) array]    - target positions
+              coordinate_system  [str]            - as stated in the header
+              timestamp          [str or None]    - ISO timestamp of the header
+    """
+    coordinate_system = 'RAS'
+    timestamp = None
+    entries = {}
+    targets = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('#'):
+                coordinate_system = _read_header_value(line, 'CoordinateSystem') or coordinate_system
+                timestamp = _read_header_value(line, 'Timestamp') or timestamp
+                continue
+            parts = line.split(',')
+            if len(parts) < 5 or parts[0] == 'Trajectory':
+                continue
+            kind, _, num = parts[1].strip().rpartition('_')
+            if not num.isdigit():
+                continue
+            position = [float(value) for value in parts[2:5]]
+            if kind == 'Entry':
+                entries[int(num)] = position
+            elif kind == 'Target':
+                targets[int(num)] = position
+
+    nums = sorted(set(entries) & set(targets))
+    return {
+        'trajectory_numbers': np.array(nums, dtype=np.int32),
+        'entries': np.array([entries[n] for n in nums], dtype=float).reshape(-1, 3),
+        'targets': np.array([targets[n] for n in nums], dtype=float).reshape(-1, 3),
+        'coordinate_system': coordinate_system,
+        'timestamp': timestamp,
+    }
+
+
+def detect_plan_file(filename):
+    """Return 'landmarks' or 'planes' for the TXT outputs of the planners (from their column header), else None."""
+    try:
+        with open(filename, 'r') as f:
+            for _, line in zip(range(16), f):
+                if line.startswith('Trajectory,Landmark,'):
+                    return 'landmarks'
+                if line.startswith('PlaneName,'):
+                    return 'planes'
+    except (OSError, UnicodeDecodeError):
+        pass
+    return None
+
+
+def write_planes_npz(filename, names, matrices, sizes, coordinate_system='RAS'):
+    """Write reference planes to the binary (.npz) equivalent of the planes TXT format (atomically, see
+    write_file_atomic)."""
+    buffer = io.BytesIO()
+    np.savez(buffer,
+             names=np.array(names, dtype=str),
+             matrices=np.asarray(matrices, dtype=float).reshape(-1, 4, 4),
+             sizes=np.asarray(sizes, dtype=float).reshape(-1, 2),
+             coordinate_system=np.array(coordinate_system))
+    if not filename.endswith('.npz'):  # as np.savez does for file names
+        filename += '.npz'
+    write_file_atomic(filename, buffer.getvalue())
+
+
+def write_table_csv(filename, columns, header_comments=None):
+    """Write a dict of equal-length 1-D arrays to a CSV file (one column per key).
+    Float columns are written with 4 decimals to match the other planner outputs."""
+    names = list(columns.keys())
+    arrays = [np.asarray(columns[name]) for name in names]
+    n_rows = len(arrays[0]) if arrays else 0
+    formatted = []
+    for array in arrays:
+        if array.dtype.kind == 'f':
+            formatted.append(np.char.mod('%.4f', array))
+        else:
+            formatted.append(array.astype(str))
+    with open(filename, 'w') as f:
+        for comment in header_comments or []:
+            f.write(f"# {comment}\n")
+        f.write(",".join(names) + "\n")
+        for r in range(n_rows):
+            f.write(",".join(column[r] for column in formatted) + "\n")
+
+
+def directory_signature(directory):
+    """Digest of the names, sizes and modification times of all files under a directory.
+    Any added, removed or rewritten file changes the signature; file contents are not read."""
+    entries = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            entries.append(f"{os.path.relpath(path, directory)}|{stat.st_size}|{stat.st_mtime_ns}")
+    entries.sort()
+    return hashlib.sha1("\n".join(entries).encode()).hexdigest()
+
+
+def _atomic_write_json(filename, data):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp, filename)
+
+
+class VolumeCache:
+    """Persistent index of converted DICOM series.
+    The index (index.json in the cache folder) maps a DICOM directory to its signature (see directory_signature)
+    and to the series it contains: series UID, name, IJK to RAS matrix, display window/level and the raw .npy file
+    holding the voxels. Volumes are stored uncompressed so that they can be memory-mapped when a case is reopened."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.index_file = os.path.join(cache_dir, 'index.json')
+        self.index = {}
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, 'r') as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"[VolumeCache] Ignoring unreadable index {self.index_file}: {e}")
+
+    def lookup(self, directory):
+        """Return the cached series of a DICOM directory, or None when it is unknown or has changed on disk."""
+        entry = self.index.get(os.path.abspath(directory))
+        if entry is None or entry['signature'] != directory_signature(directory):
+            return None
+        if not all(os.path.exists(series['array_file']) for series in entry['series']):
+            return None
+        return entry['series']
+
+    def store(self, directory, series_list):
+        """Cache the series loaded from a DICOM directory.
+        series_list: dicts with keys series_uid, name, array [(K,J,I) array], ijk_to_ras [(4,4)] and
+        optionally window / level."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        stored = []
+        for series in series_list:
+            digest = hashlib.sha1(series['series_uid'].encode()).hexdigest()
+            array_file = os.path.join(self.cache_dir, digest + '.npy')
+            tmp = array_file + '.tmp.npy'
+            np.save(tmp, np.ascontiguousarray(series['array']))
+            os.replace(tmp, array_file)
+            stored.append({
+                'series_uid': series['series_uid'],
+                'name': series['name'],
+                'ijk_to_ras': np.asarray(series['ijk_to_ras'], dtype=float).tolist(),
+                'window': series.get('window'),
+                'level': series.get('level'),
+                'array_file': array_file,
+            })
+        self.index[os.path.abspath(directory)] = {'signature': directory_signature(directory), 'series': stored}
+        _atomic_write_json(self.index_file, self.index)
+        return stored
+
+    @staticmethod
+    def load_array(series):
+        """Memory-map the voxels of a cached series (read-only)."""
+        return np.load(series['array_file'], mmap_mode='r')
+
+
+def _read_dicom_header(filename):
+    try:
+        ds = pydicom.dcmread(filename, stop_before_pixels=True)
+    except Exception:  # not a DICOM file
+        return None
+    required = ('SeriesInstanceUID', 'ImagePositionPatient', 'ImageOrientationPatient', 'PixelSpacing', 'Rows', 'Columns')
+    if not all(key in ds for key in required) or int(ds.get('NumberOfFrames', 1) or 1) > 1:
+        return None
+    return {
+        'file': filename,
+        'series_uid': str(ds.SeriesInstanceUID),
+        'description': str(ds.get('SeriesDescription', '')),
+        'position': np.array(ds.ImagePositionPatient, dtype=float),
+        'orientation': np.array(ds.ImageOrientationPatient, dtype=float),
+        'spacing': np.array(ds.PixelSpacing, dtype=float),
+        'shape': (int(ds.Rows), int(ds.Columns)),
+        'slope': float(ds.get('RescaleSlope', 1.0) or 1.0),
+        'intercept': float(ds.get('RescaleIntercept', 0.0) or 0.0),
+        'unsigned16': int(ds.get('PixelRepresentation', 1)) == 0 and int(ds.get('BitsStored', 16)) > 15,
+        'window': float(np.ravel(ds.WindowWidth)[0]) if 'WindowWidth' in ds else None,
+        'level': float(np.ravel(ds.WindowCenter)[0]) if 'WindowCenter' in ds else None,
+    }
+
+
+def read_dicom_series(directory, workers=None):
+    """Read the headers of all DICOM files under a directory (in a thread pool) and group them into series.
+    OUTPUT: list of dicts with keys
+              series_uid, name     [str]
+              files                [list of str]       - slice files sorted by position along the slice normal
+              shape                [tuple]             - (K, J, I) volume shape
+              dtype                [numpy dtype]       - integer when rescaling keeps integer values, float32 otherwise
+              slopes, intercepts   [(K,) arrays]       - per-slice rescale
+              ijk_to_ras           [(4,4) array]
+              window, level        [float or None]
+    """
+    _require_pydicom()
+    files = [os.path.join(root, name) for root, _, names in os.walk(directory) for name in names]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        headers = [h for h in pool.map(_read_dicom_header, files) if h is not None]
+
+    grouped = {}
+    for header in headers:
+        grouped.setdefault(header['series_uid'], []).append(header)
+    series_list = []
+    for series_uid, slices in grouped.items():
+        orientation = slices[0]['orientation']
+        row_dir, col_dir = orientation[:3], orientation[3:]
+        normal = np.cross(row_dir, col_dir)
+        # Skip mixed-geometry series (e.g. localizers sharing a UID)
+        slices = [h for h in slices if h['shape'] == slices[0]['shape'] and np.allclose(h['orientation'], orientation, atol=1e-4)]
+        distances = np.array([h['position'] @ normal for h in slices])
+        order = np.argsort(distances, kind='stable')
+        slices = [slices[i] for i in order]
+        distances = distances[order]
+        slice_spacing = float(np.median(np.diff(distances))) if len(slices) > 1 else 1.0
+        if slice_spacing <= 0:
+            slice_spacing = 1.0
+
+        # DICOM patient coordinates are LPS: i follows the rows direction (column spacing), j the columns direction
+        ijk_to_lps = np.eye(4)
+        ijk_to_lps[:3, 0] = row_dir * slices[0]['spacing'][1]
+        ijk_to_lps[:3, 1] = col_dir * slices[0]['spacing'][0]
+        ijk_to_lps[:3, 2] = normal * slice_spacing
+        ijk_to_lps[:3, 3] = slices[0]['position']
+        ijk_to_ras = np.diag([-1.0, -1.0, 1.0, 1.0]) @ ijk_to_lps
+
+        slopes = np.array([h['slope'] for h in slices])
+        intercepts = np.array([h['intercept'] for h in slices])
+        integer = np.all(slopes == 1.0) and np.all(intercepts == np.round(intercepts))
+        integer_dtype = np.int32 if slices[0]['unsigned16'] else np.int16
+        series_list.append({
+            'series_uid': series_uid,
+            'name': slices[0]['description'] or series_uid,
+            'files': [h['file'] for h in slices],
+            'shape': (len(slices),) + slices[0]['shape'],
+            'dtype': np.dtype(integer_dtype if integer else np.float32),
+            'slopes': slopes,
+            'intercepts': intercepts,
+            'ijk_to_ras': ijk_to_ras,
+            'window': slices[0]['window'],
+            'level': slices[0]['level'],
+        })
+    return series_list
+
+
+def _decode_slices(files, indices, slopes, intercepts, out):
+    _require_pydicom()  # pool worker processes start without it
+    for filename, k, slope, intercept in zip(files, indices, slopes, intercepts):
+        pixels = pydicom.dcmread(filename).pixel_array
+        if slope != 1.0 or intercept != 0.0:
+            np.multiply(pixels, slope, out=out[k], casting='unsafe')
+            out[k] += np.asarray(intercept).astype(out.dtype)
+        else:
+            out[k] = pixels
+
+
+def _decode_slices_shared(shm_name, shape, dtype, files, indices, slopes, intercepts):
+    # Process pool entry point: slices are written into the shared volume buffer
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        _decode_slices(files, indices, slopes, intercepts, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    finally:
+        shm.close()
+
+
+def decode_dicom_series(series, out=None, workers=None, use_processes=False, executable=None):
+    """Decode the slices of a series (from read_dicom_series) straight into a (K,J,I) volume.
+    out may be a preallocated array (e.g. the voxels of a volume node) of the series shape; slices are decoded by
+    a thread pool, or by a process pool writing into shared memory when use_processes is set."""
+    shape, dtype = series['shape'], series['dtype']
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    files = series['files']
+    workers = workers or os.cpu_count() or 1
+    chunks = [c for c in np.array_split(np.arange(len(files)), workers) if len(c)]
+
+    def chunk_args(c):
+        return [files[k] for k in c], c, series['slopes'][c], series['intercepts'][c]
+
+    if not use_processes:
+        with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+            for future in [pool.submit(_decode_slices, *chunk_args(c), out) for c in chunks]:
+                future.result()
+        return out
+
+    context = multiprocessing.get_context('spawn')
+    if executable:
+        context.set_executable(executable)
+    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    try:
+        with ProcessPoolExecutor(max_workers=len(chunks), mp_context=context) as pool:
+            futures = [pool.submit(_decode_slices_shared, shm.name, shape, dtype.str, *chunk_args(c)) for c in chunks]
+            for future in futures:
+                future.result()
+        out[...] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    finally:
+        shm.close()
+        shm.unlink()
+    return out
+
+
+# Session snapshot layout: magic | uint32 header length | JSON header | arrays (8-byte aligned, raw C order).
+# The header holds the metadata and, per array, its dtype, shape and offset in the array section.
+SNAPSHOT_MAGIC = b'SPSNAP01'
+
+
+def pack_snapshot(metadata, arrays):
+    """Pack a metadata dict (JSON-serializable) and a dict of numpy arrays into one binary blob."""
+    specs = {}
+    chunks = []
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        specs[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        data = array.tobytes()
+        padding = -len(data) % 8
+        chunks.append(data + b'\0' * padding)
+        offset += len(data) + padding
+    header = json.dumps({'metadata': metadata, 'arrays': specs}).encode()
+    header += b' ' * (-(len(SNAPSHOT_MAGIC) + 4 + len(header)) % 8)
+    return b''.join([SNAPSHOT_MAGIC, np.uint32(len(header)).tobytes(), header] + chunks)
+
+
+def _snapshot_header(data):
+    if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError("Not a SurgeryPlanner session snapshot")
+    start = len(SNAPSHOT_MAGIC) + 4
+    length = int(np.frombuffer(data[len(SNAPSHOT_MAGIC):start], dtype=np.uint32)[0])
+    return json.loads(bytes(data[start:start + length]).decode()), start + length
+
+
+def unpack_snapshot(data):
+    """Inverse of pack_snapshot. OUTPUT: metadata [dict], arrays [dict of numpy arrays]"""
+    header, data_start = _snapshot_header(data)
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape'], dtype=np.int64))
+        arrays[name] = np.frombuffer(data, dtype=dtype, count=count,
+                                     offset=data_start + spec['offset']).reshape(spec['shape']).copy()
+    return header['metadata'], arrays
+
+
+def write_file_atomic(filename, data):
+    """Write bytes so that readers (or a crash) only ever see the previous or the complete new file."""
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+
+def read_snapshot(filename, metadata_only=False):
+    """Read a session snapshot file; with metadata_only only the header is parsed."""
+    with open(filename, 'rb') as f:
+        if not metadata_only:
+            return unpack_snapshot(f.read())
+        prefix = f.read(len(SNAPSHOT_MAGIC) + 4)
+        if len(prefix) < len(SNAPSHOT_MAGIC) + 4:
+            raise ValueError("Truncated session snapshot")
+        length = int(np.frombuffer(prefix[len(SNAPSHOT_MAGIC):], dtype=np.uint32)[0])
+        return _snapshot_header(prefix + f.read(length))[0]['metadata']
+
+
+# Ring buffer log layout: magic | uint64 capacity | uint64 records written | uint32 dtype length | dtype (JSON),
+# padded to RING_HEADER_SIZE, then `capacity` fixed-size records (the oldest are overwritten once full)
+RING_MAGIC = b'SPRING01'
+RING_HEADER_SIZE = 1024
+
+
+def _ring_header(filename):
+    with open(filename, 'rb') as f:
+        header = f.read(RING_HEADER_SIZE)
+    if header[:8] != RING_MAGIC:
+        raise ValueError(f"{filename} is not a SurgeryPlanner ring buffer log")
+    capacity = int(np.frombuffer(header[8:16], dtype=np.uint64)[0])
+    length = int(np.frombuffer(header[24:28], dtype=np.uint32)[0])
+    descr = json.loads(header[28:28 + length].decode())
+    dtype = np.dtype([tuple(field[:2]) + ((tuple(field[2]),) if len(field) > 2 else ()) for field in descr])
+    return dtype, capacity
+
+
+class RingBufferLog:
+    """Fixed-size binary log of numpy records backed by np.memmap (e.g. time-stamped tool deviations).
+    Appending is a single record write, so it can keep up with tracking rates; the OS writes the pages back.
+    INPUT: filename [str], dtype [structured numpy dtype], capacity [int] - records kept (an existing log with the
+           same dtype is continued)
+    """
+
+    def __init__(self, filename, dtype, capacity):
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        if os.path.exists(filename):
+            existing_dtype, capacity = _ring_header(filename)
+            if existing_dtype != self.dtype:
+                raise ValueError(f"{filename} holds records of a different type")
+        else:
+            descr = json.dumps(self.dtype.descr).encode()
+            if 28 + len(descr) > RING_HEADER_SIZE:
+                raise ValueError("Record type too large for the ring buffer header")
+            with open(filename, 'wb') as f:
+                f.write(RING_MAGIC + np.array([capacity, 0], dtype=np.uint64).tobytes() +
+                        np.uint32(len(descr)).tobytes() + descr)
+                f.truncate(RING_HEADER_SIZE + capacity * self.dtype.itemsize)
+        self.counters = np.memmap(filename, dtype=np.uint64, mode='r+', offset=8, shape=(2,))
+        self.records = np.memmap(filename, dtype=self.dtype, mode='r+', offset=RING_HEADER_SIZE, shape=(capacity,))
+
+    def append(self, record):
+        """Append one record (tuple of the field values)."""
+        count = int(self.counters[1])
+        self.records[count % len(self.records)] = record
+        self.counters[1] = count + 1
+
+    def flush(self):
+        self.records.flush()
+        self.counters.flush()
+
+    def read(self):
+        """Return a copy of the records kept, oldest first."""
+        return _ordered_records(self.records, int(self.counters[1]))
+
+
+def _ordered_records(records, count):
+    if count <= len(records):
+        return np.array(records[:count])
+    start = count % len(records)
+    return np.concatenate([records[start:], records[:start]])
+
+
+def read_ring_buffer(filename):
+    """Read a RingBufferLog file (read-only) for review. OUTPUT: structured array of the records, oldest first"""
+    dtype, capacity = _ring_header(filename)
+    count = int(np.fromfile(filename, dtype=np.uint64, count=2, offset=8)[1])
+    records = np.memmap(filename, dtype=dtype, mode='r', offset=RING_HEADER_SIZE, shape=(capacity,))
+    return _ordered_records(records, count)
@@ -0,0 +1,294 @@
+""" surgery_planner_store
+Local, indexed repository of plan revisions backed by SQLite.
+
+A plan is identified by the series it was made on and a name. Every save adds a revision holding the trajectories and
+reference planes as one binary blob (the session snapshot layout of surgery_planner_io.pack_snapshot), next to indexed
+metadata: series / patient UID, timestamp, author and counts. Like surgery_planner_io, this module does not depend on
+Slicer.
+"""
+
+import os
+import sqlite3
+import time
+import getpass
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from . import surgery_planner_io as sio
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plans (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    series_uid TEXT NOT NULL DEFAULT '',
+    patient_id TEXT NOT NULL DEFAULT '',
+    UNIQUE (series_uid, name)
+);
+CREATE TABLE IF NOT EXISTS revisions (
+    id INTEGER PRIMARY KEY,
+    plan_id INTEGER NOT NULL REFERENCES plans (id),
+    revision INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    author TEXT NOT NULL DEFAULT '',
+    trajectory_count INTEGER NOT NULL,
+    plane_count INTEGER NOT NULL,
+    source TEXT,
+    data BLOB NOT NULL,
+    UNIQUE (plan_id, revision)
+);
+CREATE INDEX IF NOT EXISTS plans_patient ON plans (patient_id);
+CREATE INDEX IF NOT EXISTS revisions_timestamp ON revisions (timestamp);
+CREATE INDEX IF NOT EXISTS revisions_author ON revisions (author);
+CREATE UNIQUE INDEX IF NOT EXISTS revisions_source ON revisions (source) WHERE source IS NOT NULL;
+"""
+
+# Columns returned by PlanStore.query (the blob is only read by load_revision)
+LISTING_COLUMNS = ('revision_id', 'name', 'series_uid', 'patient_id', 'revision', 'timestamp', 'author',
+                   'trajectory_count', 'plane_count')
+
+
+def empty_plan_arrays():
+    """Arrays of a plan without trajectories or planes (see SurgeryPlannerLogic.collectSessionState)."""
+    return {'trajectory_numbers': np.zeros(0, dtype=np.int32), 'entries': np.zeros((0, 3)),
+            'targets': np.zeros((0, 3)), 'plane_matrices': np.zeros((0, 4, 4)), 'plane_sizes': np.zeros((0, 2)),
+            'plane_display': np.zeros((0, 5), dtype=np.float32)}
+
+
+def _file_source(filename):
+    # Identifies an imported file version, so that bulk imports can be re-run without duplicating revisions
+    stat = os.stat(filename)
+    return f"{os.path.abspath(filename)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+
+def _parse_timestamp(value, default):
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return default
+
+
+def read_plan_file(filename):
+    """Read a landmarks or planes TXT output as plan (metadata, arrays, timestamp), or None for other files."""
+    kind = sio.detect_plan_file(filename)
+    if kind is None:
+        return None
+    metadata = {'plane_names': [], 'landmark_display': None, 'selected_trajectory': None, 'selected_plane': None}
+    arrays = empty_plan_arrays()
+    if kind == 'landmarks':
+        # Landmark positions are written in RAS whatever the CoordinateSystem header says
+        landmarks = sio.read_landmarks_file(filename)
+        arrays['trajectory_numbers'] = landmarks['trajectory_numbers']
+        arrays['entries'] = landmarks['entries']
+        arrays['targets'] = landmarks['targets']
+        timestamp = landmarks['timestamp']
+    else:
+        planes = sio.read_planes_file(filename)
+        matrices = planes['matrices']
+        if planes['coordinate_system'] == 'LPS':
+            matrices = sio.convert_matrices_lps_ras(matrices)
+        metadata['plane_names'] = planes['names']
+        arrays['plane_matrices'] = matrices
+        arrays['plane_sizes'] = planes['sizes']
+        display = np.zeros((len(planes['names']), 5), dtype=np.float32)
+        display[:, 3:] = 0.5, 1.0
+        arrays['plane_display'] = display
+        timestamp = planes['timestamp']
+    return metadata, arrays, _parse_timestamp(timestamp, os.path.getmtime(filename))
+
+
+def combine_plans(plans):
+    """Combine (metadata, arrays) plans, e.g. the landmarks and planes files of one case, into one plan."""
+    metadata = {'plane_names': [], 'landmark_display': None, 'selected_trajectory': None, 'selected_plane': None}
+    arrays = empty_plan_arrays()
+    for plan_metadata, plan_arrays in plans:
+        metadata['plane_names'] = metadata['plane_names'] + list(plan_metadata['plane_names'])
+        arrays = {key: np.concatenate([arrays[key], plan_arrays[key]]) for key in arrays}
+    return metadata, arrays
+
+
+def _group_revisions(files):
+    """Group the parsed files of one directory into revisions: files sorted by timestamp are merged until a kind
+    (landmarks / planes) repeats, so a landmarks file and the planes file saved with it form one revision.
+    INPUT: files [list of (filename, (metadata, arrays, timestamp))]
+    OUTPUT: list of lists of files"""
+    revisions = []
+    kinds = set()
+    for filename, plan in sorted(files, key=lambda item: item[1][2]):
+        kind = 'planes' if len(plan[0]['plane_names']) else 'landmarks'
+        if not revisions or kind in kinds:
+            revisions.append([])
+            kinds = set()
+        revisions[-1].append((filename, plan))
+        kinds.add(kind)
+    return revisions
+
+
+class PlanStore:
+    """SQLite repository of plan revisions.
+    INPUT: path [str] - database file (created on first use)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.migrate()
+
+    def migrate(self):
+        """Create the schema, or upgrade a database written by an older version of the store."""
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(f"Plan store {self.path} was written by a newer version (schema {version})")
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+            self.connection.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+    def close(self):
+        self.connection.close()
+
+    def _plan_id(self, name, series_uid, patient_id):
+        row = self.connection.execute("SELECT id FROM plans WHERE series_uid = ? AND name = ?",
+                                      (series_uid, name)).fetchone()
+        if row:
+            if patient_id:
+                self.connection.execute("UPDATE plans SET patient_id = ? WHERE id = ?", (patient_id, row[0]))
+            return row[0]
+        return self.connection.execute("INSERT INTO plans (name, series_uid, patient_id) VALUES (?, ?, ?)",
+                                       (name, series_uid, patient_id)).lastrowid
+
+    def _insert_revision(self, plan_id, metadata, arrays, timestamp, author, source):
+        revision = self.connection.execute("SELECT COALESCE(MAX(revision), 0) + 1 FROM revisions WHERE plan_id = ?",
+                                           (plan_id,)).fetchone()[0]
+        blob = sio.pack_snapshot(metadata, arrays)
+        return self.connection.execute(
+            "INSERT INTO revisions (plan_id, revision, timestamp, author, trajectory_count, plane_count, source, data)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (plan_id, revision, timestamp, author, len(arrays['trajectory_numbers']), len(arrays['plane_matrices']),
+             source, blob)).lastrowid
+
+    def save_revision(self, name, metadata, arrays, series_uid='', patient_id='', author=None, timestamp=None):
+        """Add a revision of a plan (created if needed).
+        INPUT: metadata, arrays - plan as returned by SurgeryPlannerLogic.collectSessionState
+        OUTPUT: revision id
+        """
+        with self.connection:
+            plan_id = self._plan_id(name, series_uid or '', patient_id or '')
+            return self._insert_revision(plan_id, metadata, arrays, timestamp or time.time(),
+                                         author if author is not None else getpass.getuser(), None)
+
+    def query(self, text=None, series_uid=None, patient_id=None, author=None, since=None, until=None,
+              latest_only=False, limit=1000):
+        """List revisions (newest first) as dicts with the LISTING_COLUMNS keys; blobs are not read.
+        text matches plan names, UIDs and authors; since / until are POSIX timestamps."""
+        conditions = []
+        params = []
+        if text:
+            conditions.append("(p.name LIKE ? OR p.series_uid LIKE ? OR p.patient_id LIKE ? OR r.author LIKE ?)")
+            params += [f"%{text}%"] * 4
+        for column, value in (('p.series_uid', series_uid), ('p.patient_id', patient_id), ('r.author', author)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            conditions.append("r.timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("r.timestamp <= ?")
+            params.append(until)
+        if latest_only:
+            conditions.append("r.revision = (SELECT MAX(revision) FROM revisions WHERE plan_id = r.plan_id)")
+        sql = ("SELECT r.id, p.name, p.series_uid, p.patient_id, r.revision, r.timestamp, r.author,"
+               " r.trajectory_count, r.plane_count FROM revisions r JOIN plans p ON p.id = r.plan_id")
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY r.timestamp DESC LIMIT ?"
+        rows = self.connection.execute(sql, params + [limit]).fetchall()
+        return [dict(zip(LISTING_COLUMNS, row)) for row in rows]
+
+    def load_revision(self, revision_id):
+        """OUTPUT: metadata [dict], arrays [dict of numpy arrays] of a revision"""
+        row = self.connection.execute("SELECT data FROM revisions WHERE id = ?", (revision_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"No plan revision {revision_id}")
+        return sio.unpack_snapshot(row[0])
+
+    def delete_plan(self, name, series_uid=''):
+        with self.connection:
+            row = self.connection.execute("SELECT id FROM plans WHERE series_uid = ? AND name = ?",
+                                          (series_uid, name)).fetchone()
+            if row:
+                self.connection.execute("DELETE FROM revisions WHERE plan_id = ?", (row[0],))
+                self.connection.execute("DELETE FROM plans WHERE id = ?", (row[0],))
+
+    def import_files(self, filenames, series_uid='', patient_id='', author=None, workers=8, root=None):
+        """Bulk import landmarks / planes TXT outputs in one transaction. Each directory is one case: its plan is
+        named after the directory path relative to root (default: the parent of the common directory of the files)
+        and a landmarks file and the planes file saved with it are stored together as one revision.
+        Files are parsed in parallel; files that were already imported (same path, size and mtime) or are not planner
+        outputs are skipped. Revisions are numbered by the timestamp in the file headers.
+        OUTPUT: number of imported revisions
+        """
+        known = set()
+        for (source,) in self.connection.execute("SELECT source FROM revisions WHERE source IS NOT NULL"):
+            known.update(source.split('\n'))
+        sources = {}
+        for filename in filenames:
+            try:
+                source = _file_source(filename)
+            except OSError:
+                continue
+            if source not in known:
+                sources[filename] = source
+
+        def parse(filename):
+            try:
+                return filename, read_plan_file(filename)
+            except Exception as e:
+                print(f"[PlanStore] Skipping {filename}: {e}")
+                return filename, None
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            parsed = [(filename, plan) for filename, plan in executor.map(parse, sources) if plan is not None]
+        if not parsed:
+            return 0
+
+        directories = {}
+        for filename, plan in parsed:
+            directories.setdefault(os.path.dirname(os.path.abspath(filename)), []).append((filename, plan))
+        if root is None:
+            root = os.path.commonpath(list(directories))
+            if root in directories:
+                root = os.path.dirname(root)
+        revisions = []
+        for directory, files in directories.items():
+            name = os.path.relpath(directory, root)
+            if name == os.curdir:
+                name = os.path.basename(directory)
+            for group in _group_revisions(files):
+                metadata, arrays = combine_plans([(plan[0], plan[1]) for _, plan in group])
+                timestamp = max(plan[2] for _, plan in group)
+                source = '\n'.join(sources[filename] for filename, _ in group)
+                revisions.append((timestamp, name, metadata, arrays, source))
+        revisions.sort(key=lambda revision: revision[0])
+
+        author = author if author is not None else getpass.getuser()
+        with self.connection:
+            for timestamp, name, metadata, arrays, source in revisions:
+                plan_id = self._plan_id(name, series_uid, patient_id)
+                self._insert_revision(plan_id, metadata, arrays, timestamp, author, source)
+        return len(revisions)
+
+    def import_directory(self, directory, recursive=True, **kwargs):
+        """Bulk import all planner TXT outputs of a directory (see import_files)."""
+        if recursive:
+            filenames = [os.path.join(root, name) for root, _, names in os.walk(directory) for name in names]
+        else:
+            filenames = [os.path.join(directory, name) for name in os.listdir(directory)]
+        filenames = [name for name in filenames if name.lower().endswith('.txt')]
+        kwargs.setdefault('root', os.path.dirname(os.path.abspath(directory)))
+        return self.import_files(filenames, **kwargs)
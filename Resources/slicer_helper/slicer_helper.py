@@ -49,12 +49,9 @@ def arrayFromVTKMatrix(vmatrix):
   To set VTK matrix from a numpy array, use :py:meth:`vtkMatrixFromArray` or
   :py:meth:`updateVTKMatrixFromArray`.
   """
-    from vtk import vtkMatrix4x4
-    from vtk import vtkMatrix3x3
-    import numpy as np
-    if isinstance(vmatrix, vtkMatrix4x4):
+    if isinstance(vmatrix, vtk.vtkMatrix4x4):
         matrixSize = 4
-    elif isinstance(vmatrix, vtkMatrix3x3):
+    elif isinstance(vmatrix, vtk.vtkMatrix3x3):
         matrixSize = 3
     else:
         raise RuntimeError("Input must be vtk.vtkMatrix3x3 or vtk.vtkMatrix4x4")
@@ -69,15 +66,13 @@ def vtkMatrixFromArray(narray):
   The returned matrix is just a copy and so any modification in the array will not affect the output matrix.
   To set numpy array from VTK matrix, use :py:meth:`arrayFromVTKMatrix`.
   """
-    from vtk import vtkMatrix4x4
-    from vtk import vtkMatrix3x3
     narrayshape = narray.shape
     if narrayshape == (4, 4):
-        vmatrix = vtkMatrix4x4()
+        vmatrix = vtk.vtkMatrix4x4()
         updateVTKMatrixFromArray(vmatrix, narray)
         return vmatrix
     elif narrayshape == (3, 3):
-        vmatrix = vtkMatrix3x3()
+        vmatrix = vtk.vtkMatrix3x3()
         updateVTKMatrixFromArray(vmatrix, narray)
         return vmatrix
     else:
@@ -90,11 +85,9 @@ def updateVTKMatrixFromArray(vmatrix, narray):
   :param narray: input numpy array
   To set numpy array from VTK matrix, use :py:meth:`arrayFromVTKMatrix`.
   """
-    from vtk import vtkMatrix4x4
-    from vtk import vtkMatrix3x3
-    if isinstance(vmatrix, vtkMatrix4x4):
+    if isinstance(vmatrix, vtk.vtkMatrix4x4):
         matrixSize = 4
-    elif isinstance(vmatrix, vtkMatrix3x3):
+    elif isinstance(vmatrix, vtk.vtkMatrix3x3):
         matrixSize = 3
     else:
         raise RuntimeError("Output vmatrix must be vtk.vtkMatrix3x3 or vtk.vtkMatrix4x4")
@@ -110,9 +103,7 @@ def arrayFromTransformMatrix(transformNode, toWorld=False):
   The returned array is just a copy and so any modification in the array will not affect the transform node.
   To set transformation matrix from a numpy array, use :py:meth:`updateTransformMatrixFromArray`.
   """
-    import numpy as np
-    from vtk import vtkMatrix4x4
-    vmatrix = vtkMatrix4x4()
+    vmatrix = vtk.vtkMatrix4x4()
     if toWorld:
         success = transformNode.GetMatrixTransformToWorld(vmatrix)
     else:
@@ -128,25 +119,121 @@ def updateTransformMatrixFromArray(transformNode, narray, toWorld=False):
     to world matrix will be equal to narray; otherwise transform to parent will be
     set as narray.
   """
-    import numpy as np
-    from vtk import vtkMatrix4x4
     narrayshape = narray.shape
     if narrayshape != (4, 4):
         raise RuntimeError("Unsupported numpy array shape: " + str(narrayshape) + " expected (4,4)")
     if toWorld and transformNode.GetParentTransformNode():
         # thisToParent = worldToParent * thisToWorld = inv(parentToWorld) * toWorld
-        narrayParentToWorld = arrayFromTransformMatrix(transformNode.GetParentTransformNode())
+        narrayParentToWorld = arrayFromTransformMatrix(transformNode.GetParentTransformNode(), toWorld=True)
         thisToParent = np.dot(np.linalg.inv(narrayParentToWorld), narray)
         updateTransformMatrixFromArray(transformNode, thisToParent, toWorld=False)
     else:
-        vmatrix = vtkMatrix4x4()
+        vmatrix = vtk.vtkMatrix4x4()
         updateVTKMatrixFromArray(vmatrix, narray)
         transformNode.SetMatrixTransformToParent(vmatrix)
 
 
+"""Batch variants of the functions above for stacks of transforms (e.g. updating many transform nodes per frame).
+They reuse a module-level scratch vtkMatrix4x4 and write into caller-provided arrays when given, so no VTK or numpy
+objects are created per node."""
+
+_scratch_vmatrix = vtk.vtkMatrix4x4()
+
+
+def arraysFromTransformMatrices(transformNodes, toWorld=False, out=None):
+    """Return the 4x4 matrices of N transform nodes as an (N,4,4) numpy array.
+  :param toWorld: see :py:meth:`arrayFromTransformMatrix`
+  :param out: optional preallocated C-contiguous (N,4,4) float64 array that receives the matrices
+  """
+    if out is None:
+        out = np.empty((len(transformNodes), 4, 4))
+    for n, transformNode in enumerate(transformNodes):
+        if toWorld:
+            success = transformNode.GetMatrixTransformToWorld(_scratch_vmatrix)
+        else:
+            success = transformNode.GetMatrixTransformToParent(_scratch_vmatrix)
+        if not success:
+            raise RuntimeError("Failed to get transformation matrix from node " + transformNode.GetID())
+        _scratch_vmatrix.DeepCopy(out[n].ravel(), _scratch_vmatrix)
+    return out
+
+
+def updateTransformMatricesFromArrays(transformNodes, narrays, toWorld=False):
+    """Set the matrices of N transform nodes from an (N,4,4) numpy array.
+  :param toWorld: if set to True then each transform to world matrix will be equal to its narray; the parent
+    to world matrices are read in one batch and inverted with a single stacked inverse.
+  """
+    narrays = np.asarray(narrays, dtype=float)
+    if narrays.shape != (len(transformNodes), 4, 4):
+        raise RuntimeError("Unsupported numpy array shape: " + str(narrays.shape) +
+                           " expected ({0},4,4)".format(len(transformNodes)))
+    if toWorld:
+        parents = [transformNode.GetParentTransformNode() for transformNode in transformNodes]
+        withParent = [n for n, parent in enumerate(parents) if parent is not None]
+        if withParent:
+            parentToWorld = arraysFromTransformMatrices([parents[n] for n in withParent], toWorld=True)
+            narrays = narrays.copy()
+            narrays[withParent] = np.linalg.inv(parentToWorld) @ narrays[withParent]
+    narrays = np.ascontiguousarray(narrays)
+    for transformNode, narray in zip(transformNodes, narrays):
+        _scratch_vmatrix.DeepCopy(narray.ravel())
+        transformNode.SetMatrixTransformToParent(_scratch_vmatrix)
+
+
 """My custom code below"""
 
 
+def get_ijk_to_ras(volume_node):
+    """ Returns the IJK to RAS matrix of a volume node as a (4,4) numpy array """
+    ijk_to_ras = vtk.vtkMatrix4x4()
+    volume_node.GetIJKToRASMatrix(ijk_to_ras)
+    return arrayFromVTKMatrix(ijk_to_ras)
+
+
+def ras_to_ijk_points(points_ras, volume_node=None, ras_to_ijk=None):
+    """ Converts RAS positions to (continuous) IJK voxel coordinates with one matrix product
+    INPUT: points_ras  [(N,3) or (3,) array]
+           volume_node [vtkMRMLVolumeNode] - volume defining the voxel grid, or
+           ras_to_ijk  [(4,4) array]        - RAS to IJK matrix
+    OUTPUT: points_ijk [(N,3) array] (round to get voxel indices) """
+    if ras_to_ijk is None:
+        ras_to_ijk = np.linalg.inv(get_ijk_to_ras(volume_node))
+    points_ras = np.atleast_2d(np.asarray(points_ras, dtype=float))
+    return points_ras @ ras_to_ijk[:3, :3].T + ras_to_ijk[:3, 3]
+
+
+def ijk_to_ras_points(points_ijk, volume_node=None, ijk_to_ras=None):
+    """ Converts IJK voxel coordinates (N,3) to RAS positions with one matrix product (see ras_to_ijk_points) """
+    if ijk_to_ras is None:
+        ijk_to_ras = get_ijk_to_ras(volume_node)
+    points_ijk = np.atleast_2d(np.asarray(points_ijk, dtype=float))
+    return points_ijk @ ijk_to_ras[:3, :3].T + ijk_to_ras[:3, 3]
+
+
+def evaluate_function_on_volume(volume_node, function, extent=None, max_chunk_voxels=2 ** 22):
+    """ Sets the voxels of a volume to a function of their RAS position, e.g.
+            evaluate_function_on_volume(node, lambda ras: (ras[..., 0] - 10) ** 2 + (ras[..., 1] + 15) ** 2)
+    INPUT: volume_node      [vtkMRMLScalarVolumeNode]
+           function         [callable] - maps a (..., 3) RAS array to an array of values of shape (...)
+           extent           [6 ints]   - inclusive IJK extent (i0, i1, j0, j1, k0, k1) to fill, default: whole volume
+           max_chunk_voxels [int]      - the volume is filled in slabs of k slices of at most this many voxels
+    The RAS grid of each slab is built from the matrix columns by broadcasting, and the values are written through
+    arrayFromVolume, so memory stays bounded and no per-voxel calls are made """
+    voxels = slicer.util.arrayFromVolume(volume_node)
+    if extent is None:
+        extent = (0, voxels.shape[2] - 1, 0, voxels.shape[1] - 1, 0, voxels.shape[0] - 1)
+    ijk_to_ras = get_ijk_to_ras(volume_node)
+    i = np.arange(extent[0], extent[1] + 1)
+    j = np.arange(extent[2], extent[3] + 1)
+    ij_ras = (i[None, :, None] * ijk_to_ras[:3, 0] + j[:, None, None] * ijk_to_ras[:3, 1]) + ijk_to_ras[:3, 3]
+    slab = max(int(max_chunk_voxels) // ij_ras[..., 0].size, 1)
+    for k0 in range(extent[4], extent[5] + 1, slab):
+        k = np.arange(k0, min(k0 + slab, extent[5] + 1))
+        ras = ij_ras[None] + k[:, None, None, None] * ijk_to_ras[:3, 2]
+        voxels[k[0]:k[-1] + 1, extent[2]:extent[3] + 1, extent[0]:extent[1] + 1] = function(ras)
+    slicer.util.arrayFromVolumeModified(volume_node)
+
+
 def make_igtl_node(ip, port, name):
     """ Creates an IGT_link node in Slicer that can be used to communicate with e.g. ROS
     INPUT: ip   [str]  - IP address, (accepts 'localhost')
@@ -387,10 +474,8 @@ class SlicerTrajectoryModel:
 #         # each markup is given a unique id which can be accessed from the superclass level
 #         self.drillTipFiducialID = self.drillTipMarkupNode.GetNthMarkupID(n)
 #         self.drillTipMarkupNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self.drill_tip_callback)
-#         self.cartesian_to_voxel_transform = vtk.vtkMatrix4x4()  # Slicer calls this RAS to IJK coordinates
-#         self.volume_model.label_volumeNode.GetRASToIJKMatrix(self.cartesian_to_voxel_transform)
-#         v_rad = [self.radius, 0, 0, 1]
-#         self.voxel_radius = np.linalg.norm(self.cartesian_to_voxel_transform.MultiplyPoint(v_rad))
+#         self.ras_to_ijk = np.linalg.inv(get_ijk_to_ras(self.volume_model.label_volumeNode))
+#         self.voxel_radius = np.linalg.norm(self.radius * self.ras_to_ijk[:3, 0])
 #
 #     def get_drill_tip_pos(self):
 #         pos = np.array([0.0, 0.0, 0.0])
@@ -398,8 +483,7 @@ class SlicerTrajectoryModel:
 #         return pos
 #
 #     def drill_tip_callback(self):
-#         cartesian_position = np.append(self.get_drill_tip_pos(), 1.0)
-#         voxel_position = self.cartesian_to_voxel_transform.MultiplyPoint(cartesian_position)
+#         voxel_position = ras_to_ijk_points(self.get_drill_tip_pos(), ras_to_ijk=self.ras_to_ijk)[0]
 #
 #     def remove_material(self, bone, shape, prev_state, dim_scales):
 #         """
@@ -455,63 +539,3 @@ class SlicerTrajectoryModel:
 #         else:
 #             shared_vars.drill_contact = False
 #             return False
-#
-#
-# volumeNode=slicer.util.getNode('MRHead')
-# ijkToRas = vtk.vtkMatrix4x4()
-# volumeNode.GetIJKToRASMatrix(ijkToRas)
-#
-# for k in range(extent[4], extent[5]+1):
-#   for j in range(extent[2], extent[3]+1):
-#     for i in range(extent[0], extent[1]+1):
-#       position_Ijk=[i, j, k, 1]
-#       position_Ras=ijkToRas.MultiplyPoint(position_Ijk)
-#       r=position_Ras[0]
-#       a=position_Ras[1]
-#       s=position_Ras[2]
-#       functionValue=(r-10)*(r-10)+(a+15)*(a+15)+s*s
-#       imageData.SetScalarComponentFromDouble(i,j,k,0,functionValue)
-# imageData.Modified()
-#
-#
-#
-# >>>
-# >>> volumeNode.GetRASToIJKMatrix(rasToijk)
-# >>> rasToijk
-# (vtkCommonMathPython.vtkMatrix4x4)0x7fa1c167a940
-# >>> X = get_drill_position()
-# >>> X
-# array([  98.03942743,   54.84340186, -709.32807135])
-# >>> rasToijk.MultiplyPoint(X)
-# Traceback (most recent call last):
-#   File "<console>", line 1, in <module>
-# TypeError: MultiplyPoint argument 1: expected a sequence of 4 values, got 3 values
-# >>> rasToijk.MultiplyPoint(X.append(1))
-# Traceback (most recent call last):
-#   File "<console>", line 1, in <module>
-# AttributeError: 'numpy.ndarray' object has no attribute 'append'
-# >>> [X,1]
-# [array([  98.03942743,   54.84340186, -709.32807135]), 1]
-# >>> X.append(1)
-# Traceback (most recent call last):
-#   File "<console>", line 1, in <module>
-# AttributeError: 'numpy.ndarray' object has no attribute 'append'
-# >>>  Y = np.append(X,1)
-#   File "<console>", line 1
-#     Y = np.append(X,1)
-#     ^
-# IndentationError: unexpected indent
-# >>> Y = np.append(X,1)
-# >>> rasToijk.MultiplyPoint(Y)
-# (0.6970177888870239, 387.1557312011719, 376.3438720703125, 1.0)
-# >>> O = volumeNode.GetOrigin()
-# >>> np.append(O,1)
-# array([  98.30761719,  203.80761719, -897.5       ,    1.        ])
-# >>> rasToijk.MultiplyPoint(O)
-# Traceback (most recent call last):
-#   File "<console>", line 1, in <module>
-# TypeError: MultiplyPoint argument 1: expected a sequence of 4 values, got 3 values
-# >>> O = np.append(O,1)
-# >>> rasToijk.MultiplyPoint(O)
-# (0.0, 2.2737367544323206e-13, -2.2737367544323206e-13, 1.0)
-# >>>
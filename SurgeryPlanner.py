@@ -7,17 +7,15 @@ import slicer
 from slicer.ScriptedLoadableModule import *
 import logging
 import sys
+import time
 
 # Ensure Resources is in path for module imports
 resources_path = os.path.join(os.path.dirname(__file__), 'Resources')
 if resources_path not in sys.path:
     sys.path.append(resources_path)
 
-from SurgeryPlannerLib import surgery_planner_helper as sh
-from SurgeryPlannerLib.SurgeryPlannerLogic import SurgeryPlannerLogic, setSlicePoseFromSliceNormalAndPosition
-from SurgeryPlannerLib.TrajectoryPlanner import TrajectoryPlannerWidget
-from SurgeryPlannerLib.SegmentationPlanner import SegmentationPlannerWidget
-from SurgeryPlannerLib.ReferencePlanePlanner import ReferencePlanePlannerWidget
+from SurgeryPlannerLib.SurgeryPlannerLogic import SurgeryPlannerLogic, SessionSnapshots
+# The planner widgets (and their imports) are loaded when their mode is first selected, see getPlannerWidget
 
 # SurgeryPlanner
 class SurgeryPlanner(ScriptedLoadableModule):
@@ -46,6 +44,7 @@ class SurgeryPlannerWidget(ScriptedLoadableModuleWidget):
   """
 
     def setup(self):
+        startTime = time.perf_counter()
         ScriptedLoadableModuleWidget.setup(self)
         self.dir = os.path.dirname(__file__)
         self.logic = SurgeryPlannerLogic()
@@ -60,35 +59,133 @@ class SurgeryPlannerWidget(ScriptedLoadableModuleWidget):
         self.modeSelector.currentIndexChanged.connect(self.onModeChanged)
         self.layout.addWidget(self.modeSelector)
 
+        # One (initially empty) area per planner; the planner widget is built on first selection
+        self.trajectoryPlannerWidget = None
+        self.segmentationPlannerWidget = None
+        self.referencePlanePlannerWidget = None
+
         # --- Trajectory Area ---
         self.trajectoryArea = qt.QWidget()
         self.trajectoryLayout = qt.QVBoxLayout(self.trajectoryArea)
         self.layout.addWidget(self.trajectoryArea)
-        
-        self.trajectoryPlannerWidget = TrajectoryPlannerWidget(self.trajectoryArea, self.logic, self.dir)
-        self.trajectoryLayout.addWidget(self.trajectoryPlannerWidget)
 
         # --- Segmentation Area ---
         self.segmentationArea = qt.QWidget()
         self.segmentationLayout = qt.QVBoxLayout(self.segmentationArea)
         self.layout.addWidget(self.segmentationArea)
-        
-        self.segmentationPlannerWidget = SegmentationPlannerWidget(self.segmentationArea, self.logic, self.dir)
-        self.segmentationLayout.addWidget(self.segmentationPlannerWidget)
-        
+
         # --- Reference Plane Area ---
         self.referencePlaneArea = qt.QWidget()
         self.referencePlaneLayout = qt.QVBoxLayout(self.referencePlaneArea)
         self.layout.addWidget(self.referencePlaneArea)
-        
-        self.referencePlanePlannerWidget = ReferencePlanePlannerWidget(self.referencePlaneArea, self.logic, self.dir)
-        self.referencePlaneLayout.addWidget(self.referencePlanePlannerWidget)
 
         # Initial State
         self.onModeChanged(0)
 
+        # Crash-recovery snapshots of this session, keyed by the trajectory planner's session timestamp
+        self.sessionSnapshots = SessionSnapshots(self.trajectoryPlannerWidget.session_timestamp)
+        self.snapshotTimer = qt.QTimer()
+        self.snapshotTimer.setInterval(self.SNAPSHOT_INTERVAL_MS)
+        self.snapshotTimer.timeout.connect(self.saveSessionSnapshot)
+        self.snapshotTimer.start()
+        qt.QTimer.singleShot(0, self.offerSessionRestore)
+        logging.info(f"[SurgeryPlanner] Module setup in {time.perf_counter() - startTime:.3f} s")
+
+    SNAPSHOT_INTERVAL_MS = 30000
+
     def cleanup(self):
-        pass
+        self.snapshotTimer.stop()
+        self.saveSessionSnapshot(cleanExit=True)
+        self.sessionSnapshots.close()
+        for widget in (self.trajectoryPlannerWidget, self.segmentationPlannerWidget, self.referencePlanePlannerWidget):
+            if widget:
+                widget.cleanup()
+        self.logic.cleanup()
+
+    def saveSessionSnapshot(self, cleanExit=False):
+        """Snapshot trajectories, planes, display properties and selection (written in the background)."""
+        try:
+            startTime = time.perf_counter()
+            trajectoryWidget = self.trajectoryPlannerWidget
+            selectedTrajectory = trajectoryWidget.selectedTraj.trajNum if trajectoryWidget.selectedTraj else None
+            selectedPlane = None
+            if self.referencePlanePlannerWidget and self.referencePlanePlannerWidget.planeSelector.currentNode():
+                selectedPlane = self.referencePlanePlannerWidget.planeSelector.currentNode().GetName()
+            metadata, arrays = self.logic.collectSessionState(trajectoryWidget.sharedMarkupNode,
+                                                              selectedTrajectory, selectedPlane)
+            if self.sessionSnapshots.save(metadata, arrays, cleanExit=cleanExit, wait=cleanExit):
+                logging.info(f"[SurgeryPlanner] Session snapshot taken in {time.perf_counter() - startTime:.3f} s")
+        except Exception as e:
+            print(f"[SurgeryPlanner] Failed to take session snapshot: {e}")
+
+    def offerSessionRestore(self):
+        """Offer to restore the last snapshot of a session that did not exit cleanly."""
+        recoverable = self.sessionSnapshots.findRecoverable()
+        if recoverable is None:
+            return
+        filename, metadata = recoverable
+        if not metadata.get('trajectory_count') and not metadata.get('plane_count'):
+            return
+        ret = qt.QMessageBox.question(None, "Restore Session",
+                                      f"A previous session ({metadata.get('session_timestamp')}) did not exit "
+                                      f"cleanly. Restore its {metadata.get('trajectory_count', 0)} trajectories "
+                                      f"and {metadata.get('plane_count', 0)} reference planes?",
+                                      qt.QMessageBox.Yes | qt.QMessageBox.No)
+        if ret == qt.QMessageBox.Yes:
+            self.restoreSessionSnapshot(filename)
+
+    def restoreSessionSnapshot(self, filename):
+        try:
+            metadata, arrays = self.sessionSnapshots.load(filename)
+            self.restorePlanState(metadata, arrays)
+            print(f"[SurgeryPlanner] Restored session {metadata.get('session_timestamp')} from {filename}")
+        except Exception as e:
+            print(f"[SurgeryPlanner] Failed to restore session snapshot: {e}")
+
+    def restorePlanState(self, metadata, arrays):
+        """Replace trajectories and reference planes with a plan from a session snapshot or the plan repository."""
+        trajectoryWidget = self.getPlannerWidget("Trajectory Planning")
+        trajectoryWidget.restoreTrajectories(arrays['trajectory_numbers'], arrays['entries'], arrays['targets'],
+                                             metadata.get('selected_trajectory'))
+        self.logic.applyLandmarkDisplay(trajectoryWidget.sharedMarkupNode, metadata.get('landmark_display'))
+        if metadata['plane_names'] or slicer.util.getNodesByClass("vtkMRMLMarkupsPlaneNode"):
+            display = arrays['plane_display']
+            self.getPlannerWidget("Reference Plane Planning").restorePlanes(
+                metadata['plane_names'], arrays['plane_matrices'], arrays['plane_sizes'], display[:, :3],
+                display[:, 3], display[:, 4], metadata.get('selected_plane'))
+
+    def getPlannerWidget(self, mode):
+        """Return the planner widget of a mode, building it (and importing its module) on first use."""
+        startTime = time.perf_counter()
+        if mode == "Trajectory Planning":
+            if self.trajectoryPlannerWidget is None:
+                from SurgeryPlannerLib.TrajectoryPlanner import TrajectoryPlannerWidget
+                self.trajectoryPlannerWidget = TrajectoryPlannerWidget(self.trajectoryArea, self.logic, self.dir)
+                self.trajectoryPlannerWidget.restorePlanCallback = self.restorePlanState
+                self.trajectoryLayout.addWidget(self.trajectoryPlannerWidget)
+                logging.info(f"[SurgeryPlanner] {mode} widget built in {time.perf_counter() - startTime:.3f} s")
+            return self.trajectoryPlannerWidget
+        if mode == "Segmentation Planning":
+            if self.segmentationPlannerWidget is None:
+                from SurgeryPlannerLib.SegmentationPlanner import SegmentationPlannerWidget
+                self.segmentationPlannerWidget = SegmentationPlannerWidget(self.segmentationArea, self.logic, self.dir)
+                self.segmentationPlannerWidget.targetCallback = self.setSelectedTrajectoryTarget
+                self.segmentationLayout.addWidget(self.segmentationPlannerWidget)
+                logging.info(f"[SurgeryPlanner] {mode} widget built in {time.perf_counter() - startTime:.3f} s")
+            return self.segmentationPlannerWidget
+        if mode == "Reference Plane Planning":
+            if self.referencePlanePlannerWidget is None:
+                from SurgeryPlannerLib.ReferencePlanePlanner import ReferencePlanePlannerWidget
+                self.referencePlanePlannerWidget = ReferencePlanePlannerWidget(self.referencePlaneArea, self.logic,
+                                                                               self.dir)
+                self.referencePlaneLayout.addWidget(self.referencePlanePlannerWidget)
+                logging.info(f"[SurgeryPlanner] {mode} widget built in {time.perf_counter() - startTime:.3f} s")
+            return self.referencePlanePlannerWidget
+        return None
+
+    def setSelectedTrajectoryTarget(self, position):
+        # "Use Centroid as Target" from the segmentation planner (builds the trajectory planner if needed)
+        self.getPlannerWidget("Trajectory Planning").setSelectedTrajectoryTarget(position)
 
     def onModeChanged(self, index):
         mode = self.modeSelector.currentText
@@ -99,10 +196,13 @@ class SurgeryPlannerWidget(ScriptedLoadableModuleWidget):
         self.referencePlaneArea.hide()
         
         if mode == "Trajectory Planning":
+            self.getPlannerWidget(mode)
             self.trajectoryArea.show()
         elif mode == "Segmentation Planning":
+            self.getPlannerWidget(mode)
             self.segmentationArea.show()
         elif mode == "Reference Plane Planning":
+            self.getPlannerWidget(mode)
             self.referencePlaneArea.show()
         elif mode == "Restart Slicer":
             slicer.util.restart()